@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import contextlib, threading, time
+from urllib.error import HTTPError
+
+class Overloaded(HTTPError):
+    ''' raised when a conversion is shed. retry_after is the suggested wait in seconds '''
+    def __init__(self, reason, retry_after):
+        HTTPError.__init__(self, reason, 503, 'overloaded: ' + reason, {'Retry-After': str(retry_after)}, None)
+        self.retry_after = retry_after
+
+class AdmissionController:
+    ''' global budgets of the gateway: concurrent builds, bytes of pages held by the
+    builds and chapter downloads waiting in the fetch pool.
+    a build holds a slot from build() until it is stored. once the TOC is read,
+    SimpleCache.fetch_all charges the build with charge(): pages * page_bytes in flight
+    until the build ends, and the cache misses as queued fetches until they are done.
+    a request over a budget waits up to max_wait seconds for others to finish, and is
+    then rejected with Overloaded. a job larger than a budget is admitted when nothing
+    else holds it, so that any novel can still be converted on an idle server. '''
+    def __init__(self, max_builds=4, max_bytes=256 * 1024 * 1024, max_queued_fetches=2000,
+                 page_bytes=32 * 1024, max_wait=10, retry_after=60):
+        self.max_builds = max_builds
+        self.max_bytes = max_bytes
+        self.max_queued_fetches = max_queued_fetches
+        self.page_bytes = page_bytes
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.cond = threading.Condition()
+        self.builds = 0
+        self.bytes = 0
+        self.queued_fetches = 0
+        self.local = threading.local()
+
+    def __wait(self, fits, reason):
+        ''' wait until fits() holds. called with cond held '''
+        deadline = time.monotonic() + self.max_wait
+        while not fits():
+            timeout = deadline - time.monotonic()
+            if timeout <= 0: raise Overloaded(reason, self.retry_after)
+            self.cond.wait(timeout)
+
+    @contextlib.contextmanager
+    def build(self):
+        ''' hold a build slot (and the bytes charged to it) during the with block '''
+        with self.cond:
+            self.__wait(lambda: self.builds < self.max_builds, 'too many conversions')
+            self.builds += 1
+        self.local.bytes = 0
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.builds -= 1
+                self.bytes -= self.local.bytes
+                self.cond.notify_all()
+            self.local.bytes = None
+
+    def charge(self, pages, missing):
+        ''' charge the build of this thread for a batch of pages of which missing must be
+        downloaded. return a callable that returns the queued fetches, or None outside
+        of a build (e.g. the command line converters) '''
+        if getattr(self.local, 'bytes', None) is None: return None
+        cost = pages * self.page_bytes
+        with self.cond:
+            self.__wait(lambda: self.bytes == self.local.bytes or self.bytes + cost <= self.max_bytes,
+                        'too many pages in memory')
+            self.__wait(lambda: self.queued_fetches == 0 or self.queued_fetches + missing <= self.max_queued_fetches,
+                        'too many pages to download')
+            self.bytes += cost
+            self.local.bytes += cost
+            self.queued_fetches += missing
+        def done():
+            with self.cond:
+                self.queued_fetches -= missing
+                self.cond.notify_all()
+        return done
+
+    def stats(self):
+        with self.cond:
+            return {'builds': self.builds, 'bytes': self.bytes, 'queued_fetches': self.queued_fetches}
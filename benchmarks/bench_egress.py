@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+''' run fetch workers on loopback against a mock site that limits the requests of each
+client address, and measure how long SimpleCache takes to download a batch of pages
+through one and through several workers. each worker sends its requests from its own
+address (127.0.0.2, 127.0.0.3, ...), so the site sees them as separate clients.
+
+  $ python3 benchmarks/bench_egress.py [pages] [workers] '''
+
+import collections, datetime, http.server, os.path, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache import SimpleCache
+import fetch_worker
+
+LIMIT = 10      # requests per client address
+WINDOW = 1.0    # per this many seconds
+
+class MockSite(http.server.BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    requests = collections.defaultdict(collections.deque)
+    throttled = 0
+
+    def do_GET(self):
+        now = time.monotonic()
+        with MockSite.lock:
+            times = MockSite.requests[self.client_address[0]]
+            while len(times) > 0 and times[0] <= now - WINDOW: times.popleft()
+            limited = len(times) >= LIMIT
+            if limited: MockSite.throttled += 1
+            else: times.append(now)
+        if limited:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = ('<html><body>%s</body></html>' % self.path).encode('UTF-8') * 50
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class QuietWorker(fetch_worker.FetchWorkerHandler):
+    def log_message(self, *args):
+        pass
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run(pages, worker_count):
+    site = start(http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockSite))
+    workers = []
+    for i in range(worker_count):
+        worker = fetch_worker.serve('127.0.0.1', 0, source_address='127.0.0.%d' % (i + 2))
+        worker.RequestHandlerClass.log_message = QuietWorker.log_message
+        workers.append(start(worker))
+    pool = fetch_worker.EgressPool(['http://127.0.0.1:%d' % w.server_port for w in workers],
+                                   rate=LIMIT / WINDOW / 2, burst=LIMIT // 2, throttle_time=WINDOW,
+                                   max_wait=5)
+    MockSite.requests.clear()
+    MockSite.throttled = 0
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = SimpleCache(cache_dir, retry_delays=(1, 2, 4), egress=pool)
+        urls = ['http://127.0.0.1:%d/%d/' % (site.server_port, i) for i in range(pages)]
+        t0 = time.perf_counter()
+        results = cache.fetch_all(urls)
+        elapsed = time.perf_counter() - t0
+    assert all(results[i] is not None for i in range(len(urls)))
+    for server in [site] + workers: server.shutdown()
+    return (elapsed, MockSite.throttled, pool.stats())
+
+if __name__ == '__main__':
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    worker_count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    for n in sorted(set((1, worker_count))):
+        (elapsed, throttled, stats) = run(pages, n)
+        print('%d worker(s): %d pages in %.2f s (%.1f pages/s), %d throttled by the site' %
+              (n, pages, elapsed, pages / elapsed, throttled))
+        for s in stats:
+            print('  %s fetched %d, failed %d' % (s['url'], s['fetched'], s['failed']))
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+''' measure the per-page extraction time of the compiled site rules (extract.Rules)
+against walking the whole tree in python, on synthetic syosetu episode and TOC pages
+surrounded by the usual amount of site chrome. parsing is not included. '''
+
+import io, os.path, statistics, sys, time
+import lxml.html
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from syosetu_com import SyosetuCom
+
+CHROME = ''.join('<div class="nav%d"><ul>%s</ul></div>' % (i, '<li><a href="#">menu</a></li>' * 10)
+                 for i in range(60))
+
+def episode_page(lines=200):
+    body = '<br>'.join('本文%dの行です。<ruby>漢字<rt>かんじ</rt></ruby>' % i for i in range(lines))
+    return ('<html><head><meta charset="utf-8"></head><body>%s<div id="novel_view">%s</div>%s</body></html>'
+            % (CHROME, body, CHROME)).encode('UTF-8')
+
+def toc_page(episodes=500):
+    rows = []
+    for i in range(episodes):
+        if i % 50 == 0: rows.append('<tr><td class="chapter">第%d章</td></tr>' % (i // 50 + 1))
+        rows.append('<tr><td class="period_subtitle"><a href="/n0000a/%d/">第%d話</a></td>'
+                    '<td class="long_update">2014/01/01 00:00</td></tr>' % (i + 1, i + 1))
+    return ('<html><head><meta charset="utf-8"></head><body>%s<div class="novel_sublist"><table>%s</table></div>%s'
+            '</body></html>' % (CHROME, ''.join(rows), CHROME)).encode('UTF-8')
+
+def walk_body(tree):
+    for div in tree.iter('div'):
+        if 'id' not in div.attrib: continue
+        if div.attrib['id'] == 'novel_view': return div
+
+def walk_toc(tree):
+    for div in tree.iter('div'):
+        if 'class' in div.attrib and div.attrib['class'] == 'novel_sublist': break
+    cells = []
+    for td in div.iter('td'):
+        if 'class' not in td.attrib: continue
+        if td.attrib['class'] in ('chapter', 'period_subtitle', 'long_subtitle'):
+            updated = None
+            for sib in td.itersiblings(tag='td'):
+                if sib.attrib.get('class') == 'long_update': updated = sib.text
+            cells.append((td, updated))
+    return cells
+
+def rules_toc(tree):
+    items = []
+    for e in SyosetuCom.rules.all('toc_items', tree):
+        if e.tag == 'a' or e.attrib['class'] == 'chapter': items.append([e, None])
+        else: items[-1][1] = e.text
+    return items
+
+def measure(cases, count):
+    ''' run the cases interleaved so that they see the same machine load '''
+    times = [[] for _ in cases]
+    for _ in range(count):
+        for (i, (_, func, tree)) in enumerate(cases):
+            t0 = time.perf_counter()
+            func(tree)
+            times[i].append((time.perf_counter() - t0) * 1000000)
+    return [(min(t), statistics.median(t)) for t in times]
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    episode = lxml.html.parse(io.BytesIO(episode_page()))
+    toc = lxml.html.parse(io.BytesIO(toc_page()))
+    assert walk_body(episode) is SyosetuCom.rules.first('body', episode)
+    assert len(walk_toc(toc)) == len(rules_toc(toc))
+    cases = (('episode body, tree walk', walk_body, episode),
+             ('episode body, rules', lambda t: SyosetuCom.rules.first('body', t), episode),
+             ('toc, tree walk', walk_toc, toc),
+             ('toc, rules', rules_toc, toc))
+    for ((name, _, _), result) in zip(cases, measure(cases, count)):
+        print('%-26s min %9.1f us, median %9.1f us' % ((name + ':',) + result))
@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+''' measure the cold start of the gateway: import wsgi_gw and render the index page
+in a fresh interpreter, and check that no converter module (or lxml) was loaded. '''
+
+import os.path, statistics, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = '''
+import sys, time
+t0 = time.perf_counter()
+import wsgi_gw
+t1 = time.perf_counter()
+body = wsgi_gw.application({'QUERY_STRING': ''}, lambda status, headers: None)
+t2 = time.perf_counter()
+loaded = [m for m in ('lxml', 'syosetu_com', 'mai_net', 'epub', 'style') if m in sys.modules]
+print(t1 - t0, t2 - t1, ','.join(loaded))
+'''
+
+def run_once():
+    out = subprocess.check_output([sys.executable, '-c', SCRIPT], cwd=ROOT).decode().split()
+    return (float(out[0]), float(out[1]), out[2] if len(out) > 2 else '')
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    results = [run_once() for _ in range(count)]
+    imports = [r[0] * 1000 for r in results]
+    index = [r[1] * 1000 for r in results]
+    print('import wsgi_gw: min %.2f ms, median %.2f ms' % (min(imports), statistics.median(imports)))
+    print('index page:     min %.2f ms, median %.2f ms' % (min(index), statistics.median(index)))
+    loaded = set(m for r in results for m in r[2].split(',') if len(m) > 0)
+    print('eagerly loaded: ' + (', '.join(sorted(loaded)) if len(loaded) > 0 else 'none'))
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+''' convert a synthetic directory tree of chapter files (text.py -d) with the files
+rendered one by one when the book is saved, and with them stat-ed, read and rendered
+ahead on a pool of threads.
+
+  $ python3 benchmarks/bench_text.py [files] [workers] [--cold]
+
+--cold drops the page cache of the os before each conversion (linux, root only), so
+that the files are read from the disk as in a batch job over a new archive. '''
+
+import io, os, os.path, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from epub import EPUBPackage
+from style import StylesheetMap, SimpleVerticalWritingStyle
+from text import TextToEpub
+
+def make_tree(root, files, per_dir=100, lines=60):
+    for i in range(files):
+        d = os.path.join(root, '%03d_第%d部' % (i // per_dir, i // per_dir + 1))
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, '%03d_第%d話.txt' % (i % per_dir, i + 1)), 'w', encoding='UTF-8') as f:
+            f.write('\n'.join('本文%dの%d行目です。「会話の行」もあります。' % (i, n) for n in range(lines)))
+
+def drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+def run(root, max_workers, cold):
+    if cold: drop_caches()
+    css_map = StylesheetMap(('style.css', SimpleVerticalWritingStyle))
+    converter = TextToEpub(max_workers=max_workers)
+    t0 = time.perf_counter()
+    book = converter.read_tree(root, css_map)
+    t1 = time.perf_counter()
+    package = EPUBPackage(reproducible=True)
+    converter.write_book('bench', 'author', book, css_map, package)
+    out = io.BytesIO()
+    package.save(out)
+    t2 = time.perf_counter()
+    return (t1 - t0, t2 - t1, out.getvalue())
+
+if __name__ == '__main__':
+    cold = '--cold' in sys.argv
+    args = [a for a in sys.argv[1:] if a != '--cold']
+    files = int(args[0]) if len(args) > 0 else 5000
+    workers = int(args[1]) if len(args) > 1 else 4
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, files)
+        results = {}
+        for max_workers in (None, workers):
+            (read, save, data) = results[max_workers] = run(root, max_workers, cold)
+            print('%-10s read %.2f s, render and save %.2f s, total %.2f s (%d bytes)' %
+                  ('one by one' if max_workers is None else '%d threads' % max_workers,
+                   read, save, read + save, len(data)))
+        assert results[None][2] == results[workers][2]
@@ -1,18 +1,20 @@
 import datetime, hashlib, zlib, urllib.request
-import concurrent.futures, os.path, shelve, sys, time
+import collections, collections.abc, concurrent.futures, mmap, os, os.path, sqlite3, sys, tempfile, threading, time
 from urllib.error import HTTPError
 
-def url_readall(url):
+def url_readall(url, opener=None, max_retry_count=3):
+    ''' opener: an urllib.request.OpenerDirector to open url with instead of urlopen() '''
     last_exception_is_503 = False
-    max_retry_count = 3
     for retry_count in range(max_retry_count):
         last_retry = (retry_count == max_retry_count - 1)
         sleep_time = 1
         last_exception_is_503 = False
         try:
-            with urllib.request.urlopen(url) as res:
-                return (res.readall(), res)
+            with (opener.open(url) if opener is not None else urllib.request.urlopen(url)) as res:
+                return (res.read(), res)
         except HTTPError as ex:
+            if ex.code in (404, 410):
+                raise
             if ex.code in (503,):
                 sys.stderr.write('urlopen failed. retry...' + url + '\n')
                 sleep_time = 10
@@ -28,78 +30,694 @@ def url_readall(url):
     else:
         raise HTTPError(url, 500, None, None, None)
 
+class FetchIncomplete(HTTPError):
+    ''' raised by fetch_all when some urls still failed after all retries.
+    every page fetched so far is already stored in the cache, so a retried build
+    only has to download failed_urls '''
+    def __init__(self, failed_urls, code):
+        HTTPError.__init__(self, failed_urls[0], code, '%d urls failed' % len(failed_urls), None, None)
+        self.failed_urls = failed_urls
+
+CacheEntry = collections.namedtuple('CacheEntry', ('accessed', 'hash', 'modified', 'encoding'))
+
+class BlobStore:
+    ''' content-addressed file store.
+    blobs are stored as <root>/aa/bb/<hash> and committed with an atomic rename,
+    so several processes can share one directory without locking. '''
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    def path(self, hash_value):
+        return os.path.join(self.root_dir, hash_value[0:2], hash_value[2:4], hash_value)
+
+    def exists(self, hash_value):
+        return os.path.isfile(self.path(hash_value))
+
+    def __commit(self, tmp_path, hash_value):
+        path = self.path(hash_value)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    def put(self, hash_value, data):
+        if self.exists(hash_value): return hash_value
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.root_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            self.__commit(tmp_path, hash_value)
+        except:
+            os.unlink(tmp_path)
+            raise
+        return hash_value
+
+    def put_stream(self, fileobj, hash_value=None, chunk_size=1024 * 64):
+        ''' copy fileobj into the store. return the hash of its contents,
+        or hash_value as is when it is given '''
+        if hash_value is not None and self.exists(hash_value): return hash_value
+        h = hashlib.sha512()
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.root_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    buf = fileobj.read(chunk_size)
+                    if not buf: break
+                    if hash_value is None: h.update(buf)
+                    f.write(buf)
+            if hash_value is None: hash_value = h.hexdigest()[0:64]
+            if self.exists(hash_value):
+                os.unlink(tmp_path)
+            else:
+                self.__commit(tmp_path, hash_value)
+        except:
+            if os.path.exists(tmp_path): os.unlink(tmp_path)
+            raise
+        return hash_value
+
+    def open(self, hash_value):
+        return open(self.path(hash_value), 'rb')
+
+    def remove(self, hash_value):
+        try:
+            os.unlink(self.path(hash_value))
+        except FileNotFoundError:
+            pass
+
+    def map(self, hash_value):
+        ''' return a read-only buffer of the blob without copying it (None if not exists) '''
+        try:
+            with self.open(hash_value) as f:
+                if os.fstat(f.fileno()).st_size == 0: return memoryview(b'')
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+class CacheIndex:
+    ''' key -> CacheEntry index stored in sqlite3.
+    sqlite takes care of the locking when several processes share one index. '''
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                        'key TEXT PRIMARY KEY, accessed TEXT, hash TEXT, modified TEXT, encoding TEXT)')
+
+    def __to_str(dt):
+        return dt.isoformat() if dt is not None else None
+    def __to_datetime(s):
+        return datetime.datetime.fromisoformat(s) if s is not None else None
+    def __to_entry(row):
+        return CacheEntry(CacheIndex.__to_datetime(row[0]), row[1], CacheIndex.__to_datetime(row[2]), row[3])
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT accessed, hash, modified, encoding FROM entries WHERE key=?',
+                                  (key,)).fetchone()
+        return CacheIndex.__to_entry(row) if row is not None else None
+
+    def get_many(self, keys, batch_size=500):
+        ''' return {key: entry} of the given keys that exist, reading batch_size keys per query '''
+        keys = list(keys)
+        result = {}
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i+batch_size]
+            with self.lock:
+                rows = self.db.execute('SELECT key, accessed, hash, modified, encoding FROM entries WHERE key IN (%s)'
+                                       % ','.join('?' * len(batch)), batch).fetchall()
+            for row in rows:
+                result[row[0]] = CacheIndex.__to_entry(row[1:])
+        return result
+
+    def __to_row(key, entry):
+        return (key, CacheIndex.__to_str(entry.accessed), entry.hash,
+                CacheIndex.__to_str(entry.modified), entry.encoding)
+
+    def put(self, key, entry):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)', CacheIndex.__to_row(key, entry))
+
+    def put_many(self, items, keep_newer=False):
+        ''' write [(key, entry)] in one transaction. with keep_newer, existing entries
+        accessed later than the new ones are left as is '''
+        sql = 'INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)'
+        if keep_newer:
+            sql = ('INSERT INTO entries VALUES (?,?,?,?,?) ON CONFLICT(key) DO UPDATE SET '
+                   'accessed=excluded.accessed, hash=excluded.hash, modified=excluded.modified, '
+                   'encoding=excluded.encoding WHERE excluded.accessed > entries.accessed')
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany(sql, [CacheIndex.__to_row(key, entry) for (key, entry) in items])
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def delete(self, key):
+        with self.lock:
+            self.db.execute('DELETE FROM entries WHERE key=?', (key,))
+
+    def items(self):
+        ''' return [(key, entry)] of all entries '''
+        with self.lock:
+            rows = self.db.execute('SELECT key, accessed, hash, modified, encoding FROM entries').fetchall()
+        return [(row[0], CacheIndex.__to_entry(row[1:])) for row in rows]
+
+class FetchQueue:
+    ''' per-conversion task queue of a FetchScheduler '''
+    def __init__(self, scheduler, weight, max_in_flight, priority):
+        self.scheduler = scheduler
+        self.weight = weight
+        self.credit = weight
+        self.max_in_flight = max_in_flight
+        self.priority = priority
+        self.in_flight = 0
+        self.urgent = collections.deque()
+        self.normal = collections.deque()
+
+    def submit(self, fn, *args, urgent=False):
+        future = concurrent.futures.Future()
+        with self.scheduler.cond:
+            (self.urgent if urgent else self.normal).append((future, fn, args))
+            self.scheduler.cond.notify()
+        return future
+
+    def close(self):
+        ''' cancel the pending tasks and leave the rotation '''
+        with self.scheduler.cond:
+            for (future, _, _) in list(self.urgent) + list(self.normal):
+                future.cancel()
+            self.urgent.clear()
+            self.normal.clear()
+            if self in self.scheduler.queues:
+                self.scheduler.queues.remove(self)
+
+class FetchScheduler:
+    ''' runs fetch tasks on a fixed set of worker threads shared fairly between conversions.
+    each conversion submits to its own FetchQueue. idle workers take a task from the queues
+    in weighted round-robin order, skipping queues that reached their in-flight cap.
+    urgent tasks and priority queues (background revalidations, short stories) are served first. '''
+    def __init__(self, max_workers=8, max_in_flight=None):
+        self.cond = threading.Condition()
+        self.queues = []
+        self.position = 0
+        self.max_in_flight = max_in_flight if max_in_flight is not None else max_workers
+        for _ in range(max_workers):
+            threading.Thread(target=self.__worker, daemon=True).start()
+
+    def open_queue(self, weight=1, max_in_flight=None, priority=False):
+        queue = FetchQueue(self, weight, max_in_flight if max_in_flight is not None else self.max_in_flight,
+                           priority)
+        with self.cond:
+            self.queues.append(queue)
+        return queue
+
+    def __pick(self):
+        def is_urgent(q): return q.priority or len(q.urgent) > 0
+        candidates = [q for q in self.queues if q.in_flight < q.max_in_flight and (len(q.urgent) + len(q.normal)) > 0]
+        if len(candidates) == 0: return None
+        urgent_only = any(is_urgent(q) for q in candidates)
+        n = len(self.queues)
+        for i in range(n):
+            idx = (self.position + i) % n
+            q = self.queues[idx]
+            if q not in candidates or (urgent_only and not is_urgent(q)): continue
+            q.credit -= 1
+            if q.credit <= 0:
+                q.credit = q.weight
+                self.position = idx + 1
+            else:
+                self.position = idx
+            q.in_flight += 1
+            return (q, (q.urgent if len(q.urgent) > 0 else q.normal).popleft())
+        return None
+
+    def __worker(self):
+        while True:
+            with self.cond:
+                picked = self.__pick()
+                while picked is None:
+                    self.cond.wait()
+                    picked = self.__pick()
+            (queue, (future, fn, args)) = picked
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as ex:
+                        future.set_exception(ex)
+            finally:
+                with self.cond:
+                    queue.in_flight -= 1
+                    self.cond.notify_all()
+
+class HotCache:
+    ''' in-memory LRU of decompressed pages in front of the disk store of a SimpleCache,
+    holding at most max_bytes of pages. a page is kept from its second read from disk
+    among the last max_seen pages read, so that the single pass of a large build does
+    not push out the pages every request reads (TOC pages, API responses, the first
+    chapters of a popular novel). SimpleCache checks the entry of a page against the
+    same freshness rules as the disk store before it uses it. '''
+    def __init__(self, max_bytes, max_seen=10000):
+        self.max_bytes = max_bytes
+        self.max_seen = max_seen
+        self.lock = threading.Lock()
+        # url -> (CacheEntry, page)
+        self.pages = collections.OrderedDict()
+        # urls read from disk once
+        self.seen = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __remove(self, url):
+        item = self.pages.pop(url, None)
+        if item is not None: self.bytes -= len(item[1])
+        return item
+
+    def get(self, url, usable):
+        ''' return (entry, page) of url if usable(entry) holds, or None. an unusable page is dropped '''
+        with self.lock:
+            item = self.pages.get(url)
+            if item is not None and not usable(item[0]):
+                self.__remove(url)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.pages.move_to_end(url)
+            self.hits += 1
+            return item
+
+    def admit(self, url, entry, binary):
+        ''' tell that the page of url was read from disk '''
+        if len(binary) > self.max_bytes: return
+        with self.lock:
+            if url not in self.seen and url not in self.pages:
+                self.seen[url] = None
+                if len(self.seen) > self.max_seen: self.seen.popitem(last=False)
+                return
+            self.seen.pop(url, None)
+            self.__remove(url)
+            self.pages[url] = (entry, binary)
+            self.bytes += len(binary)
+            while self.bytes > self.max_bytes:
+                (_, (_, old)) = self.pages.popitem(last=False)
+                self.bytes -= len(old)
+                self.evictions += 1
+
+    def discard(self, url):
+        ''' drop the page of url (e.g. it was downloaded again). a dropped page is kept
+        again from its next read '''
+        with self.lock:
+            if self.__remove(url) is not None: self.seen[url] = None
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'pages': len(self.pages), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups > 0 else 0.0, 'evictions': self.evictions}
+
+class CachedPages(collections.abc.Sequence):
+    ''' the result list of SimpleCache.fetch_all. a page found in the cache is kept as its
+    CacheEntry and decompressed when it is first read. the decompression runs on the pool of
+    the cache in chunks of chunk_size pages, readahead chunks ahead of the reader.
+    may be read from several threads '''
+    def __init__(self, cache, url_list, items, chunk_size=16, readahead=4):
+        self.cache = cache
+        self.url_list = url_list
+        self.items = items
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __submit(self, start):
+        ''' decompress the pending cached pages of [start, start + chunk_size) as one task.
+        called with lock held '''
+        indexes = [j for j in range(start, min(len(self.items), start + self.chunk_size))
+                   if isinstance(self.items[j], CacheEntry) and j not in self.futures]
+        if len(indexes) == 0: return
+        entries = [(self.url_list[j], self.items[j]) for j in indexes]
+        future = self.cache.decompress_executor.submit(lambda: [self.cache.read_page(e, url) for (url, e) in entries])
+        for (k, j) in enumerate(indexes):
+            self.futures[j] = (future, k)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice): return [self[j] for j in range(*i.indices(len(self.items)))]
+        i = range(len(self.items))[i]
+        with self.lock:
+            item = self.items[i]
+            if not isinstance(item, CacheEntry): return item
+            for n in range(self.readahead + 1):
+                self.__submit(i + n * self.chunk_size)
+            (future, k) = self.futures[i]
+        binary = future.result()[k]
+        if binary is None:
+            # the blob was removed after the lookup
+            binary = self.cache.fetch(self.url_list[i])
+        with self.lock:
+            self.items[i] = binary
+            self.futures.pop(i, None)
+        return binary
+
+class DeflateCache:
+    ''' raw deflate streams of epub entries for EPUBPackage.save(), keyed by
+    the hash of the uncompressed entry. kept in the blob store as "deflate:<key>"
+    entries, whose time is renewed at most once per touch_interval when they are
+    used. remove the ones unused for a while with "cache_tool.py purge --deflate" '''
+    touch_interval = datetime.timedelta(days=1)
+
+    def __init__(self, index, blobs):
+        self.index = index
+        self.blobs = blobs
+
+    def get(self, key):
+        entry = self.index.get('deflate:' + key)
+        if entry is None: return None
+        buf = self.blobs.map(entry.hash)
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        if buf is not None and entry.accessed + DeflateCache.touch_interval < now:
+            self.index.put('deflate:' + key, entry._replace(accessed=now))
+        return buf
+
+    def put(self, key, compressed):
+        hash_value = self.blobs.put(hashlib.sha512(compressed).hexdigest()[0:64], compressed)
+        self.index.put('deflate:' + key, CacheEntry(datetime.datetime.utcnow().replace(microsecond=0),
+                                                    hash_value, None, 'raw-deflate'))
+
 class SimpleCache:
     def __init__(self, cache_dir = 'data',
-                 expiration_time = datetime.timedelta(hours=6), max_parallel_fetches=8):
+                 expiration_time = datetime.timedelta(hours=6), max_parallel_fetches=8,
+                 max_fetches_per_conversion=None, small_batch_size=16,
+                 retry_delays=(5, 20, 60), allow_partial=False,
+                 stale_while_revalidate=None, stale_if_error=None, cache_only=False, admission=None,
+                 egress=None, hot_bytes=32 * 1024 * 1024):
+        ''' retry_delays: backoff in seconds before each retry of a failed url in fetch_all
+        allow_partial: fetch_all returns None for urls that failed all retries instead of
+                       raising FetchIncomplete
+        stale_while_revalidate: a page expired by age less than this long ago is returned
+                                at once and downloaded again in the background
+        stale_if_error: a page expired less than this long ago is returned when its
+                        download fails (except 404/410)
+        cache_only: never download. any cached page is returned regardless of its age,
+                    and a missing page fails with 504
+        admission: an admission.AdmissionController charged by fetch_all for the pages
+                   of the build running in the calling thread
+        egress: a fetch_worker.EgressPool downloading the pages through fetch workers
+                instead of from this host
+        hot_bytes: size of the in-memory tier of often read pages (a HotCache). 0 disables it '''
         self.expiration_time = expiration_time
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel_fetches)
+        self.retry_delays = retry_delays
+        self.allow_partial = allow_partial
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.cache_only = cache_only
+        self.admission = admission
+        self.egress = egress
+        self.hot = HotCache(hot_bytes) if hot_bytes > 0 else None
+        if max_fetches_per_conversion is None:
+            max_fetches_per_conversion = max(1, max_parallel_fetches * 3 // 4)
+        self.scheduler = FetchScheduler(max_workers=max_parallel_fetches,
+                                        max_in_flight=max_fetches_per_conversion)
+        self.small_batch_size = small_batch_size
+        self.revalidate_queue = self.scheduler.open_queue(max_in_flight=max(1, max_parallel_fetches // 4),
+                                                          priority=True)
+        self.revalidating = set()
+        self.revalidating_lock = threading.Lock()
+        self.decompress_workers = os.cpu_count() or 4
+        self.decompress_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.decompress_workers)
 
-        """ GNU dbm key-value spec.
-        url_db:  key=url, value=(accessed, hash)
-        data_db: key=hash, value=(url, modified, data) """
-        self.url_db = shelve.open(os.path.join(cache_dir, 'urldb'), flag='c')
-        self.data_db = shelve.open(os.path.join(cache_dir, 'datadb'), flag='c')
+        """ index: key=url, value=CacheEntry(accessed, hash, modified, encoding)
+        blobs: <hash> -> zlib compressed page (encoding='zlib') or raw file (encoding='identity')
+        identical contents share one blob. """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = CacheIndex(os.path.join(cache_dir, 'index.db'))
+        self.blobs = BlobStore(os.path.join(cache_dir, 'blobs'))
+        self.deflate_cache = DeflateCache(self.index, self.blobs)
 
-    def __lookup_cache(self, url, use_cache_newer_than=None):
+    def __is_fresh(self, entry, use_cache_newer_than):
+        return entry[0] >= use_cache_newer_than or entry[0] + self.expiration_time >= datetime.datetime.utcnow()
+
+    def read_page(self, entry, url=None):
+        ''' return the decompressed page of entry, or None if its blob is missing.
+        with url, the page may be kept in the hot tier '''
+        buf = self.blobs.map(entry.hash)
+        if buf is None: return None
+        with buf:
+            binary = zlib.decompress(buf)
+        if url is not None and self.hot is not None: self.hot.admit(url, entry, binary)
+        return binary
+
+    def __lookup_hot(self, url, use_cache_newer_than):
+        ''' return the page of url from the hot tier, or None '''
+        if self.hot is None: return None
+        item = self.hot.get(url, lambda entry: self.__usable(entry, use_cache_newer_than)[0])
+        if item is None: return None
+        if self.__usable(item[0], use_cache_newer_than)[1]: self.__revalidate_later(url, item[0])
+        return item[1]
+
+    def __is_within(self, entry, window):
+        ''' True if entry expired less than window ago '''
+        return window is not None and \
+            entry.accessed + self.expiration_time + window >= datetime.datetime.utcnow()
+
+    def __usable(self, entry, use_cache_newer_than):
+        ''' return (usable, stale). usable is True if the page of entry can be returned
+        without downloading it, stale if it should then be revalidated '''
         if use_cache_newer_than is None or not isinstance(use_cache_newer_than, datetime.datetime):
             use_cache_newer_than = datetime.datetime.max
-        entry = self.url_db.get(url)
-        if entry is not None:
-            if entry[0] >= use_cache_newer_than or entry[0] + self.expiration_time >= datetime.datetime.utcnow():
-                data_entry = self.data_db.get(entry[1])
-                return (entry, zlib.decompress(data_entry[2]))
-        return (entry, None)
-
-    def __download(self, url):
+        if entry is None or entry.encoding != 'zlib': return (False, False)
+        fresh = self.cache_only or self.__is_fresh(entry, use_cache_newer_than)
+        # a page only known to be old (not known to be modified) may be served stale
+        stale = not fresh and use_cache_newer_than == datetime.datetime.max and \
+            self.__is_within(entry, self.stale_while_revalidate)
+        return (fresh or stale, stale)
+
+    def __check_hit(self, url, entry, use_cache_newer_than):
+        ''' return (entry, hit). hit is True if the page of entry can be returned for url,
+        and then a stale page is revalidated in the background. entry is None when the
+        blob of the page is missing '''
+        (usable, stale) = self.__usable(entry, use_cache_newer_than)
+        if not usable: return (entry, False)
+        if not self.blobs.exists(entry.hash): return (None, False)
+        if stale: self.__revalidate_later(url, entry)
+        return (entry, True)
+
+    def __lookup_cache(self, url, use_cache_newer_than=None):
+        binary = self.__lookup_hot(url, use_cache_newer_than)
+        if binary is not None: return (None, binary)
+        (entry, hit) = self.__check_hit(url, self.index.get(url), use_cache_newer_than)
+        if not hit: return (entry, None)
+        binary = self.read_page(entry, url)
+        return (entry, binary) if binary is not None else (None, None)
+
+    def __revalidate_later(self, url, cache_entry):
+        with self.revalidating_lock:
+            if url in self.revalidating: return
+            self.revalidating.add(url)
+        self.revalidate_queue.submit(self.__revalidate, url, cache_entry)
+
+    def __revalidate(self, url, cache_entry):
+        try:
+            # a failed revalidation is tried again by the next request of the page
+            (binary, compressed_binary, hash_value, dt_accessed, dt_modified) = self.__download(url, 1)
+            self.__update_cache(url, cache_entry, compressed_binary, hash_value, dt_accessed, dt_modified)
+        except Exception as ex:
+            sys.stderr.write('revalidation failed (%s). url=%s\n' % (ex, url))
+        finally:
+            with self.revalidating_lock:
+                self.revalidating.discard(url)
+
+    def __stale_if_error(self, url, cache_entry, code):
+        ''' return the expired page of cache_entry to use instead of a failed download, or None '''
+        if cache_entry is None or cache_entry.encoding != 'zlib' or code in (404, 410): return None
+        if not self.__is_within(cache_entry, self.stale_if_error): return None
+        binary = self.read_page(cache_entry)
+        if binary is not None:
+            sys.stderr.write('fetch failed (%d). use the cached page of %s. url=%s\n' %
+                             (code, cache_entry.accessed.isoformat(), url))
+        return binary
+
+    def __download(self, url, max_retry_count=3):
+        ''' max_retry_count: attempts of url_readall. the downloads of fetch_all make one, as
+        __wait_downloads retries them with its own backoff '''
         dt_modified = None
         dt_accessed = datetime.datetime.utcnow().replace(microsecond=0)
-        (binary, res) = url_readall(url)
+        (binary, res) = self.egress.readall(url) if self.egress is not None \
+            else url_readall(url, max_retry_count=max_retry_count)
         compressed_binary = zlib.compress(binary)
         dt_modified = res.info().get('Last-Modified', None)
         if dt_modified is not None:
             try:
                 dt_modified = datetime.datetime.strptime(dt_modified, '%a, %d %b %Y %H:%M:%S GMT')
-            except:
-                pass
+            except ValueError:
+                dt_modified = None
         hash_value = hashlib.sha512(binary).hexdigest()[0:64]
         return (binary, compressed_binary, hash_value, dt_accessed, dt_modified)
 
     def __update_cache(self, url, cache_entry, compressed_binary, hash_value, dt_accessed, dt_modified):
-        if cache_entry is None or hash_value != cache_entry[1]:
-            self.data_db[hash_value] = (url, dt_modified, compressed_binary)
-        self.url_db[url] = (dt_accessed, hash_value)
+        self.blobs.put(hash_value, compressed_binary)
+        self.index.put(url, CacheEntry(dt_accessed, hash_value, dt_modified, 'zlib'))
+        if self.hot is not None: self.hot.discard(url)
 
     def fetch(self, url, use_cache_newer_than=None):
         (cache_entry, binary) = self.__lookup_cache(url, use_cache_newer_than)
         if binary is not None: return binary
-        (binary, compressed_binary, hash_value, dt_accessed, dt_modified) = self.__download(url)
+        if self.cache_only: raise HTTPError(url, 504, 'not cached', None, None)
+        try:
+            (binary, compressed_binary, hash_value, dt_accessed, dt_modified) = self.__download(url)
+        except Exception as ex:
+            binary = self.__stale_if_error(url, cache_entry, ex.code if isinstance(ex, HTTPError) else 500)
+            if binary is None: raise
+            return binary
         self.__update_cache(url, cache_entry, compressed_binary, hash_value, dt_accessed, dt_modified)
         return binary
 
     def fetch_all(self, url_list, use_cache_newer_than_map=None):
-        futures = {}
-        results = {}
+        ''' return the pages of url_list as a CachedPages list, in which the pages found in
+        the cache are decompressed as they are read '''
+        url_list = list(url_list)
+        def newer_than(url):
+            return use_cache_newer_than_map.get(url) if use_cache_newer_than_map is not None else None
+        # pages in the hot tier are not looked up on disk
+        hot = {}
         for url in url_list:
-            dt = use_cache_newer_than_map.get(url) if use_cache_newer_than_map is not None else None
-            (cache_entry, binary) = self.__lookup_cache(url, dt)
-            if binary is None:
-                futures[self.executor.submit(self.__download, url)] = (url, cache_entry)
+            binary = self.__lookup_hot(url, newer_than(url))
+            if binary is not None: hot[url] = binary
+        entries = self.index.get_many(set(url_list) - set(hot))
+        hits = {}
+        missing = []
+        for url in url_list:
+            if url in hot: continue
+            (cache_entry, hit) = self.__check_hit(url, entries.get(url), newer_than(url))
+            if hit:
+                hits[url] = cache_entry
             else:
+                missing.append((url, cache_entry))
+        fetched = self.admission.charge(len(url_list), 0 if self.cache_only else len(missing)) \
+            if self.admission is not None else None
+        try:
+            results = self.__fetch_missing(missing)
+        finally:
+            if fetched is not None: fetched()
+        results.update(hot)
+        return CachedPages(self, url_list, [results[url] if url in results else hits.get(url) for url in url_list],
+                           readahead=self.decompress_workers)
+
+    def cached_sizes(self, url_list, use_cache_newer_than_map=None):
+        ''' return the compressed size of the page of each url that fetch_all would return
+        from the cache, or None for the urls it would download. nothing is downloaded
+        or revalidated '''
+        entries = self.index.get_many(set(url_list))
+        sizes = []
+        for url in url_list:
+            dt = use_cache_newer_than_map.get(url) if use_cache_newer_than_map is not None else None
+            entry = entries.get(url)
+            size = None
+            if self.__usable(entry, dt)[0]:
+                try:
+                    size = os.path.getsize(self.blobs.path(entry.hash))
+                except OSError:
+                    pass
+            sizes.append(size)
+        return sizes
+
+    def __fetch_missing(self, missing):
+        ''' download the (url, cache entry) of missing. return {url: page} '''
+        results = {}
+        futures = {}
+        if len(missing) == 0:
+            return results
+        if self.cache_only:
+            self.__raise_failed(dict((url, 504) for (url, _) in missing))
+            return results
+
+        # small jobs (short stories, a few new chapters) jump ahead of large builds.
+        # the expired pages of a large build wait their turn like its new pages
+        queue = self.scheduler.open_queue(priority=len(missing) <= self.small_batch_size)
+        try:
+            for (url, cache_entry) in missing:
+                futures[queue.submit(self.__download, url, 1)] = (url, cache_entry)
+            failed = self.__wait_downloads(queue, futures, results)
+        finally:
+            queue.close()
+        cache_entries = dict(missing)
+        for (url, code) in list(failed.items()):
+            binary = self.__stale_if_error(url, cache_entries[url], code)
+            if binary is not None:
                 results[url] = binary
-        for future in concurrent.futures.as_completed(futures):
-            (url, cache_entry) = futures[future]
-            if future.exception() is not None:
-                for tmp in futures:
-                    try:
-                        tmp.cancel()
-                    except:
-                        pass
-                print("error url =", url, ". cancelled all download task")
-                raise future.exception()
-            (binary, compressed_binary, hash_value, dt_accessed, dt_modified) = future.result()
-            self.__update_cache(url, cache_entry, compressed_binary, hash_value, dt_accessed, dt_modified)
-            results[url] = binary
-        return [results[url] for url in url_list]
+                del failed[url]
+        self.__raise_failed(failed)
+        return results
+
+    def __raise_failed(self, failed):
+        ''' raise FetchIncomplete for the {url: http status} of failed unless allow_partial '''
+        if len(failed) > 0:
+            sys.stderr.write('%d urls failed. first url=%s\n' % (len(failed), min(failed)))
+            if not self.allow_partial:
+                code = 503 if 503 in failed.values() else 504 if 504 in failed.values() else 500
+                raise FetchIncomplete(sorted(failed), code)
+
+    def __wait_downloads(self, queue, futures, results):
+        ''' wait for the downloads. a failed url goes to a deferred queue and is submitted
+        again after a backoff while the other downloads continue. each page is stored
+        in the cache as soon as it arrives. return {url: http status} of the urls
+        that failed all retries '''
+        deferred = []
+        attempts = {}
+        failed = {}
+        while len(futures) > 0 or len(deferred) > 0:
+            now = time.monotonic()
+            for item in [item for item in deferred if item[0] <= now]:
+                deferred.remove(item)
+                futures[queue.submit(self.__download, item[1], 1)] = (item[1], item[2])
+            timeout = max(0, min(item[0] for item in deferred) - now) if len(deferred) > 0 else None
+            if len(futures) == 0:
+                time.sleep(timeout)
+                continue
+            (done, _) = concurrent.futures.wait(futures, timeout=timeout,
+                                                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (url, cache_entry) = futures.pop(future)
+                ex = future.exception()
+                if ex is None:
+                    (binary, compressed_binary, hash_value, dt_accessed, dt_modified) = future.result()
+                    self.__update_cache(url, cache_entry, compressed_binary, hash_value, dt_accessed, dt_modified)
+                    results[url] = binary
+                    continue
+                code = ex.code if isinstance(ex, HTTPError) else 500
+                attempt = attempts.get(url, 0)
+                if attempt < len(self.retry_delays) and code not in (404, 410):
+                    attempts[url] = attempt + 1
+                    sys.stderr.write('fetch failed (%d). retry in %gs. url=%s\n' % (code, self.retry_delays[attempt], url))
+                    deferred.append((time.monotonic() + self.retry_delays[attempt], url, cache_entry))
+                else:
+                    failed[url] = code
+        return failed
+
+    def store_file(self, key, fileobj):
+        ''' copy fileobj (e.g. a built epub) to the blob store and register it as key.
+        return the hash of the stored file '''
+        hash_value = self.blobs.put_stream(fileobj)
+        self.index.put(key, CacheEntry(datetime.datetime.utcnow().replace(microsecond=0),
+                                       hash_value, None, 'identity'))
+        return hash_value
+
+    def lookup_file(self, key, use_cache_newer_than=None):
+        ''' return (entry, path) of the file registered as key, or None if missing or expired '''
+        if use_cache_newer_than is None:
+            use_cache_newer_than = datetime.datetime.max
+        entry = self.index.get(key)
+        if entry is None or entry.encoding != 'identity': return None
+        if not self.__is_fresh(entry, use_cache_newer_than): return None
+        path = self.blobs.path(entry.hash)
+        if not os.path.isfile(path): return None
+        return (entry, path)
 
 class DummyCache:
     def __init__(self, max_parallel_fetches=8):
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+''' inspect, verify, export and import SimpleCache stores.
+
+  $ python3 cache_tool.py stats data
+  $ python3 cache_tool.py verify data [--purge]
+  $ python3 cache_tool.py export data cache.tar [--host ncode.syosetu.com] [--ncode n0000a] [--max-age 24]
+  $ python3 cache_tool.py import data cache.tar [--batch 1000]
+  $ python3 cache_tool.py purge data --max-age 720 [--deflate] [--host ncode.syosetu.com] [--ncode n0000a]
+
+an archive is an uncompressed tar (the blobs are already compressed) holding
+index.jsonl followed by blobs/<hash>. import rejects a blob whose contents do not match
+its hash, and the entries referring to it. '''
+
+import argparse, datetime, hashlib, io, json, os.path, re, sys, tarfile, zlib
+from urllib.parse import urlparse
+from cache import BlobStore, CacheEntry, CacheIndex
+
+AGE_BUCKETS = ((datetime.timedelta(hours=1), '< 1h'), (datetime.timedelta(hours=6), '< 6h'),
+               (datetime.timedelta(days=1), '< 1d'), (datetime.timedelta(days=7), '< 7d'),
+               (datetime.timedelta(days=30), '< 30d'), (datetime.timedelta.max, '>= 30d'))
+
+def open_store(cache_dir):
+    if not os.path.isfile(os.path.join(cache_dir, 'index.db')):
+        raise SystemExit('not a cache directory: ' + cache_dir)
+    return (CacheIndex(os.path.join(cache_dir, 'index.db')), BlobStore(os.path.join(cache_dir, 'blobs')))
+
+def key_host(key):
+    ''' hostname of a url key, or the prefix of a non-url key (e.g. "epub") '''
+    host = urlparse(key).hostname
+    if host is not None: return host
+    return '(' + key.split(':', 1)[0] + ')'
+
+def key_matches(key, entry, args, now):
+    if args.host is not None and key_host(key) != args.host: return False
+    if args.ncode is not None and args.ncode.lower() not in re.split('[/=:&?]', key.lower()): return False
+    if args.max_age is not None and entry.accessed + datetime.timedelta(hours=args.max_age) < now: return False
+    return True
+
+def blob_size(blobs, hash_value):
+    try:
+        return os.path.getsize(blobs.path(hash_value))
+    except OSError:
+        return None
+
+def stream_hash(fileobj, encoding, chunk_size=1024 * 64):
+    ''' the hash the cache gives to a blob of encoding: that of its decompressed contents
+    for zlib, of the stored bytes otherwise '''
+    h = hashlib.sha512()
+    d = zlib.decompressobj() if encoding == 'zlib' else None
+    while True:
+        buf = fileobj.read(chunk_size)
+        if not buf: break
+        h.update(d.decompress(buf) if d is not None else buf)
+    if d is not None: h.update(d.flush())
+    return h.hexdigest()[0:64]
+
+def cmd_stats(args):
+    (index, blobs) = open_store(args.cache_dir)
+    now = datetime.datetime.utcnow()
+    items = index.items()
+    hashes = {}
+    ages = dict((label, 0) for (_, label) in AGE_BUCKETS)
+    hosts = {}
+    for (key, entry) in items:
+        hashes[entry.hash] = entry.encoding
+        for (limit, label) in AGE_BUCKETS:
+            if now - entry.accessed < limit:
+                ages[label] += 1
+                break
+        hosts[key_host(key)] = hosts.get(key_host(key), 0) + 1
+    sizes = [blob_size(blobs, h) for h in hashes]
+    print('entries: %d' % len(items))
+    print('blobs:   %d (%d missing)' % (len(hashes), sizes.count(None)))
+    print('bytes:   %d' % sum(size for size in sizes if size is not None))
+    print('age (last fetched):')
+    for (_, label) in AGE_BUCKETS:
+        print('  %-7s %d' % (label, ages[label]))
+    print('hosts:')
+    for (host, count) in sorted(hosts.items(), key=lambda x: -x[1]):
+        print('  %-30s %d' % (host, count))
+
+def cmd_verify(args):
+    (index, blobs) = open_store(args.cache_dir)
+    items = index.items()
+    bad = set()
+    encodings = dict((entry.hash, entry.encoding) for (_, entry) in items)
+    for (hash_value, encoding) in sorted(encodings.items()):
+        buf = blobs.map(hash_value)
+        if buf is None:
+            print('missing ' + hash_value)
+            bad.add(hash_value)
+            continue
+        with buf:
+            try:
+                data = zlib.decompress(buf) if encoding == 'zlib' else buf
+                ok = hashlib.sha512(data).hexdigest()[0:64] == hash_value
+            except zlib.error:
+                ok = False
+        if not ok:
+            print('corrupt ' + hash_value)
+            bad.add(hash_value)
+    print('%d blobs checked, %d bad' % (len(encodings), len(bad)))
+    if args.purge and len(bad) > 0:
+        for (key, entry) in items:
+            if entry.hash in bad: index.delete(key)
+        for hash_value in bad: blobs.remove(hash_value)
+        print('purged %d blobs and their entries' % len(bad))
+    return 1 if len(bad) > 0 and not args.purge else 0
+
+def cmd_purge(args):
+    ''' remove the entries not fetched (or, for the deflated entries of built epubs,
+    not used) within max_age hours, and the blobs no other entry refers to '''
+    (index, blobs) = open_store(args.cache_dir)
+    now = datetime.datetime.utcnow()
+    filters = argparse.Namespace(host=args.host, ncode=args.ncode, max_age=None)
+    items = index.items()
+    removed = [(key, entry) for (key, entry) in items
+               if key_matches(key, entry, filters, now) and (not args.deflate or key.startswith('deflate:'))
+               and entry.accessed + datetime.timedelta(hours=args.max_age) < now]
+    for (key, _) in removed: index.delete(key)
+    removed_keys = set(key for (key, _) in removed)
+    referenced = set(entry.hash for (key, entry) in items if key not in removed_keys)
+    # a blob put again by a running gateway after this is only a cache miss
+    hashes = set(entry.hash for (_, entry) in removed) - referenced
+    size = 0
+    for hash_value in hashes:
+        size += blob_size(blobs, hash_value) or 0
+        blobs.remove(hash_value)
+    print('purged %d entries and %d blobs (%d bytes)' % (len(removed), len(hashes), size))
+
+def cmd_export(args):
+    (index, blobs) = open_store(args.cache_dir)
+    now = datetime.datetime.utcnow()
+    items = [(key, entry) for (key, entry) in index.items()
+             if key_matches(key, entry, args, now) and blobs.exists(entry.hash)]
+    lines = []
+    for (key, entry) in items:
+        lines.append(json.dumps({'key': key, 'accessed': entry.accessed.isoformat(), 'hash': entry.hash,
+                                 'modified': entry.modified.isoformat() if entry.modified is not None else None,
+                                 'encoding': entry.encoding}, ensure_ascii=False))
+    index_data = ('\n'.join(lines) + '\n').encode('UTF-8')
+    with tarfile.open(args.archive, 'w') as tar:
+        info = tarfile.TarInfo('index.jsonl')
+        info.size = len(index_data)
+        info.mtime = now.timestamp()
+        tar.addfile(info, io.BytesIO(index_data))
+        for hash_value in sorted(set(entry.hash for (_, entry) in items)):
+            tar.add(blobs.path(hash_value), arcname='blobs/' + hash_value)
+    print('exported %d entries' % len(items))
+
+hash_regex = re.compile(r'^[0-9a-f]{64}$')
+
+def cmd_import(args):
+    os.makedirs(args.cache_dir, exist_ok=True)
+    index = CacheIndex(os.path.join(args.cache_dir, 'index.db'))
+    blobs = BlobStore(os.path.join(args.cache_dir, 'blobs'))
+    def to_datetime(s):
+        return datetime.datetime.fromisoformat(s) if s is not None else None
+    count = 0
+    with tarfile.open(args.archive, 'r') as tar:
+        entries = []
+        encodings = {}
+        rejected = set()
+        for member in tar:
+            if member.name == 'index.jsonl':
+                for line in tar.extractfile(member):
+                    if len(line.strip()) == 0: continue
+                    m = json.loads(line.decode('UTF-8'))
+                    entries.append((m['key'], CacheEntry(to_datetime(m['accessed']), m['hash'],
+                                                         to_datetime(m['modified']), m['encoding'])))
+                    encodings.setdefault(m['hash'], set()).add(m['encoding'])
+            elif member.isfile() and member.name.startswith('blobs/'):
+                # blobs are shared by hash, so a blob must match its name before it is stored.
+                # index.jsonl comes first in an archive and tells how each blob is hashed
+                hash_value = os.path.basename(member.name)
+                if hash_regex.match(hash_value) is None:
+                    print('rejected %s (not a hash)' % member.name)
+                    continue
+                if hash_value not in encodings:
+                    print('skipped %s (not a blob of the index)' % member.name)
+                    continue
+                f = tar.extractfile(member)
+                ok = True
+                for encoding in encodings[hash_value]:
+                    f.seek(0)
+                    try:
+                        ok = ok and stream_hash(f, encoding) == hash_value
+                    except zlib.error:
+                        ok = False
+                if not ok:
+                    print('rejected %s (its contents do not match its name)' % member.name)
+                    rejected.add(hash_value)
+                    continue
+                f.seek(0)
+                blobs.put_stream(f, hash_value=hash_value)
+        # the blobs are in place before their entries become visible
+        entries = [(key, entry) for (key, entry) in entries
+                   if entry.hash not in rejected and hash_regex.match(entry.hash) is not None]
+        for i in range(0, len(entries), args.batch):
+            index.put_many(entries[i:i + args.batch], keep_newer=True)
+            count += len(entries[i:i + args.batch])
+    print('imported %d entries' % count)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='inspect and move SimpleCache stores')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('stats', help='show entry counts, sizes, ages and hosts')
+    p.add_argument('cache_dir')
+    p.set_defaults(func=cmd_stats)
+    p = sub.add_parser('verify', help='check that every blob matches its hash')
+    p.add_argument('cache_dir')
+    p.add_argument('--purge', action='store_true', help='remove bad blobs and their entries')
+    p.set_defaults(func=cmd_verify)
+    p = sub.add_parser('export', help='write a filtered subset to an archive')
+    p.add_argument('cache_dir')
+    p.add_argument('archive')
+    p.add_argument('--host', help='only entries of this hostname')
+    p.add_argument('--ncode', help='only entries of this content code')
+    p.add_argument('--max-age', type=float, help='only entries fetched within this many hours')
+    p.set_defaults(func=cmd_export)
+    p = sub.add_parser('import', help='merge an archive into a cache directory')
+    p.add_argument('cache_dir')
+    p.add_argument('archive')
+    p.add_argument('--batch', type=int, default=1000, help='index entries per transaction')
+    p.set_defaults(func=cmd_import)
+    p = sub.add_parser('purge', help='remove old entries and the blobs only they refer to')
+    p.add_argument('cache_dir')
+    p.add_argument('--max-age', type=float, required=True, help='remove entries older than this many hours')
+    p.add_argument('--deflate', action='store_true', help='only the deflated entries of built epubs')
+    p.add_argument('--host', help='only entries of this hostname')
+    p.add_argument('--ncode', help='only entries of this content code')
+    p.set_defaults(func=cmd_purge)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        quit()
+    sys.exit(args.func(args) or 0)
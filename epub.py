@@ -1,11 +1,94 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from io import RawIOBase, IOBase
-from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+from io import IOBase
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
 import xml.etree.ElementTree as ET
 import xml.sax.saxutils as SAX
-import datetime, os.path
+import datetime, hashlib, os, os.path, struct, time, uuid, zlib
+
+def iter_chunks(source, chunk_size=1024 * 64):
+    ''' yield the contents of a manifest item as byte chunks.
+    source is bytes, str, a path-like object (read from the file), a file object,
+    a callable returning one of them, or an iterable (e.g. generator) of chunks '''
+    if callable(source): source = source()
+    if isinstance(source, str):
+        yield source.encode('UTF-8')
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        yield source
+    elif isinstance(source, os.PathLike):
+        with open(source, 'rb') as f:
+            yield from iter_chunks(f, chunk_size)
+    elif isinstance(source, IOBase):
+        while True:
+            buf = source.read(chunk_size)
+            if not buf: break
+            yield buf.encode('UTF-8') if isinstance(buf, str) else buf
+    else:
+        for chunk in source:
+            yield chunk.encode('UTF-8') if isinstance(chunk, str) else chunk
+
+def raw_deflate(data, level=zlib.Z_DEFAULT_COMPRESSION):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush()
+
+# the private attributes of ZipFile used to copy compressed entries as they are
+raw_zip_attributes = ('fp', '_lock', '_seekable', '_writecheck', '_didModify', 'start_dir',
+                      'filelist', 'NameToInfo')
+
+def can_copy_raw(zf):
+    return all(hasattr(zf, name) for name in raw_zip_attributes)
+
+def write_raw_entry(zf, zinfo, compressed, crc, file_size):
+    ''' append an entry whose data is already compressed with zinfo.compress_type
+    to zf without recompressing it. this follows what ZipFile.open(..., 'w') does
+    when it starts and closes an entry, using private attributes of ZipFile (checked
+    with CPython 3.6 to 3.12). when a version of zipfile lacks them, the data is
+    decompressed and written with writestr() instead '''
+    if not can_copy_raw(zf):
+        data = zlib.decompress(compressed, -15) if zinfo.compress_type == ZIP_DEFLATED else bytes(compressed)
+        zf.writestr(zinfo, data)
+        return
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(compressed)
+    zip64 = file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+    with zf._lock:
+        if zf._seekable: zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader(zip64))
+        zf.fp.write(compressed)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+
+class RawEntry:
+    ''' an entry of another zip archive (e.g. an earlier build) as a manifest item source.
+    save() copies its compressed bytes as they are when the compression matches (and
+    zipfile has the attributes write_raw_entry needs), and otherwise reads it like a
+    callable source '''
+    def __init__(self, zf, name):
+        self.zf = zf
+        self.zinfo = zf.getinfo(name)
+
+    def __call__(self):
+        return self.zf.read(self.zinfo)
+
+    def compressed(self):
+        with self.zf._lock:
+            fp = self.zf.fp
+            fp.seek(self.zinfo.header_offset)
+            header = fp.read(30)
+            (name_length, extra_length) = struct.unpack('<HH', header[26:30])
+            fp.seek(self.zinfo.header_offset + 30 + name_length + extra_length)
+            return fp.read(self.zinfo.compress_size)
+
+def source_uuid(*names):
+    ''' identifier derived from the names of a source (e.g. its url, or title and author),
+    so that every build of the same source gets the same one '''
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, '\n'.join(names)))
 
 class SimpleXMLWriter:
     def __init__(self):
@@ -53,7 +136,7 @@ class SimpleXMLWriter:
         xml = indent + '<' + node.tag
         for (key,value) in node.attrib.items():
             xml += ' ' + key + '=' + SAX.quoteattr(value)
-        children = node.getchildren()
+        children = list(node)
         if len(children) == 0 and (node.text is None or len(node.text) == 0):
             xml += ' />\n'
         else:
@@ -86,16 +169,35 @@ class SimpleXMLWriter:
             self.element('link', atts={'rel':'stylesheet', 'type':'text/css', 'href':href})
 
 class EPUBPackage:
-    def __init__(self):
+    def __init__(self, reproducible=False):
+        ''' reproducible: the same contents always give a byte-identical file.
+        the zip entries are dated by dcterms:modified instead of the time of save()
+        and build_date() returns the date of the source '''
+        self.reproducible = reproducible
         self.version = "3.0"
         self.lang = None
         self.metadata = EPUBMetadata()
         self.manifest = EPUBManifest(self, EPUBSpine())
         self.spine = self.manifest.spine
         self.files = []
+        # True when some contents are placeholders for pages that could not be fetched
+        self.incomplete = False
+
+    def add_file(self, path, source):
+        ''' source is read only in save(). see iter_chunks() for the accepted types '''
+        self.files.append((path, source))
 
-    def add_file(self, path, file_or_bytes):
-        self.files.append((path, file_or_bytes))
+    def build_date(self, source_date):
+        ''' the date of this build for dc:date. the date of the source when reproducible '''
+        return source_date if self.reproducible else datetime.datetime.utcnow()
+
+    def date_time(self):
+        ''' the (year, month, day, hour, min, sec) to date the zip entries with '''
+        if not self.reproducible: return time.localtime(time.time())[:6]
+        modified = self.metadata.get_meta_text('dcterms:modified')
+        if modified is None: return (1980, 1, 1, 0, 0, 0)
+        dt = datetime.datetime.strptime(modified, '%Y-%m-%dT%H:%M:%SZ')
+        return max((1980, 1, 1, 0, 0, 0), dt.timetuple()[:6])
 
     def __validate(self):
         self.metadata.validate()
@@ -119,27 +221,48 @@ class EPUBPackage:
         self.spine.write_xml(writer)
         return str(writer).encode("UTF-8")
 
-    def save(self, file, compression = ZIP_DEFLATED):
+    def __write_deflated(self, zf, zinfo, data, deflate_cache):
+        ''' splice the cached raw deflate stream of data, compressing it only on a cache miss '''
+        if isinstance(data, str): data = data.encode('UTF-8')
+        key = hashlib.sha256(data).hexdigest()
+        compressed = deflate_cache.get(key)
+        if compressed is None:
+            compressed = memoryview(raw_deflate(data))
+            deflate_cache.put(key, compressed)
+        with compressed:
+            write_raw_entry(zf, zinfo, compressed, zlib.crc32(data), len(data))
+
+    def save(self, file, compression = ZIP_DEFLATED, deflate_cache = None):
+        ''' deflate_cache: optional store of compressed entries with get(key) -> buffer or None
+        and put(key, compressed). in-memory entries found there are copied to the archive
+        without being compressed again, and so are RawEntry sources '''
         self.__validate()
         rootdir = "OPBES/"
         opf_path = rootdir + "content.opf"
+        date_time = self.date_time()
+        def create_zinfo(path, compress_type):
+            zinfo = ZipInfo(path, date_time=date_time)
+            zinfo.compress_type = compress_type
+            zinfo.external_attr = 0o600 << 16
+            return zinfo
         with ZipFile(file, "w", compression) as epub:
-            epub.writestr("mimetype", "application/epub+zip".encode("UTF-8"), compress_type=ZIP_STORED)
-            epub.writestr("META-INF/container.xml",
+            epub.writestr(create_zinfo("mimetype", ZIP_STORED), "application/epub+zip".encode("UTF-8"))
+            epub.writestr(create_zinfo("META-INF/container.xml", compression),
                           self.__create_container_xml(opf_path).encode("UTF-8"))
-            epub.writestr(opf_path, self.__create_opf())
-            for (path, file_or_bytes) in self.files:
-                data = file_or_bytes
-                if isinstance(file_or_bytes, RawIOBase):
-                    data = file_or_bytes.readall()
-                if isinstance(file_or_bytes, IOBase):
-                    buf = bytearray(1024 * 64)
-                    data = bytes()
-                    while True:
-                        read_size = file_or_bytes.readinto(buf)
-                        if read_size == 0: break
-                        data = data + buf[0:read_size]
-                epub.writestr(rootdir + path, data)
+            epub.writestr(create_zinfo(opf_path, compression), self.__create_opf())
+            for (path, source) in self.files:
+                zinfo = create_zinfo(rootdir + path, compression)
+                if isinstance(source, RawEntry) and source.zinfo.compress_type == compression and \
+                   can_copy_raw(source.zf) and can_copy_raw(epub):
+                    write_raw_entry(epub, zinfo, source.compressed(), source.zinfo.CRC, source.zinfo.file_size)
+                    continue
+                if deflate_cache is not None and compression == ZIP_DEFLATED and isinstance(source, (str, bytes)) \
+                   and can_copy_raw(epub):
+                    self.__write_deflated(epub, zinfo, source, deflate_cache)
+                    continue
+                with epub.open(zinfo, 'w') as f:
+                    for chunk in iter_chunks(source):
+                        f.write(chunk)
 
 class MetadataError(Exception):
     def __init__(self, msg):
@@ -288,12 +411,23 @@ class EPUBMetadata:
         return dcmes_info
     def add_meta(self, propname, content, scheme = None):
         self.meta.append({'property':propname, '__content__': content, 'scheme': scheme})
+    def add_collection(self, name, position = None, collection_type = 'series'):
+        id = 'collection' + str(len([m for m in self.meta if m['property'] == 'belongs-to-collection']) + 1)
+        self.meta.append({'property':'belongs-to-collection', 'id':id, '__content__':name, 'scheme':None})
+        self.meta.append({'refines':'#' + id, 'property':'collection-type', '__content__':collection_type, 'scheme':None})
+        if position is not None:
+            self.meta.append({'refines':'#' + id, 'property':'group-position', '__content__':str(int(position)), 'scheme':None})
     def add_link(self, rel, href, media_type = None):
         self.link.append({'rel':rel, 'href':href, 'media-type':media_type})
 
     def validate(self):
         pass
 
+    def get_meta_text(self, propname):
+        for m in self.meta:
+            if m['property'] == propname: return m['__content__']
+        return None
+
     def get_dcmes_text(self, name):
         for dcmes_info in self.dcmes:
             if dcmes_info.name == name and dcmes_info.content is not None:
@@ -346,7 +480,7 @@ class EPUBManifest:
             if id not in self.id_set:
                 return id
 
-    def add_item(self, href, file_or_bytes,
+    def add_item(self, href, source,
                  media_type = None, id = None, spine_pos = None,
                  add_to_spine=None, is_toc = False,
                  fallback=None, properties=None, media_overlay=None):
@@ -362,9 +496,6 @@ class EPUBManifest:
             if media_type in ('application/xhtml+xml'):
                 add_to_spine = True
 
-        if isinstance(file_or_bytes, str):
-            file_or_bytes = file_or_bytes.encode('UTF-8')
-
         if id is None: id = self.__create_id()
         if id in self.id_set: raise MetadataError("duplicate id")
         if is_toc and self.spine.toc is not None: raise MetadataError('already added TOC')
@@ -372,7 +503,7 @@ class EPUBManifest:
         if add_to_spine: self.spine.add_itemref(id, pos=spine_pos)
         if is_toc: self.spine.toc = id
         self.id_set.add(id)
-        self.package.add_file(href, file_or_bytes)
+        self.package.add_file(href, source)
         self.items.append({'id':id, 'href':href, 'media-type':media_type,
                            'fallback':fallback, 'properties':properties,
                            'media-overlay':media_overlay})
@@ -381,11 +512,11 @@ class EPUBManifest:
                             'scripted', 'svg', 'switch')
     def __check_properties(self, properties):
         props = properties.split()
-        ret = set()
+        ret = []
         for prop in props:
             if prop not in self.__defined_properties:
                 raise MetadataError('unknown property "' + prop + '"')
-            ret.add(prop)
+            if prop not in ret: ret.append(prop)
         return " ".join(ret)
     def validate(self):
         # fallback id check
@@ -402,6 +533,7 @@ class EPUBManifest:
         return -1
 
     def lookup_id(self, filename):
+        filename = filename.split('#', 1)[0]
         for item in self.items:
             if item['href'] == filename:
                 return item['id']
@@ -514,15 +646,28 @@ class EPUBCompatibleNav:
         self.navs = navs
         self.manifest = manifest
     def __output_navMap(self, nav, writer, autoid):
+        # navPoints share a playOrder when they point at the same target. an entry
+        # without a link (e.g. a chapter title) points at its first page
+        play_order = {}
+        def first_link(curnav):
+            if curnav.link is not None: return curnav.link
+            for child in curnav.children:
+                link = first_link(child)
+                if link is not None: return link
+            return None
         writer.start('navMap')
         def output_navPoint(curnav):
             autoid[0] += 1
+            link = first_link(curnav)
             writer.start('navPoint', atts={'id':'navpoint' + str(autoid[0])})
+            if link is not None:
+                if link not in play_order: play_order[link] = len(play_order) + 1
+                writer.att('playOrder', str(play_order[link]))
             writer.start('navLabel')
             writer.element('text', text=curnav.title)
             writer.end()
-            if curnav.link is not None:
-                writer.element('content', atts={'src':curnav.link})
+            if link is not None:
+                writer.element('content', atts={'src':link})
             for child in curnav.children:
                 output_navPoint(child)
             writer.end()
@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import lxml.etree
+
+class Rules:
+    ''' named XPath selectors declaring where a site keeps its contents.
+    each selector is compiled once and reused for every page, so following a markup
+    change of a site only needs new expressions. '''
+    def __init__(self, **selectors):
+        self.selectors = selectors
+        self.xpaths = dict((name, lxml.etree.XPath(expr)) for (name, expr) in selectors.items())
+
+    def all(self, name, node):
+        ''' return the list of matches of selector name under node '''
+        return self.xpaths[name](node)
+
+    def first(self, name, node):
+        ''' return the first match of selector name under node, or None '''
+        result = self.xpaths[name](node)
+        return result[0] if len(result) > 0 else None
+
+    def text(self, name, node):
+        ''' return the stripped text of the first match (an element or a string), or '' '''
+        result = self.first(name, node)
+        if result is None: return ''
+        if not isinstance(result, str): result = result.text
+        return result.strip() if result is not None else ''
+
+    def all_text(self, name, node):
+        ''' return all text under the first match, stripped, or '' '''
+        result = self.first(name, node)
+        return ''.join(result.itertext()).strip() if result is not None else ''
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+''' fetch workers: small http services downloading pages on behalf of the gateway, so that
+its requests to the novel sites leave from several addresses.
+
+  $ python3 fetch_worker.py serve [--host 127.0.0.1] [--port 8101] [--token T] [--source-address ADDR]
+
+the gateway spreads its downloads over the workers with an EgressPool given to
+SimpleCache(egress=...). the protocol:
+
+  GET /fetch?url=<url>  200 with the page. the Last-Modified of the site is passed through.
+                        502 with "X-Origin-Status: <http status>" when the site failed.
+  GET /health           200 "ok"
+
+a worker fetches only the pages of the sites in sites.py. it started with --token requires
+it in the X-Fetch-Worker-Token header of every request, and a worker on a non-loopback
+--host must be started with one. --source-address makes the requests to the sites leave from that address of
+the host (e.g. one of several addresses of an egress node, or 127.0.0.N on loopback). '''
+
+import argparse, functools, hmac, http.client, http.server, ipaddress, sys, threading, time, urllib.request
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlparse, parse_qs
+import sites
+from cache import url_readall
+
+class SourceAddressHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, source_address):
+        urllib.request.HTTPHandler.__init__(self)
+        self.source_address = source_address
+    def http_open(self, req):
+        return self.do_open(functools.partial(http.client.HTTPConnection,
+                                              source_address=(self.source_address, 0)), req)
+
+class SourceAddressHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, source_address):
+        urllib.request.HTTPSHandler.__init__(self)
+        self.source_address = source_address
+    def https_open(self, req):
+        return self.do_open(functools.partial(http.client.HTTPSConnection,
+                                              source_address=(self.source_address, 0)), req)
+
+class FetchWorkerHandler(http.server.BaseHTTPRequestHandler):
+    # set by serve()
+    token = None
+    opener = None
+
+    def __reply(self, status, body, headers=()):
+        self.send_response(status)
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.token is not None:
+            token = self.headers.get('X-Fetch-Worker-Token', '')
+            if not hmac.compare_digest(token.encode('UTF-8'), self.token.encode('UTF-8')):
+                return self.__reply(403, b'forbidden')
+        path = urlparse(self.path)
+        if path.path == '/health':
+            return self.__reply(200, b'ok')
+        if path.path != '/fetch':
+            return self.__reply(404, b'not found')
+        url = parse_qs(path.query).get('url', [None])[0]
+        if url is None or urlparse(url).scheme not in ('http', 'https') or sites.find_site(url)[0] is None:
+            return self.__reply(400, b'bad url')
+        try:
+            # no retries here. the pool retries a throttled page on another worker
+            (binary, res) = url_readall(url, opener=self.opener, max_retry_count=1)
+        except HTTPError as ex:
+            return self.__reply(502, b'origin failed', (('X-Origin-Status', str(ex.code)),))
+        headers = [('Content-Type', 'application/octet-stream')]
+        if res.info().get('Last-Modified') is not None:
+            headers.append(('Last-Modified', res.info().get('Last-Modified')))
+        self.__reply(200, binary, headers)
+
+def is_loopback(host):
+    if host == 'localhost': return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def serve(host, port, token=None, source_address=None):
+    ''' raise ValueError without a token on a non-loopback host '''
+    if token is None and not is_loopback(host):
+        raise ValueError('a worker on %s needs a token' % (host or 'every address'))
+    handler = type('Handler', (FetchWorkerHandler,), {
+        'token': token,
+        'opener': urllib.request.build_opener(SourceAddressHTTPHandler(source_address),
+                                              SourceAddressHTTPSHandler(source_address))
+                  if source_address is not None else None})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+class Worker:
+    ''' a fetch worker as seen by an EgressPool '''
+    def __init__(self, url, burst):
+        self.url = url.rstrip('/')
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.healthy = True
+        self.throttled_until = 0.0
+        self.fetched = 0
+        self.failed = 0
+
+class EgressPool:
+    ''' spread the downloads of a SimpleCache over fetch workers.
+    each worker has a budget of rate requests per second (up to burst at once), and a
+    download goes to the available worker with the most budget left, waiting up to
+    max_wait seconds for one. a worker that cannot be reached is taken out and probed
+    with /health every health_interval seconds until it answers. a worker whose site
+    answers 503 (the access limit of its address) rests for throttle_time seconds.
+    in both cases the download fails over to the other workers, trying at most twice
+    as many times as there are workers; any other error of the site (e.g. 404) is final,
+    and so is a url the worker refuses (400, or 404 for an unknown path).
+    keep rate * the time window of the site limits plus burst below those limits. '''
+    def __init__(self, worker_urls, rate=1.0, burst=5, token=None, timeout=60,
+                 health_interval=10, throttle_time=60, max_wait=30):
+        self.workers = [Worker(url, burst) for url in worker_urls]
+        self.rate = rate
+        self.burst = burst
+        self.token = token
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.throttle_time = throttle_time
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        threading.Thread(target=self.__check_health, daemon=True).start()
+
+    def __request(self, worker, path):
+        headers = {'X-Fetch-Worker-Token': self.token} if self.token is not None else {}
+        return urllib.request.urlopen(urllib.request.Request(worker.url + path, headers=headers),
+                                      timeout=self.timeout)
+
+    def __acquire(self, down):
+        ''' take one request of the budget of a healthy worker not in down, waiting for
+        the budget or the end of a rest up to max_wait. return None if there is none '''
+        deadline = time.monotonic() + self.max_wait
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                candidates = [w for w in self.workers if w not in down and w.healthy]
+                if len(candidates) == 0: return None
+                for w in candidates:
+                    w.tokens = min(self.burst, w.tokens + (now - w.updated) * self.rate)
+                    w.updated = now
+                ready = [w for w in candidates if w.throttled_until <= now]
+                if len(ready) > 0:
+                    worker = max(ready, key=lambda w: w.tokens)
+                    if worker.tokens >= 1:
+                        worker.tokens -= 1
+                        return worker
+                wake = min(w.throttled_until if w.throttled_until > now else now + (1 - w.tokens) / self.rate
+                           for w in candidates)
+                if wake > deadline: return None
+                self.cond.wait(wake - now)
+
+    def __take_out(self, worker, ex):
+        sys.stderr.write('fetch worker is down (%s). worker=%s\n' % (ex, worker.url))
+        with self.cond:
+            worker.healthy = False
+            worker.failed += 1
+
+    def readall(self, url):
+        ''' download url through a worker. return (data, response) like cache.url_readall '''
+        down = set()
+        code = 503
+        for _ in range(len(self.workers) * 2):
+            worker = self.__acquire(down)
+            if worker is None: break
+            try:
+                with self.__request(worker, '/fetch?' + urlencode({'url': url})) as res:
+                    binary = res.read()
+                with self.cond:
+                    worker.fetched += 1
+                return (binary, res)
+            except HTTPError as ex:
+                if ex.code in (400, 404):
+                    # the worker refuses this url (e.g. not a page of the sites). the others would too
+                    raise HTTPError(url, ex.code, 'fetch refused', None, None)
+                if ex.code != 502:
+                    # the worker itself failed (e.g. a wrong token)
+                    self.__take_out(worker, ex)
+                    down.add(worker)
+                    code = 500
+                    continue
+                code = int(ex.headers.get('X-Origin-Status', 500))
+                with self.cond:
+                    worker.failed += 1
+                    if code == 503: worker.throttled_until = time.monotonic() + self.throttle_time
+                if code != 503: raise HTTPError(url, code, 'fetch failed', None, None)
+                sys.stderr.write('throttled. retry on another worker. worker=%s url=%s\n' % (worker.url, url))
+            except OSError as ex:
+                self.__take_out(worker, ex)
+                down.add(worker)
+                code = 500
+        raise HTTPError(url, code, 'no fetch worker available', None, None)
+
+    def __check_health(self):
+        while True:
+            time.sleep(self.health_interval)
+            with self.cond:
+                down = [w for w in self.workers if not w.healthy]
+            for worker in down:
+                try:
+                    with self.__request(worker, '/health') as res:
+                        res.read()
+                except OSError:
+                    continue
+                sys.stderr.write('fetch worker is up. worker=%s\n' % (worker.url,))
+                with self.cond:
+                    worker.healthy = True
+                    self.cond.notify_all()
+
+    def stats(self):
+        now = time.monotonic()
+        with self.cond:
+            return [{'url': w.url, 'healthy': w.healthy, 'throttled': w.throttled_until > now,
+                     'fetched': w.fetched, 'failed': w.failed} for w in self.workers]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='download pages on behalf of the gateway')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('serve', help='run a fetch worker')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8101)
+    p.add_argument('--token', help='require this token from the gateway')
+    p.add_argument('--source-address', help='send the requests to the sites from this address')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        quit()
+    try:
+        server = serve(args.host, args.port, token=args.token, source_address=args.source_address)
+    except ValueError as ex:
+        parser.error(str(ex))
+    server.serve_forever()
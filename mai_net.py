@@ -4,11 +4,15 @@
 from epub import *
 from style import *
 from cache import DummyCache
-import lxml.html, math, sys, datetime, uuid, functools, io
+from extract import Rules
+import lxml.etree, sys, datetime
 
 class MaiNet:
-    def __init__(self, cache=DummyCache()):
+    def __init__(self, cache=DummyCache(), pack_size=None):
+        ''' pack_size: pack consecutive posts into spine documents of about this many
+        bytes of text (None: one document per post) '''
         self.cache = cache
+        self.pack_size = pack_size
 
     class PostData:
         def __init__(self):
@@ -16,50 +20,90 @@ class MaiNet:
             self.body   = None
             self.author = None
             self.date   = None
-    def __parse(self, tree):
-        posts = []
-        cur = MaiNet.PostData()
-        for e in tree.iter():
-            if e.tag == 'td':
-                if 'class' not in e.attrib: continue
-                if e.attrib['class'] == 'bgb':
-                    cur.title = e.find('font').text.rstrip()
-                if e.attrib['class'] == 'bgc':
-                    t = e.find('tt').text[6:].strip()
-                    cur.author = e.find('table').find('tr').find('td').find('tt').text[6:].strip()
-                    cur.date   = datetime.datetime(int(t[0:4]), int(t[5:7]), int(t[8:10]), int(t[11:13]),
-                                                   int(t[14:16]), tzinfo=datetime.timezone(datetime.timedelta(hours=9)))
-                    cur.body   = e.find('blockquote').find('div')
-                    if '◆' in cur.author: cur.author = cur.author[0:cur.author.find('◆')]
-                    posts.append(cur)
-                    cur = MaiNet.PostData()
-        return posts
 
-    def __call__(self, package, css_map, content_id):
-        fetch_url = 'http://www.mai-net.net/bbs/sst/sst.php?act=all_msg&cate=&all=' + content_id
-        tree = lxml.html.parse(io.BytesIO(self.cache.fetch(fetch_url)))
-        posts = self.__parse(tree)
-        if len(posts) == 0: raise Exception()
+    feed_chunk_size = 1024 * 64
 
-        meta = package.metadata
-        meta.add_title(posts[0].title, lang='ja')
-        meta.add_language('ja')
-        meta.add_identifier(str(uuid.uuid4()), unique_id=True)
-        meta.add_modified(functools.reduce(lambda x,y: x if x.date > y.date else y, posts).date)
-        meta.add_date(datetime.datetime.utcnow())
-        meta.add_creator(posts[0].author, lang='ja')
+    rules = Rules(
+        title='font',
+        date='tt',
+        author='table/tr/td/tt',
+        body='blockquote/div')
 
-        add_simple_cover(package.manifest, posts[0].title, posts[0].author, css_file=css_map.cover_css())
-        css_map.output(package.manifest)
+    def __parse_post(self, e, cur):
+        rules = MaiNet.rules
+        t = rules.first('date', e).text[6:].strip()
+        cur.author = rules.first('author', e).text[6:].strip()
+        cur.date   = datetime.datetime(int(t[0:4]), int(t[5:7]), int(t[8:10]), int(t[11:13]),
+                                       int(t[14:16]), tzinfo=datetime.timezone(datetime.timedelta(hours=9)))
+        cur.body   = rules.first('body', e)
+        if '◆' in cur.author: cur.author = cur.author[0:cur.author.find('◆')]
 
-        autoid = 0
-        id_width = math.ceil(math.log10(len(posts)))
+    def __release(self, e):
+        ''' drop the finished post and everything parsed before it '''
+        e.clear()
+        for ancestor in e.iterancestors():
+            while ancestor.getprevious() is not None:
+                del ancestor.getparent()[0]
+
+    def __iter_td(self, data):
+        parser = lxml.etree.HTMLPullParser(events=('end',), tag='td')
+        for pos in range(0, len(data), self.feed_chunk_size):
+            parser.feed(data[pos:pos + self.feed_chunk_size])
+            for (_, e) in parser.read_events(): yield e
+        parser.close()
+        for (_, e) in parser.read_events(): yield e
+
+    def __iter_posts(self, data):
+        ''' parse the page incrementally and yield each post as soon as its bgc cell is closed.
+        the post body is only valid until the next post is requested '''
+        cur = MaiNet.PostData()
+        for e in self.__iter_td(data):
+            if e.attrib.get('class') == 'bgb':
+                cur.title = MaiNet.rules.text('title', e)
+            elif e.attrib.get('class') == 'bgc':
+                self.__parse_post(e, cur)
+                yield cur
+                self.__release(e)
+                cur = MaiNet.PostData()
+
+    def __fetch_url(self, content_id):
+        return 'http://www.mai-net.net/bbs/sst/sst.php?act=all_msg&cate=&all=' + content_id
+
+    def plan(self, content_id):
+        ''' see SyosetuCom.plan. every post is on one page, so nothing but that page is
+        known without fetching it '''
+        return {'title': None, 'novel_type': None, 'complete': None, 'last_modified': None,
+                'chapters': None, 'pages': [(self.__fetch_url(content_id), None)]}
+
+    def __call__(self, package, css_map, content_id):
+        fetch_url = self.__fetch_url(content_id)
+        first = None
+        last_modified = None
         nav = EPUBNav('toc', '目次', 'ja', css_map.toc_css())
-        for post in posts[1:]:
-            filename = str(autoid).zfill(id_width) + '.xhtml'
+        autoid = 0
+        packer = PagePacker(package, css_map.page_css(), self.pack_size)
+        for post in self.__iter_posts(self.cache.fetch(fetch_url)):
+            if last_modified is None or last_modified < post.date: last_modified = post.date
+            if first is None:
+                first = (post.title, post.author)
+                add_simple_cover(package.manifest, post.title, post.author, css_file=css_map.cover_css())
+                css_map.output(package.manifest)
+                continue
+            # the number of posts is unknown while streaming, so use a fixed width
+            filename = str(autoid).zfill(4) + '.xhtml'
+            nav.add_child(post.title, packer.add_html(filename, 'post' + str(autoid), post.title, 'h2', post.body))
             autoid += 1
-            nav.add_child(post.title, filename)
-            create_simple_page_from_html(package, filename, post.title, 'h2', css_map.page_css(), post.body)
+        packer.close()
+        if first is None: raise Exception()
+        (title, author) = first
+
+        meta = package.metadata
+        meta.add_title(title, lang='ja')
+        meta.add_language('ja')
+        meta.add_identifier(source_uuid(fetch_url), unique_id=True)
+        meta.add_modified(last_modified)
+        meta.add_date(package.build_date(last_modified))
+        meta.add_creator(author, lang='ja')
 
         compatible_toc = EPUBCompatibleNav([nav], package.metadata, package.manifest)
         package.manifest.add_item('toc.ncx', str(compatible_toc), is_toc=True)
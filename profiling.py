@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+''' on-demand profiling of gateway conversions, and a cli to read the captures.
+
+  $ python3 profiling.py list data/profiles
+  $ python3 profiling.py show data/profiles/20140101-000000.000000-syosetu.com-n0000a [--limit 30] [--sort tottime]
+  $ python3 profiling.py diff before after [--limit 30]
+
+a capture is <name>.prof (a pstats dump) and <name>.alloc.txt (peak memory and the
+top allocation sites). '''
+
+import argparse, cProfile, datetime, hmac, os, os.path, pstats, random, re, sys, threading, time, tracemalloc
+
+class RequestProfiler:
+    ''' profile selected requests with cProfile and tracemalloc.
+    a request is profiled when it carries the secret in the X-Epub3-Profile header (never
+    in the query string, which access logs and proxies record), or at random with
+    sample_rate. only one capture runs at a
+    time; other requests meanwhile run unprofiled. cProfile sees the request thread only,
+    so page downloads show up as time waiting in fetch_all, while tracemalloc traces
+    every thread. '''
+    def __init__(self, profile_dir, secret=None, sample_rate=0.0, top_allocations=30):
+        self.profile_dir = profile_dir
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.top_allocations = top_allocations
+        self.lock = threading.Lock()
+
+    def wants(self, environ):
+        if self.secret is not None:
+            token = environ.get('HTTP_X_EPUB3_PROFILE')
+            if token is not None and hmac.compare_digest(token.encode('UTF-8'), self.secret.encode('UTF-8')):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def run(self, tag, func, *args):
+        ''' call func(*args) and save a capture named after tag. return its result '''
+        if not self.lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            name = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S.%f-') + re.sub(r'[^0-9A-Za-z._-]', '_', tag)
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing: tracemalloc.start()
+            tracemalloc.reset_peak()
+            profile = cProfile.Profile()
+            t0 = time.perf_counter()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                elapsed = time.perf_counter() - t0
+                (_, peak) = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                if started_tracing: tracemalloc.stop()
+                try:
+                    self.__save(name, tag, elapsed, peak, profile, snapshot)
+                except OSError as ex:
+                    # a lost capture never fails the request
+                    sys.stderr.write('cannot save the profile (%s). tag=%s\n' % (ex, tag))
+        finally:
+            self.lock.release()
+
+    def __save(self, name, tag, elapsed, peak, profile, snapshot):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, name)
+        profile.dump_stats(path + '.prof')
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')))
+        with open(path + '.alloc.txt', 'w') as f:
+            f.write('tag: %s\nelapsed: %.3f s\npeak: %d bytes\n' % (tag, elapsed, peak))
+            for stat in snapshot.statistics('lineno')[:self.top_allocations]:
+                f.write(str(stat) + '\n')
+        sys.stderr.write('profile saved. ' + path + '\n')
+
+def capture_path(path):
+    ''' accept a capture name with or without the .prof/.alloc.txt suffix '''
+    for suffix in ('.prof', '.alloc.txt'):
+        if path.endswith(suffix): return path[:-len(suffix)]
+    return path
+
+def read_header(path):
+    header = {}
+    if not os.path.isfile(path + '.alloc.txt'): return header
+    with open(path + '.alloc.txt') as f:
+        for line in f:
+            (key, sep, value) = line.partition(': ')
+            if sep == '' or key not in ('tag', 'elapsed', 'peak'): break
+            header[key] = value.strip()
+    return header
+
+def cmd_list(args):
+    names = sorted(capture_path(n) for n in os.listdir(args.profile_dir) if n.endswith('.prof'))
+    for name in names:
+        header = read_header(os.path.join(args.profile_dir, name))
+        print('%-60s %10s %16s' % (name, header.get('elapsed', '-'), header.get('peak', '-')))
+
+def cmd_show(args):
+    path = capture_path(args.capture)
+    pstats.Stats(path + '.prof').sort_stats(args.sort).print_stats(args.limit)
+    if os.path.isfile(path + '.alloc.txt'):
+        with open(path + '.alloc.txt') as f:
+            sys.stdout.write(f.read())
+
+def cmd_diff(args):
+    (a, b) = (capture_path(args.before), capture_path(args.after))
+    stats_a = pstats.Stats(a + '.prof').stats
+    stats_b = pstats.Stats(b + '.prof').stats
+    # (cumulative time before, after) of every function
+    times = dict((func, (stats_a[func][3] if func in stats_a else 0.0,
+                         stats_b[func][3] if func in stats_b else 0.0))
+                 for func in set(stats_a) | set(stats_b))
+    (header_a, header_b) = (read_header(a), read_header(b))
+    for key in ('elapsed', 'peak'):
+        print('%-8s %16s -> %s' % (key + ':', header_a.get(key, '-'), header_b.get(key, '-')))
+    print('%10s %10s %10s  function' % ('before', 'after', 'delta'))
+    for (func, (before, after)) in sorted(times.items(), key=lambda x: -abs(x[1][1] - x[1][0]))[:args.limit]:
+        print('%10.4f %10.4f %+10.4f  %s' % (before, after, after - before, pstats.func_std_string(func)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='read profiles captured by the gateway')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('list', help='list the captures with their time and peak memory')
+    p.add_argument('profile_dir')
+    p.set_defaults(func=cmd_list)
+    p = sub.add_parser('show', help='print the hottest functions and allocation sites of a capture')
+    p.add_argument('capture')
+    p.add_argument('--limit', type=int, default=30)
+    p.add_argument('--sort', default='cumulative', help='pstats sort key (default: cumulative)')
+    p.set_defaults(func=cmd_show)
+    p = sub.add_parser('diff', help='compare the cumulative time of each function of two captures')
+    p.add_argument('before')
+    p.add_argument('after')
+    p.add_argument('--limit', type=int, default=30)
+    p.set_defaults(func=cmd_diff)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        quit()
+    sys.exit(args.func(args) or 0)
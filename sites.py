@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import fnmatch, importlib, re, threading
+from urllib.parse import parse_qs, urlparse
+
+class Site:
+    ''' declaration of a site converter.
+    the converter module is imported only when the site is first used. '''
+    def __init__(self, name, title, homepage, module, class_name, hostnames,
+                 path_pattern=None, query_param=None, code_filter=None):
+        self.name = name
+        self.title = title
+        self.homepage = homepage
+        self.module = module
+        self.class_name = class_name
+        self.hostnames = hostnames
+        self.path_regex = re.compile(path_pattern) if path_pattern is not None else None
+        self.query_param = query_param
+        self.code_filter = code_filter
+        self.__class = None
+        self.__lock = threading.Lock()
+
+    def match_hostname(self, hostname):
+        if hostname is None: return False
+        for pattern in self.hostnames:
+            if fnmatch.fnmatchcase(hostname.lower(), pattern): return True
+        return False
+
+    def extract_code(self, url):
+        ''' return the content code in url, or None '''
+        code = None
+        if self.path_regex is not None:
+            m = self.path_regex.match(url.path)
+            if m is None: return None
+            code = m.group(1)
+        if self.query_param is not None:
+            values = parse_qs(url.query).get(self.query_param)
+            if values is None: return None
+            code = values[0]
+        if code is not None and self.code_filter is not None:
+            code = self.code_filter(code)
+        return code
+
+    def converter_class(self):
+        with self.__lock:
+            if self.__class is None:
+                self.__class = getattr(importlib.import_module(self.module), self.class_name)
+            return self.__class
+
+sites = []
+
+def register(site):
+    sites.append(site)
+    return site
+
+def get_site(name):
+    for site in sites:
+        if site.name == name: return site
+    return None
+
+def find_site(url):
+    ''' return (site, code) for url. (None, None) if no site matches '''
+    url = urlparse(url)
+    for site in sites:
+        if site.match_hostname(url.hostname):
+            return (site, site.extract_code(url))
+    return (None, None)
+
+register(Site('syosetu.com', '小説家になろう', 'http://syosetu.com/',
+              'syosetu_com', 'SyosetuCom', ('*.syosetu.com',),
+              path_pattern=r'^/([nN][0-9a-zA-Z]+)', code_filter=str.lower))
+register(Site('mai-net.net', 'Arcadia', 'http://www.mai-net.net/',
+              'mai_net', 'MaiNet', ('www.mai-net.net',),
+              query_param='all'))
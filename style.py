@@ -16,7 +16,8 @@ def add_simple_cover(manifest, title, author, description=None, css_file=None, f
         writer.element('p', text=description)
     manifest.add_item(filename, str(writer).encode('UTF-8'))
 
-def create_simple_page(title, title_tagname, css_file, iterator):
+def start_simple_page(title, css_file):
+    ''' return a writer with the head written and the body opened '''
     writer = SimpleXMLWriter()
     writer.write_xhtml_dtd_and_documentelement(lang='ja')
     writer.start('head')
@@ -24,23 +25,37 @@ def create_simple_page(title, title_tagname, css_file, iterator):
     writer.write_link_stylesheet(css_file)
     writer.end()
     writer.start('body')
-    if title_tagname is not None:
-        writer.element(title_tagname, text=title)
+    return writer
+
+def write_simple_body(writer, iterator):
     for line in iterator:
         writer.element('p', text=line.strip())
+
+def create_simple_page(title, title_tagname, css_file, iterator):
+    writer = start_simple_page(title, css_file)
+    if title_tagname is not None:
+        writer.element(title_tagname, text=title)
+    write_simple_body(writer, iterator)
     writer.end()
     return str(writer)
 
-def create_simple_page_from_html(package, filename, title, title_tagname, css_file, novel_body_element):
-    writer = SimpleXMLWriter()
-    writer.write_xhtml_dtd_and_documentelement(lang='ja')
-    writer.start('head')
-    writer.element('title', text=title)
-    writer.write_link_stylesheet(css_file)
-    writer.end()
-    writer.start('body')
+placeholder_lines = ('この話は取得できませんでした。', '時間をおいてから再度変換してください。')
+# the class of the body (or of the div of a packed page) of a placeholder page, so that
+# an update of the book (update.PreviousBuild) fetches the page again instead of copying it
+placeholder_class = 'placeholder'
+
+def add_placeholder_page(package, filename, title, title_tagname, css_file):
+    ''' add a page standing in for contents that could not be fetched '''
+    package.incomplete = True
+    writer = start_simple_page(title, css_file)
+    writer.att('class', placeholder_class)
     if title_tagname is not None:
         writer.element(title_tagname, text=title)
+    write_simple_body(writer, placeholder_lines)
+    writer.end()
+    package.manifest.add_item(filename, str(writer))
+
+def write_html_body(package, writer, novel_body_element):
     prev_is_empty_p = False
     paragraph_open = False
 
@@ -90,9 +105,78 @@ def create_simple_page_from_html(package, filename, title, title_tagname, css_fi
             prev_is_empty_p = False
         else:
             prev_is_empty_p = True
+    if paragraph_open:
+        writer.end()
+
+def create_simple_page_from_html(package, filename, title, title_tagname, css_file, novel_body_element):
+    writer = start_simple_page(title, css_file)
+    if title_tagname is not None:
+        writer.element(title_tagname, text=title)
+    write_html_body(package, writer, novel_body_element)
     writer.end()
     package.manifest.add_item(filename, str(writer))
 
+class PagePacker:
+    ''' write consecutive pages into shared spine documents of about target_size bytes
+    of text. each page is a div whose id is the fragment of its nav link
+    ("0001.xhtml#ep12"); a page larger than the target gets a document of its own.
+    with target_size None every page is a document, as create_simple_page*() write it.
+    close() must be called to write the last document. '''
+    def __init__(self, package, css_file, target_size=None):
+        self.package = package
+        self.css_file = css_file
+        self.target_size = target_size
+        self.writer = None
+        self.filename = None
+        self.size = 0
+
+    def __flush(self):
+        if self.writer is None: return
+        self.writer.end()
+        self.package.manifest.add_item(self.filename, str(self.writer))
+        self.writer = None
+
+    def __add(self, filename, fragment_id, title, title_tagname, size, write_body, page_class=None):
+        if self.target_size is None or \
+           (self.writer is not None and self.size + size > self.target_size):
+            self.__flush()
+        if self.writer is None:
+            self.writer = start_simple_page(title, self.css_file)
+            self.filename = filename
+            self.size = 0
+        self.size += size
+        link = self.filename
+        if self.target_size is not None:
+            self.writer.start('div', atts={'id':fragment_id})
+            link += '#' + fragment_id
+        # without packing, the body of the new document is open here
+        if page_class is not None: self.writer.att('class', page_class)
+        if title_tagname is not None:
+            self.writer.element(title_tagname, text=title)
+        write_body(self.writer)
+        if self.target_size is not None: self.writer.end()
+        return link
+
+    def add_html(self, filename, fragment_id, title, title_tagname, novel_body_element):
+        ''' add a page. return the nav link to it '''
+        size = sum(len(t.encode('UTF-8')) for t in novel_body_element.itertext())
+        return self.__add(filename, fragment_id, title, title_tagname, size,
+                          lambda writer: write_html_body(self.package, writer, novel_body_element))
+
+    def add_placeholder(self, filename, fragment_id, title, title_tagname):
+        ''' add a page standing in for contents that could not be fetched '''
+        self.package.incomplete = True
+        return self.__add(filename, fragment_id, title, title_tagname, 0,
+                          lambda writer: write_simple_body(writer, placeholder_lines), placeholder_class)
+
+    def add_document(self, filename, source):
+        ''' add a document written elsewhere (e.g. a page of an earlier build) as is '''
+        self.__flush()
+        self.package.manifest.add_item(filename, source)
+
+    def close(self):
+        self.__flush()
+
 class StylesheetMap:
     def __init__(self, default_css, cover_css = None, toc_css = None, page_css = None):
         self.default = default_css
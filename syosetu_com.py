@@ -4,20 +4,81 @@
 from epub import *
 from style import *
 from cache import DummyCache
-import lxml.html, math, sys, urllib.request, re, datetime, io, json
+from volume import add_volume_metadata, build_volumes
+from extract import Rules
+import lxml.html, math, os, sys, urllib.request, re, datetime, io, json, threading, collections, concurrent.futures
+
+class MetadataNotFound(Exception):
+    pass
 
 class SyosetuCom:
     image_url_regex = re.compile('[^0-9]*([0-9]+)\..*/icode/(i[0-9a-zA-Z]+)')
+    api_endpoints = ('http://api.syosetu.com/novelapi/api/', 'http://api.syosetu.com/novel18api/api/')
+    metadata_errors = (OSError, ValueError, KeyError, IndexError, TypeError, MetadataNotFound)
+    # how long an endpoint that does not know an ncode (or failed) is skipped for it
+    not_found_ttl = datetime.timedelta(hours=1)
+    error_ttl = datetime.timedelta(minutes=5)
+    # ncodes remembered in endpoint_map and negative_map (the least recently used are forgotten)
+    max_known_ncodes = 10000
+    toc_page_regex = re.compile(r'[?&]p=([0-9]+)')
+    # the nav link of an episode in a built epub: "0012.xhtml" or "0008.xhtml#ep12"
+    page_href_regex = re.compile(r'^([0-9]+)\.xhtml(?:#ep([0-9]+))?$')
+    rules = Rules(
+        cell='.',
+        body='descendant::div[@id="novel_view"][1]',
+        # chapter titles, episode links and update dates of the TOC in document order
+        toc_items='descendant::div[@class="novel_sublist"][1]//td[@class="chapter" or @class="long_update"]'
+                  ' | descendant::div[@class="novel_sublist"][1]//td[@class="period_subtitle"'
+                  ' or @class="long_subtitle"]/a',
+        toc_last_page='descendant::a[contains(@class, "novelview_pager-last")'
+                      ' or contains(@class, "c-pager__item--last")][1]/@href',
+        info_captions='//td[@class="h1" or @class="h_l"]',
+        info_value='following::td[1]',
+        info_title='//td/div/strong/a',
+        info_author='//td/div/a',
+        info_keywords='div')
 
-    def __init__(self, cache=DummyCache()):
+    def __init__(self, cache=DummyCache(), pack_size=None):
+        ''' pack_size: pack consecutive episodes into spine documents of about this many
+        bytes of text (None: one document per episode) '''
         self.cache = cache
+        self.pack_size = pack_size
+        self.endpoint_lock = threading.Lock()
+        self.endpoint_map = collections.OrderedDict()
+        self.negative_map = collections.OrderedDict()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(SyosetuCom.api_endpoints) * 2)
+
+    def __known_endpoint(self, ncode):
+        with self.endpoint_lock:
+            endpoint = self.endpoint_map.get(ncode)
+            if endpoint is not None: self.endpoint_map.move_to_end(ncode)
+            return endpoint
+    def __set_endpoint(self, ncode, endpoint):
+        with self.endpoint_lock:
+            self.endpoint_map.pop(ncode, None)
+            if endpoint is not None:
+                self.endpoint_map[ncode] = endpoint
+                if len(self.endpoint_map) > SyosetuCom.max_known_ncodes: self.endpoint_map.popitem(last=False)
+    def __is_negative(self, endpoint, ncode):
+        with self.endpoint_lock:
+            expires = self.negative_map.get((endpoint, ncode))
+            if expires is None: return False
+            if expires < datetime.datetime.utcnow():
+                del self.negative_map[(endpoint, ncode)]
+                return False
+            return True
+    def __set_negative(self, endpoint, ncode, ex):
+        ttl = SyosetuCom.not_found_ttl if isinstance(ex, MetadataNotFound) else SyosetuCom.error_ttl
+        now = datetime.datetime.utcnow()
+        with self.endpoint_lock:
+            self.negative_map.pop((endpoint, ncode), None)
+            self.negative_map[(endpoint, ncode)] = now + ttl
+            if len(self.negative_map) > SyosetuCom.max_known_ncodes:
+                for key in [key for (key, expires) in self.negative_map.items() if expires < now]:
+                    del self.negative_map[key]
+                while len(self.negative_map) > SyosetuCom.max_known_ncodes:
+                    self.negative_map.popitem(last=False)
 
-    def __get_all_text(self, node):
-        text = ''
-        for n in node.iter():
-            if n.text is not None: text += n.text
-            if n.tail is not None: text += n.tail
-        return text.strip()
     def __get_metadata(self, ncode):
         ''' return (title, author, description, keywords[space-separated],
             start-date, last modified, type[連載,短編], completed_flag)    '''
@@ -30,36 +91,33 @@ class SyosetuCom:
         def __get_metadata_manual_parse():
             fetch_url = 'http://ncode.syosetu.com/novelview/infotop/ncode/' + ncode
             info_page = lxml.html.parse(io.BytesIO(self.cache.fetch(fetch_url)))
-            prev_caption = None
-            title, author, description, keywords, start_date, last_modified = None, None, None, None, None, None
+            rules = SyosetuCom.rules
+            description, keywords, start_date, last_modified = None, None, None, None
             novel_type, complete_flag = None, True
-            def __safe_get_text(node):
-                return node.text.strip() if node is not None and node.text is not None else ''
-            for td in info_page.iter('td'):
-                if 'class' in td.attrib and td.attrib['class'] in ('h1', 'h_l'):
-                    prev_caption = __safe_get_text(td)
-                    continue
-                author = __safe_get_text(td.find('div/a'))
-                title = __safe_get_text(td.find('div/strong/a'))
-                if prev_caption is None: continue
-                elif prev_caption == 'あらすじ': description = self.__get_all_text(td)
-                elif prev_caption == 'キーワード': keywords = __safe_get_text(td.find('div'))
-                elif prev_caption == '掲載日': start_date = __safe_get_text(td)
-                elif prev_caption.startswith('最終'): last_modified = __safe_get_text(td)
-                elif prev_caption == '種別':
-                    novel_type = __safe_get_text(td)
+            title = rules.text('info_title', info_page)
+            author = rules.text('info_author', info_page)
+            for caption_td in rules.all('info_captions', info_page):
+                caption = (caption_td.text or '').strip()
+                td = rules.first('info_value', caption_td)
+                if td is None: continue
+                elif caption == 'あらすじ': description = rules.all_text('cell', td)
+                elif caption == 'キーワード': keywords = rules.text('info_keywords', td)
+                elif caption == '掲載日': start_date = rules.text('cell', td)
+                elif caption.startswith('最終'): last_modified = rules.text('cell', td)
+                elif caption == '種別':
+                    novel_type = rules.text('cell', td)
                     if novel_type.startswith('連載'): complete_flag = False
                     if novel_type != '短編': novel_type = '連載'
             start_date = to_datetime(start_date)
             try:
                 last_modified = to_datetime(last_modified)
-            except:
+            except (TypeError, ValueError):
                 last_modified = start_date
             return (title, author, description, keywords, start_date, last_modified, novel_type, complete_flag,
                     (last_modified - last_modified.utcoffset()).replace(tzinfo=None))
         def __get_metadata_api(base_url):
             json_val = json.load(io.StringIO(self.cache.fetch(base_url + '?out=json&of=t-w-s-k-gf-nt-e-nu&ncode=' + ncode).decode('utf-8')))
-            if json_val[0].get('allcount', 0) == 0: raise 'not found'
+            if json_val[0].get('allcount', 0) == 0: raise MetadataNotFound(ncode)
             m = json_val[1]
             last_modified = to_datetime(m.get('novelupdated_at'))
             return (m['title'], m['writer'], m.get('story',''), m.get('keyword',''),
@@ -68,12 +126,25 @@ class SyosetuCom:
                     True if m.get('end',0) == 0 else False,
                     (last_modified - last_modified.utcoffset()).replace(tzinfo=None))
 
-        try:
-            return __get_metadata_api('http://api.syosetu.com/novelapi/api/')
-        except: pass
-        try:
-            return __get_metadata_api('http://api.syosetu.com/novel18api/api/')
-        except: pass
+        endpoint = self.__known_endpoint(ncode)
+        if endpoint is not None:
+            try:
+                return __get_metadata_api(endpoint)
+            except SyosetuCom.metadata_errors as ex:
+                self.__set_endpoint(ncode, None)
+                self.__set_negative(endpoint, ncode, ex)
+
+        # cold lookup: ask every api that may know the ncode at once and take the first answer
+        candidates = [e for e in SyosetuCom.api_endpoints if not self.__is_negative(e, ncode)]
+        futures = dict((self.executor.submit(__get_metadata_api, e), e) for e in candidates)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except SyosetuCom.metadata_errors as ex:
+                self.__set_negative(futures[future], ncode, ex)
+                continue
+            self.__set_endpoint(ncode, futures[future])
+            return result
         return __get_metadata_manual_parse()
 
     def __process_image(self, url):
@@ -88,15 +159,11 @@ class SyosetuCom:
             else: mime = None
             return (filename, mime, f.read())
 
-    def __process_page(self, url, use_cache_newer_than, title, title_tagname, filename, css_file, package, data=None):
-        if data is None: data = self.cache.fetch(url, use_cache_newer_than=use_cache_newer_than)
-        page_tree = lxml.html.parse(io.BytesIO(data))
-        def find_novel_view():
-            for div in page_tree.iter('div'):
-                if 'id' not in div.attrib: continue
-                if div.attrib['id'] == 'novel_view':
-                    return div
-        novel_view = find_novel_view()
+    def __find_novel_view(self, data):
+        return SyosetuCom.rules.first('body', lxml.html.parse(io.BytesIO(data)))
+
+    def __process_page(self, url, use_cache_newer_than, title, title_tagname, filename, css_file, package):
+        novel_view = self.__find_novel_view(self.cache.fetch(url, use_cache_newer_than=use_cache_newer_than))
         create_simple_page_from_html(package, filename, title, title_tagname, css_file, novel_view)
 
     def __process_short_story(self, ncode, title, use_cache_newer_than, css_map, package):
@@ -108,97 +175,292 @@ class SyosetuCom:
         package.manifest.add_item('toc.ncx', str(compatible_toc), is_toc=True)
         package.manifest.add_item('toc.xhtml', nav.to_xml(), add_to_spine=False, properties='nav')
 
-    def __process_serial_story(self, ncode, use_cache_newer_than, css_map, package):
-        toc_page = lxml.html.parse(io.BytesIO(self.cache.fetch('http://ncode.syosetu.com/' + ncode,
-                                                               use_cache_newer_than=use_cache_newer_than)))
-        def find_novel_sublist():
-            for div in toc_page.iter('div'):
-                if 'class' in div.attrib and div.attrib['class'] == 'novel_sublist': return div
-        def rellink_to_url(rellink):
-            return 'http://ncode.syosetu.com/' + ncode + '/' + rellink + '/'
-        nav = EPUBNav('toc', '目次', 'ja', css_map.toc_css())
-        child = None
-        num_of_files = 0
+    def __chapter_url(self, ncode, rellink):
+        return 'http://ncode.syosetu.com/' + ncode + '/' + rellink + '/'
+
+    def __toc_url(self, ncode, page):
+        url = 'http://ncode.syosetu.com/' + ncode
+        return url if page == 1 else url + '/?p=' + str(page)
+
+    def __toc_page_count(self, toc_page):
+        href = SyosetuCom.rules.text('toc_last_page', toc_page)
+        m = SyosetuCom.toc_page_regex.search(href)
+        return int(m.group(1)) if m is not None else 1
+
+    def __parse_toc(self, ncode, toc_page, nav, chapter):
+        ''' add the entries of one TOC page to nav. chapter is the chapter node the page
+        starts in (a chapter may continue from the previous page).
+        return (chapter node at the end of the page, chapter urls, {url: modified datetime}) '''
         flat_link_list = []
         modified_datetime_map = {}
-        for td in find_novel_sublist().iter('td'):
-            if 'class' not in td.attrib: continue
-            if td.attrib['class'] == 'chapter': child = nav.add_child(td.text.strip())
-            elif td.attrib['class'] == 'period_subtitle' or td.attrib['class'] == 'long_subtitle':
-                node = nav
-                link = td.find('a')
-                if td.attrib['class'] == 'period_subtitle': node = child
-                link_value = link.attrib['href'][len(ncode)+2:].rstrip('/')
-                url = rellink_to_url(link_value)
+        url = None
+        for e in SyosetuCom.rules.all('toc_items', toc_page):
+            if e.tag == 'a':
+                node = chapter if e.getparent().attrib['class'] == 'period_subtitle' and chapter is not None else nav
+                link_value = e.attrib['href'][len(ncode)+2:].rstrip('/')
+                url = self.__chapter_url(ncode, link_value)
                 flat_link_list.append(url)
-                node.add_child(link.text.strip(), link=link_value)
-                num_of_files += 1
-                for sib in td.itersiblings(tag='td'):
-                    if sib.attrib.get('class') == 'long_update':
-                        modified_text = sib.text
-                        for c in '\n\r \t年月日/': modified_text = modified_text.replace(c,'')
-                        try:
-                            modified_datetime_map[url] = \
-                                datetime.datetime(int(modified_text[0:4]),
-                                                  int(modified_text[4:6]),
-                                                  int(modified_text[6:8])) - datetime.timedelta(hours=9)
-                        except:
-                            modified_datetime_map[url] = None
+                node.add_child(e.text.strip(), link=link_value)
+            elif e.attrib['class'] == 'chapter':
+                chapter = nav.add_child(e.text.strip())
+            elif url is not None and e.text is not None:
+                # a revised episode carries the date of the revision in the title of a span
+                revision = e.find('span')
+                modified_text = revision.attrib['title'] if revision is not None and 'title' in revision.attrib \
+                    else e.text
+                for c in '\n\r \t年月日/': modified_text = modified_text.replace(c,'')
+                try:
+                    modified_datetime_map[url] = \
+                        datetime.datetime(int(modified_text[0:4]),
+                                          int(modified_text[4:6]),
+                                          int(modified_text[6:8])) - datetime.timedelta(hours=9)
+                except:
+                    modified_datetime_map[url] = None
+        return (chapter, flat_link_list, modified_datetime_map)
 
+    def __fetch_chapters(self, flat_link_list, modified_datetime_map):
         # parallel fetch
+        # the pages are read from the result list (in which cached pages are decompressed
+        # as they are read) only when they are written
         fetch_result = self.cache.fetch_all(flat_link_list, use_cache_newer_than_map=modified_datetime_map)
         fetch_result_map = {}
         for i in range(len(flat_link_list)):
-            fetch_result_map[flat_link_list[i]] = fetch_result[i]
+            fetch_result_map[flat_link_list[i]] = (fetch_result, i)
+        return fetch_result_map
+
+    def __chapter_data(self, fetch_result_map, url):
+        (fetch_result, i) = fetch_result_map[url]
+        return fetch_result[i]
+
+    def __chapter_link(self, url):
+        return url.rstrip('/').rsplit('/', 1)[1]
+
+    def __previous_pages(self, ncode, previous):
+        ''' return {episode link: nav link} of the episodes in previous (an update.PreviousBuild),
+        or {} when it is not a build of ncode '''
+        if previous is None or previous.modified is None or \
+           previous.identifier != 'http://ncode.syosetu.com/' + ncode:
+            return {}
+        pages = {}
+        for href in previous.links:
+            m = SyosetuCom.page_href_regex.match(href)
+            if m is not None: pages[m.group(2) if m.group(2) is not None else str(int(m.group(1)))] = href
+        return pages
 
-        filename_width = math.ceil(math.log10(num_of_files))
+    def __is_unchanged(self, previous, modified):
+        # the TOC dates an episode by the day (in JST) only, so an episode of the day
+        # previous was built counts as changed
+        return modified is not None and modified + datetime.timedelta(days=1) <= previous.modified
+
+    def __reused_pages(self, previous, previous_pages, unchanged_links):
+        ''' return {episode link: nav link} of the episodes to copy from previous: those in
+        documents whose episodes are all unchanged and still listed, and that have no
+        placeholder page '''
+        documents = {}
+        for (link, href) in previous_pages.items():
+            documents.setdefault(href.split('#', 1)[0], []).append(link)
+        reused = {}
+        for (document, links) in documents.items():
+            if all(link in unchanged_links for link in links) and not previous.has_placeholder(document):
+                for link in links: reused[link] = previous_pages[link]
+        return reused
+
+    def __iter_toc(self, ncode, use_cache_newer_than, nav):
+        ''' read the TOC of a serial novel into nav and yield (chapter urls, {url: modified
+        datetime}) of each TOC page. the links of nav are relative links (e.g. "12") until
+        the pages are written.
+        a long TOC is split into "?p=N" pages. the first page tells their number and the
+        rest are fetched concurrently with fetch_all, so that they share the fetch workers
+        with the other conversions and are charged to this one. '''
+        first_page = lxml.html.parse(io.BytesIO(self.cache.fetch(self.__toc_url(ncode, 1),
+                                                                 use_cache_newer_than=use_cache_newer_than)))
+        page_count = self.__toc_page_count(first_page)
+        urls = [self.__toc_url(ncode, page) for page in range(2, page_count + 1)]
+        pages = []
+        if len(urls) > 0:
+            pages = self.cache.fetch_all(urls, use_cache_newer_than_map=dict((url, use_cache_newer_than)
+                                                                             for url in urls))
+        chapter = None
+        for page in range(1, page_count + 1):
+            toc_page = first_page if page == 1 else lxml.html.parse(io.BytesIO(pages[page - 2]))
+            (chapter, links, modified_datetime_map) = self.__parse_toc(ncode, toc_page, nav, chapter)
+            yield (links, modified_datetime_map)
+
+    def __read_serial(self, ncode, use_cache_newer_than, css_map, previous=None):
+        ''' read the TOC of a serial novel and fetch its chapters. the chapters of every TOC
+        page are fetched with one fetch_all, as one job of the fetch scheduler.
+        return (nav, chapter urls, fetch result map, reused pages); read a chapter with
+        __chapter_data().
+        with previous (an update.PreviousBuild of an earlier build), the episodes it has
+        that did not change since then are not fetched. reused pages is
+        {episode link: nav link in previous} of the episodes to copy from it. '''
+        previous_pages = self.__previous_pages(ncode, previous)
+        nav = EPUBNav('toc', '目次', 'ja', css_map.toc_css())
+        flat_link_list = []
+        modified_datetime_map = {}
+        unchanged_links = set()
+        for (links, page_modified_map) in self.__iter_toc(ncode, use_cache_newer_than, nav):
+            flat_link_list.extend(links)
+            modified_datetime_map.update(page_modified_map)
+            for url in links:
+                link = self.__chapter_link(url)
+                if link in previous_pages and self.__is_unchanged(previous, page_modified_map.get(url)):
+                    unchanged_links.add(link)
+        reused = self.__reused_pages(previous, previous_pages, unchanged_links)
+        # unchanged episodes sharing a document with a changed or removed one, or with a
+        # placeholder, are fetched with the others
+        fetch_links = [url for url in flat_link_list if self.__chapter_link(url) not in reused]
+        return (nav, flat_link_list, self.__fetch_chapters(fetch_links, modified_datetime_map), reused)
+
+    def __write_serial_pages(self, ncode, nav, fetch_result_map, filename_width, css_map, package,
+                             previous=None, reused={}):
+        ''' the episodes in reused ({episode link: nav link}) are copied from previous '''
+        packer = PagePacker(package, css_map.page_css(), self.pack_size)
+        copied = set()
         def process_page(nav_node, indent):
-            if nav_node.link is not None:
+            if nav_node.link in reused:
+                nav_node.link = reused[nav_node.link]
+                document = nav_node.link.split('#', 1)[0]
+                if document not in copied:
+                    copied.add(document)
+                    packer.add_document(document, previous.entry(document))
+            elif nav_node.link is not None:
                 filename = nav_node.link.zfill(filename_width) + '.xhtml'
-                url = rellink_to_url(nav_node.link)
-                nav_node.link = filename
-                self.__process_page(url, modified_datetime_map[url], nav_node.title, 'h' + str(indent),
-                                    filename, css_map.page_css(), package, data=fetch_result_map[url])
+                fragment_id = 'ep' + nav_node.link
+                data = self.__chapter_data(fetch_result_map, self.__chapter_url(ncode, nav_node.link))
+                if data is None:
+                    nav_node.link = packer.add_placeholder(filename, fragment_id, nav_node.title, 'h' + str(indent))
+                else:
+                    nav_node.link = packer.add_html(filename, fragment_id, nav_node.title, 'h' + str(indent),
+                                                    self.__find_novel_view(data))
             next_indent = indent + 1
             if next_indent > 6: next_indent = 6
             for child in nav_node.children:
                 process_page(child, next_indent)
         process_page(nav, 2)
+        packer.close()
         compatible_toc = EPUBCompatibleNav([nav], package.metadata, package.manifest)
         package.manifest.add_item('toc.ncx', str(compatible_toc), is_toc=True)
         package.manifest.add_item('toc.xhtml', nav.to_xml(), properties='nav',
                                   spine_pos = package.manifest.find_spine_pos('cover.xhtml') + 1)
 
-    def __call__(self, package, css_map, ncode):
-        metadata_tuple = self.__get_metadata(ncode)
+    def __process_serial_story(self, ncode, use_cache_newer_than, css_map, package, previous=None):
+        (nav, flat_link_list, fetch_result_map, reused) = \
+            self.__read_serial(ncode, use_cache_newer_than, css_map, previous)
+        filename_width = math.ceil(math.log10(len(flat_link_list)))
+        self.__write_serial_pages(ncode, nav, fetch_result_map, filename_width, css_map, package,
+                                  previous, reused)
+
+    def __write_metadata(self, package, metadata_tuple, ncode, css_map, volume=None):
         (title, author, description, keywords, start_date, last_modified,
          novel_type, complete_flag, use_cache_newer_than) = metadata_tuple
         meta = package.metadata
-        meta.add_title(title, lang='ja')
+        identifier = 'http://ncode.syosetu.com/' + ncode
+        if volume is None:
+            meta.add_title(title, lang='ja')
+        else:
+            add_volume_metadata(meta, title, volume)
+            identifier += '/#volume' + str(volume)
         meta.add_language('ja')
-        meta.add_identifier('http://ncode.syosetu.com/' + ncode, unique_id=True)
+        meta.add_identifier(identifier, unique_id=True)
         meta.add_created(start_date)
         meta.add_modified(last_modified)
-        meta.add_date(datetime.datetime.utcnow())
+        meta.add_date(package.build_date(last_modified))
         meta.add_creator(author, lang='ja')
         meta.add_description(description, lang='ja')
 
         css_map.output(package.manifest)
-        add_simple_cover(package.manifest, title, author, description=description, css_file=css_map.cover_css())
+        add_simple_cover(package.manifest, meta.get_dcmes_text('title'), author,
+                         description=description, css_file=css_map.cover_css())
+
+    def __call__(self, package, css_map, ncode):
+        self.update(package, css_map, ncode, None)
+
+    def update(self, package, css_map, ncode, previous):
+        ''' build the novel into package like __call__, from previous (an update.PreviousBuild
+        of an earlier build of it, or None). the documents of the episodes that did not change
+        since previous was built are copied from it, so only new and changed episodes are
+        fetched. the metadata, cover and TOC are written again. '''
+        metadata_tuple = self.__get_metadata(ncode)
+        self.__write_metadata(package, metadata_tuple, ncode, css_map)
         if metadata_tuple[6] == '短編':
-            self.__process_short_story(ncode, title, use_cache_newer_than, css_map, package)
+            self.__process_short_story(ncode, metadata_tuple[0], metadata_tuple[8], css_map, package)
         else:
-            self.__process_serial_story(ncode, use_cache_newer_than, css_map, package)
+            self.__process_serial_story(ncode, metadata_tuple[8], css_map, package, previous)
+
+    def plan(self, ncode):
+        ''' read only the metadata and the TOC of the novel, without fetching any chapter.
+        return {'title', 'novel_type', 'complete', 'last_modified', 'chapters', 'pages'}.
+        pages is [(url, use_cache_newer_than)] of the pages a build would fetch '''
+        (title, author, description, keywords, start_date, last_modified,
+         novel_type, complete_flag, use_cache_newer_than) = self.__get_metadata(ncode)
+        plan = {'title': title, 'novel_type': novel_type, 'complete': complete_flag,
+                'last_modified': last_modified}
+        if novel_type == '短編':
+            plan.update(chapters=1, pages=[('http://ncode.syosetu.com/' + ncode, use_cache_newer_than)])
+            return plan
+        pages = []
+        for (links, modified_datetime_map) in self.__iter_toc(ncode, use_cache_newer_than,
+                                                              EPUBNav('toc', '目次', 'ja', None)):
+            pages.extend((url, modified_datetime_map.get(url)) for url in links)
+        plan.update(chapters=len(pages), pages=pages)
+        return plan
+
+    def build_volumes(self, css_map, ncode, splitter, package_factory=EPUBPackage, max_workers=4):
+        ''' build the novel as volumes split by splitter (a volume.VolumeSplitter).
+        the volumes are built concurrently. return the list of packages '''
+        metadata_tuple = self.__get_metadata(ncode)
+        use_cache_newer_than = metadata_tuple[8]
+        if metadata_tuple[6] == '短編':
+            package = package_factory()
+            self.__write_metadata(package, metadata_tuple, ncode, css_map)
+            self.__process_short_story(ncode, metadata_tuple[0], use_cache_newer_than, css_map, package)
+            return [package]
+        (nav, flat_link_list, fetch_result_map, _) = self.__read_serial(ncode, use_cache_newer_than, css_map)
+        filename_width = math.ceil(math.log10(len(flat_link_list)))
+        def size_of(link):
+            # reading a chapter keeps it decompressed until the volumes are written,
+            # so the chapters are only read when the split needs their sizes
+            if splitter.max_bytes is None: return 0
+            data = self.__chapter_data(fetch_result_map, self.__chapter_url(ncode, link))
+            return len(data) if data is not None else 0
+        volumes = splitter.split(nav, size_of)
+        def build(number, entries):
+            package = package_factory()
+            self.__write_metadata(package, metadata_tuple, ncode, css_map,
+                                  volume=number if len(volumes) > 1 else None)
+            volume_nav = EPUBNav('toc', '目次', 'ja', css_map.toc_css())
+            volume_nav.children = entries
+            self.__write_serial_pages(ncode, volume_nav, fetch_result_map, filename_width, css_map, package)
+            return package
+        return build_volumes(volumes, build, max_workers)
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('usage: %s [ncode (example: n0000a)]' % (sys.argv[0],))
+    if len(sys.argv) not in (2, 3):
+        print('usage: %s [ncode (example: n0000a)] [max episodes per volume | previous epub to update]' % (sys.argv[0],))
         quit()
     converter = SyosetuCom()
     ncode = sys.argv[1]
 
     css_map = StylesheetMap(('style.css', SimpleVerticalWritingStyle))
-    package = EPUBPackage()
-    package.spine.set_direction('rtl')
-    converter(package, css_map, ncode)
-    package.save(ncode + '.epub')
+    def create_package():
+        package = EPUBPackage()
+        package.spine.set_direction('rtl')
+        return package
+    if len(sys.argv) == 3 and sys.argv[2].endswith('.epub'):
+        from update import PreviousBuild
+        package = create_package()
+        with PreviousBuild(sys.argv[2]) as previous:
+            converter.update(package, css_map, ncode, previous)
+            package.save(ncode + '.epub.tmp')
+        os.replace(ncode + '.epub.tmp', ncode + '.epub')
+    elif len(sys.argv) == 3:
+        from volume import VolumeSplitter
+        packages = converter.build_volumes(css_map, ncode, VolumeSplitter(max_items=int(sys.argv[2])),
+                                           package_factory=create_package)
+        for i in range(len(packages)):
+            packages[i].save(ncode + '_' + str(i + 1) + '.epub')
+    else:
+        package = create_package()
+        converter(package, css_map, ncode)
+        package.save(ncode + '.epub')
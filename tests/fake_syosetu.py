@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+NCODE = 'n1234ab'
+
+class FakeSite:
+    ''' a serial of episodes 1..count dated in december 2013, as the cache of a converter.
+    its TOC lists per_page episodes a page. the episodes in failing cannot be fetched '''
+    def __init__(self, count, short_story=False, per_page=100):
+        self.count = count
+        self.per_page = per_page
+        self.batches = []
+        self.short_story = short_story
+        self.failing = set()
+        self.fetched = []
+        self.api_calls = 0
+        self.reads = []
+
+    def __page(self, url):
+        if 'api.syosetu.com' in url:
+            # both endpoints are asked at once on the first lookup. count one of them
+            if '/novelapi/' in url: self.api_calls += 1
+            return json.dumps([{'allcount': 1}, {'title': 'テスト小説', 'writer': '作者', 'story': 'あらすじ',
+                                'keyword': 'k', 'general_firstup': '2013-01-01 00:00:00',
+                                'novelupdated_at': '2013-12-20 00:00:00',
+                                'noveltype': 2 if self.short_story else 1, 'end': 0}]).encode()
+        if url.rstrip('/') == 'http://ncode.syosetu.com/' + NCODE and self.short_story:
+            return '<html><head><meta charset="utf-8"></head><body><div id="novel_view">短編</div></body></html>'.encode()
+        page = 1 if url.rstrip('/') == 'http://ncode.syosetu.com/' + NCODE else \
+            int(url.split('?p=')[1]) if '?p=' in url else None
+        if page is not None:
+            first = (page - 1) * self.per_page + 1
+            rows = ''.join('<tr><td class="period_subtitle"><a href="/%s/%d/">話%d</a></td>'
+                           '<td class="long_update">2013/12/%02d 00:00</td></tr>' % (NCODE, n, n, n % 28 + 1)
+                           for n in range(first, min(first + self.per_page, self.count + 1)))
+            pager = '<a class="novelview_pager-last" href="/%s/?p=%d">最後へ</a>' % \
+                (NCODE, (self.count + self.per_page - 1) // self.per_page)
+            return ('<html><head><meta charset="utf-8"></head><body>%s<div class="novel_sublist"><table>%s</table>'
+                    '</div></body></html>' % (pager, rows)).encode()
+        n = int(url.rstrip('/').rsplit('/', 1)[1])
+        self.fetched.append(n)
+        if n in self.failing: return None
+        return ('<html><head><meta charset="utf-8"></head><body><div id="novel_view">本文%d</div></body></html>' % n).encode()
+
+    def fetch(self, url, use_cache_newer_than=None):
+        return self.__page(url)
+
+    def fetch_all(self, url_list, use_cache_newer_than_map=None):
+        self.batches.append(list(url_list))
+        return Pages(self, [self.__page(url) for url in url_list])
+
+class Pages(list):
+    ''' the result of fetch_all. records the pages read, as SimpleCache decompresses them
+    only when they are read '''
+    def __init__(self, site, pages):
+        list.__init__(self, pages)
+        self.site = site
+    def __getitem__(self, i):
+        self.site.reads.append(i)
+        return list.__getitem__(self, i)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import threading, time
+import pytest
+from admission import AdmissionController, Overloaded
+
+def hold_build(admission):
+    ''' hold a build slot in another thread until the returned event is set '''
+    (started, release) = (threading.Event(), threading.Event())
+    def run():
+        with admission.build():
+            started.set()
+            release.wait()
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return release
+
+def test_build_beyond_max_builds_waits_then_is_shed():
+    admission = AdmissionController(max_builds=1, max_wait=0.2, retry_after=30)
+    release = hold_build(admission)
+    t0 = time.monotonic()
+    with pytest.raises(Overloaded) as ex:
+        with admission.build():
+            pass
+    assert time.monotonic() - t0 >= 0.2
+    assert ex.value.code == 503 and ex.value.retry_after == 30
+    # a slot freed within max_wait is taken
+    threading.Timer(0.1, release.set).start()
+    with admission.build():
+        assert admission.stats()['builds'] == 1
+    assert admission.stats()['builds'] == 0
+
+def test_charge_and_done():
+    admission = AdmissionController(page_bytes=100)
+    assert admission.charge(10, 4) is None
+    with admission.build():
+        done = admission.charge(10, 4)
+        assert admission.stats() == {'builds': 1, 'bytes': 1000, 'queued_fetches': 4}
+        done()
+        # the fetches are returned when they are done, the bytes when the build ends
+        assert admission.stats() == {'builds': 1, 'bytes': 1000, 'queued_fetches': 0}
+    assert admission.stats() == {'builds': 0, 'bytes': 0, 'queued_fetches': 0}
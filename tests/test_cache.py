@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import datetime, http.server, threading, time
+import pytest
+from cache import SimpleCache, FetchIncomplete
+
+class Origin(http.server.BaseHTTPRequestHandler):
+    ''' answers 503 to /fail, the status in status to its paths and a page to anything else,
+    after delay seconds. counts the requests of each path '''
+    hits = {}
+    status = {}
+    delay = 0
+
+    def do_GET(self):
+        Origin.hits[self.path] = Origin.hits.get(self.path, 0) + 1
+        time.sleep(Origin.delay)
+        status = Origin.status.get(self.path, 503 if self.path == '/fail' else 200)
+        body = b'<html>' + self.path.encode() + b'</html>' if status == 200 else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def origin():
+    Origin.hits = {}
+    Origin.status = {}
+    Origin.delay = 0
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%d' % server.server_port
+    server.shutdown()
+
+def test_fetch_all_retries_only_with_its_backoff(origin, tmp_path):
+    cache = SimpleCache(str(tmp_path), retry_delays=(0.1, 0.1), allow_partial=True)
+    t0 = time.monotonic()
+    pages = cache.fetch_all([origin + '/fail', origin + '/ok'])
+    # one attempt and one per retry delay, without the sleeps of url_readall
+    assert Origin.hits['/fail'] == 3
+    assert time.monotonic() - t0 < 5
+    assert pages[0] is None
+    assert pages[1] == b'<html>/ok</html>'
+
+def test_fetch_all_raises_after_retries(origin, tmp_path):
+    cache = SimpleCache(str(tmp_path), retry_delays=(0.1,))
+    with pytest.raises(FetchIncomplete) as ex:
+        cache.fetch_all([origin + '/fail'])
+    assert ex.value.code == 503
+    assert Origin.hits['/fail'] == 2
+
+def test_purge_removes_old_deflate_entries(tmp_path):
+    import argparse, datetime, cache_tool
+    cache = SimpleCache(str(tmp_path))
+    cache.deflate_cache.put('old', b'old stream')
+    cache.deflate_cache.put('new', b'new stream')
+    old = cache.index.get('deflate:old')
+    cache.index.put('deflate:old', old._replace(accessed=old.accessed - datetime.timedelta(days=60)))
+    cache_tool.cmd_purge(argparse.Namespace(cache_dir=str(tmp_path), max_age=24 * 30, deflate=True,
+                                            host=None, ncode=None))
+    assert cache.index.get('deflate:old') is None
+    assert not cache.blobs.exists(old.hash)
+    assert bytes(cache.deflate_cache.get('new')) == b'new stream'
+
+def test_import_rejects_blobs_not_matching_their_hash(tmp_path):
+    import argparse, datetime, hashlib, io, tarfile, zlib, cache_tool
+    from cache import CacheEntry
+    cache = SimpleCache(str(tmp_path / 'src'))
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    for (url, body) in (('http://example.com/1', b'page 1'), ('http://example.com/2', b'page 2')):
+        hash_value = cache.blobs.put(hashlib.sha512(body).hexdigest()[0:64], zlib.compress(body))
+        cache.index.put(url, CacheEntry(now, hash_value, None, 'zlib'))
+    archive = str(tmp_path / 'cache.tar')
+    cache_tool.cmd_export(argparse.Namespace(cache_dir=str(tmp_path / 'src'), archive=archive,
+                                             host=None, ncode=None, max_age=None))
+    # replace the blob of page 2 by another page
+    tampered = str(tmp_path / 'tampered.tar')
+    bad_hash = cache.index.get('http://example.com/2').hash
+    with tarfile.open(archive) as src, tarfile.open(tampered, 'w') as dst:
+        for member in src:
+            data = src.extractfile(member).read()
+            if member.name == 'blobs/' + bad_hash: data = zlib.compress(b'evil')
+            member.size = len(data)
+            dst.addfile(member, io.BytesIO(data))
+    cache_tool.cmd_import(argparse.Namespace(cache_dir=str(tmp_path / 'dst'), archive=tampered, batch=10))
+    imported = SimpleCache(str(tmp_path / 'dst'))
+    assert imported.fetch('http://example.com/1') == b'page 1'
+    assert imported.index.get('http://example.com/2') is None
+    assert not imported.blobs.exists(bad_hash)
+
+def expire(cache, urls, age=datetime.timedelta(days=1)):
+    for url in urls:
+        entry = cache.index.get(url)
+        cache.index.put(url, entry._replace(accessed=entry.accessed - age))
+
+def test_expired_pages_of_a_large_build_do_not_block_other_builds(origin, tmp_path):
+    cache = SimpleCache(str(tmp_path), max_parallel_fetches=2, max_fetches_per_conversion=2, small_batch_size=4)
+    large = [origin + '/large/%d' % i for i in range(60)]
+    cache.fetch_all(large)
+    expire(cache, large)
+    Origin.delay = 0.02
+    rebuild = threading.Thread(target=cache.fetch_all, args=(large,))
+    rebuild.start()
+    while Origin.hits.get('/large/1', 0) < 2 and rebuild.is_alive():
+        time.sleep(0.01)
+    # neither a short job nor a larger new one waits for the whole rebuild
+    cache.fetch_all([origin + '/short/%d' % i for i in range(2)])
+    cache.fetch_all([origin + '/medium/%d' % i for i in range(8)])
+    assert rebuild.is_alive()
+    rebuild.join()
+
+def test_stale_page_is_served_and_revalidated_once(origin, tmp_path):
+    cache = SimpleCache(str(tmp_path), stale_while_revalidate=datetime.timedelta(days=2), hot_bytes=0)
+    url = origin + '/stale'
+    cache.fetch_all([url])
+    expire(cache, [url])
+    Origin.delay = 0.3
+    t0 = time.monotonic()
+    for _ in range(3):
+        assert cache.fetch(url) == b'<html>/stale</html>'
+        assert list(cache.fetch_all([url])) == [b'<html>/stale</html>']
+    assert time.monotonic() - t0 < 0.3
+    deadline = time.monotonic() + 5
+    while (Origin.hits['/stale'] < 2 or len(cache.revalidating) > 0) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert Origin.hits['/stale'] == 2
+    assert cache.index.get(url).accessed > datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+
+def test_page_past_the_grace_window_is_downloaded(origin, tmp_path):
+    cache = SimpleCache(str(tmp_path), stale_while_revalidate=datetime.timedelta(hours=1), hot_bytes=0)
+    url = origin + '/old'
+    cache.fetch_all([url])
+    expire(cache, [url])
+    cache.fetch_all([url])
+    assert Origin.hits['/old'] == 2
+    assert len(cache.revalidating) == 0
+
+@pytest.mark.parametrize('status', [503, 404, 410])
+def test_stale_if_error(origin, tmp_path, status):
+    cache = SimpleCache(str(tmp_path), stale_if_error=datetime.timedelta(days=7), retry_delays=(), hot_bytes=0)
+    url = origin + '/gone'
+    cache.fetch_all([url])
+    expire(cache, [url])
+    Origin.status['/gone'] = status
+    if status == 503:
+        assert list(cache.fetch_all([url])) == [b'<html>/gone</html>']
+    else:
+        with pytest.raises(FetchIncomplete):
+            cache.fetch_all([url])
+
+def test_cache_only(origin, tmp_path):
+    from urllib.error import HTTPError
+    cache = SimpleCache(str(tmp_path), hot_bytes=0)
+    url = origin + '/cached'
+    cache.fetch_all([url])
+    expire(cache, [url], age=datetime.timedelta(days=365))
+    cache.cache_only = True
+    assert cache.fetch(url) == b'<html>/cached</html>'
+    assert list(cache.fetch_all([url])) == [b'<html>/cached</html>']
+    with pytest.raises(HTTPError) as ex:
+        cache.fetch(origin + '/new')
+    assert ex.value.code == 504
+    with pytest.raises(FetchIncomplete) as ex:
+        cache.fetch_all([url, origin + '/new'])
+    assert ex.value.code == 504
+    assert Origin.hits == {'/cached': 1}
+
+def test_hot_cache_admits_on_second_read_and_evicts_by_bytes():
+    from cache import HotCache
+    hot = HotCache(10)
+    hot.admit('a', 'entry a', b'aaaaaa')
+    assert hot.get('a', lambda entry: True) is None
+    hot.admit('a', 'entry a', b'aaaaaa')
+    assert hot.get('a', lambda entry: True) == ('entry a', b'aaaaaa')
+    hot.admit('b', 'entry b', b'bbbbbb')
+    hot.admit('b', 'entry b', b'bbbbbb')
+    assert hot.get('a', lambda entry: True) is None
+    stats = hot.stats()
+    assert (stats['pages'], stats['bytes'], stats['evictions']) == (1, 6, 1)
+    assert stats['hit_rate'] == 1 / 3
+    # an entry no longer usable is dropped
+    assert hot.get('b', lambda entry: False) is None
+    assert hot.stats()['pages'] == 0
+
+def test_hot_tier_of_simple_cache(origin, tmp_path):
+    cache = SimpleCache(str(tmp_path), stale_while_revalidate=datetime.timedelta(days=2))
+    url = origin + '/hot'
+    cache.fetch(url)
+    cache.fetch(url)
+    assert cache.hot.stats()['pages'] == 0
+    cache.fetch(url)
+    assert cache.hot.stats()['pages'] == 1
+    hits = cache.hot.stats()['hits']
+    assert cache.fetch(url) == b'<html>/hot</html>'
+    assert cache.hot.stats()['hits'] == hits + 1
+    # a stale page is served from the hot tier and dropped once it is downloaded again
+    expire(cache, [url])
+    (entry, page) = cache.hot.pages[url]
+    cache.hot.pages[url] = (entry._replace(accessed=entry.accessed - datetime.timedelta(days=1)), page)
+    assert cache.fetch(url) == b'<html>/hot</html>'
+    deadline = time.monotonic() + 5
+    while cache.hot.stats()['pages'] > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert Origin.hits['/hot'] == 2
+    assert cache.hot.stats()['pages'] == 0
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import io, zipfile
+import epub
+from epub import EPUBPackage
+
+class DeflateStore:
+    def __init__(self):
+        self.streams = {}
+    def get(self, key):
+        return memoryview(self.streams[key]) if key in self.streams else None
+    def put(self, key, compressed):
+        self.streams[key] = bytes(compressed)
+
+def build(deflate_cache=None):
+    package = EPUBPackage(reproducible=True)
+    package.metadata.add_title('タイトル', lang='ja')
+    package.metadata.add_language('ja')
+    package.metadata.add_identifier('urn:test', unique_id=True)
+    package.metadata.add_modified(epub.datetime.datetime(2014, 1, 1))
+    package.manifest.add_item('page.xhtml', '<html>' + '本文' * 1000 + '</html>')
+    out = io.BytesIO()
+    package.save(out, deflate_cache=deflate_cache)
+    return out.getvalue()
+
+def contents(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        assert z.testzip() is None
+        return dict((name, z.read(name)) for name in z.namelist())
+
+def test_deflate_cache_gives_the_same_entries():
+    store = DeflateStore()
+    plain = build()
+    assert contents(build(store)) == contents(plain)
+    assert len(store.streams) > 0
+    assert contents(build(store)) == contents(plain)
+
+def test_write_raw_entry_falls_back_without_zipfile_internals(monkeypatch):
+    store = DeflateStore()
+    expected = contents(build(store))
+    monkeypatch.setattr(epub, 'raw_zip_attributes', epub.raw_zip_attributes + ('_no_such_attribute',))
+    assert contents(build(store)) == expected
+    with zipfile.ZipFile(io.BytesIO(), 'w') as z:
+        zinfo = zipfile.ZipInfo('a.txt')
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        epub.write_raw_entry(z, zinfo, epub.raw_deflate(b'abc' * 100), 0, 300)
+        assert z.read('a.txt') == b'abc' * 100
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import contextlib, http.server, threading, time, urllib.request
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+import pytest
+import fetch_worker, sites
+
+class Origin(http.server.BaseHTTPRequestHandler):
+    ''' answers 503 to the requests from the addresses in throttled, and a page to the others.
+    counts the requests of each client address '''
+    hits = {}
+    throttled = set()
+
+    def do_GET(self):
+        address = self.client_address[0]
+        Origin.hits[address] = Origin.hits.get(address, 0) + 1
+        (status, body) = (503, b'') if address in Origin.throttled else (200, b'page')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@contextlib.contextmanager
+def running(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield 'http://127.0.0.1:%d' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def origin(monkeypatch):
+    ''' the url of a page of a local site the workers may fetch '''
+    Origin.hits = {}
+    Origin.throttled = set()
+    monkeypatch.setattr(sites, 'sites', sites.sites + [
+        sites.Site('origin', 'origin', 'http://127.0.0.1/', 'fetch_worker', 'Worker', ('127.0.0.1',))])
+    with running(http.server.ThreadingHTTPServer(('127.0.0.1', 0), Origin)) as url:
+        yield url + '/page'
+
+def worker(source_address=None):
+    return running(fetch_worker.serve('127.0.0.1', 0, source_address=source_address))
+
+def test_token_required_off_loopback():
+    with pytest.raises(ValueError):
+        fetch_worker.serve('0.0.0.0', 0)
+    fetch_worker.serve('0.0.0.0', 0, token='t').server_close()
+    fetch_worker.serve('127.0.0.1', 0).server_close()
+
+def test_fetches_only_site_pages():
+    with worker() as url:
+        with pytest.raises(HTTPError) as ex:
+            urllib.request.urlopen(url + '/fetch?' + urlencode({'url': 'http://example.com/'}), timeout=10)
+        assert ex.value.code == 400
+
+def test_refused_url_keeps_the_workers(origin):
+    with worker() as url:
+        pool = fetch_worker.EgressPool([url])
+        with pytest.raises(HTTPError) as ex:
+            pool.readall('http://example.com/')
+        assert ex.value.code == 400
+        assert pool.stats()[0]['healthy']
+        assert pool.readall(origin)[0] == b'page'
+
+def test_fails_over_to_another_worker(origin):
+    dead = fetch_worker.serve('127.0.0.1', 0)
+    dead_url = 'http://127.0.0.1:%d' % dead.server_address[1]
+    dead.server_close()
+    with worker() as url:
+        pool = fetch_worker.EgressPool([dead_url, url])
+        assert pool.readall(origin)[0] == b'page'
+        assert pool.readall(origin)[0] == b'page'
+        stats = dict((s['url'], s) for s in pool.stats())
+        assert not stats[dead_url]['healthy']
+        assert stats[url]['fetched'] == 2
+
+def test_throttled_worker_rests(origin):
+    Origin.throttled.add('127.0.0.2')
+    with worker('127.0.0.2') as throttled_url, worker('127.0.0.3') as url:
+        pool = fetch_worker.EgressPool([throttled_url, url], throttle_time=60)
+        for _ in range(3):
+            assert pool.readall(origin)[0] == b'page'
+        stats = dict((s['url'], s) for s in pool.stats())
+        assert stats[throttled_url]['throttled'] and stats[throttled_url]['healthy']
+        # the site is asked once from the throttled address, then only from the other
+        assert Origin.hits == {'127.0.0.2': 1, '127.0.0.3': 3}
+
+def test_worker_comes_back_after_health_check(origin):
+    server = fetch_worker.serve('127.0.0.1', 0)
+    port = server.server_address[1]
+    server.server_close()
+    pool = fetch_worker.EgressPool(['http://127.0.0.1:%d' % port], health_interval=0.1, max_wait=1)
+    with pytest.raises(HTTPError):
+        pool.readall(origin)
+    assert not pool.stats()[0]['healthy']
+    with running(fetch_worker.serve('127.0.0.1', port)):
+        deadline = time.monotonic() + 5
+        while not pool.stats()[0]['healthy'] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert pool.readall(origin)[0] == b'page'
+
+def test_rate_budget_of_a_worker(origin):
+    with worker() as url:
+        pool = fetch_worker.EgressPool([url], rate=5, burst=1)
+        t0 = time.monotonic()
+        for _ in range(3):
+            pool.readall(origin)
+        # the burst is spent by the first download, then one download every 0.2 s
+        assert time.monotonic() - t0 >= 0.35
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+from profiling import RequestProfiler
+
+def test_secret_only_from_header(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), secret='s3cret')
+    assert profiler.wants({'HTTP_X_EPUB3_PROFILE': 's3cret'})
+    assert not profiler.wants({'QUERY_STRING': 'profile=s3cret'})
+    assert not profiler.wants({'HTTP_X_EPUB3_PROFILE': 'wrong'})
+
+def test_failed_capture_keeps_the_result(tmp_path):
+    (tmp_path / 'file').write_text('')
+    profiler = RequestProfiler(str(tmp_path / 'file' / 'profiles'))
+    assert profiler.run('tag', lambda x: x * 2, 21) == 42
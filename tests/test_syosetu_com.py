@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import io, re, zipfile
+import style, syosetu_com
+from epub import EPUBPackage
+from fake_syosetu import FakeSite, NCODE
+
+def test_paged_toc_is_read_with_one_fetch_all_for_the_chapters():
+    site = FakeSite(25, per_page=10)
+    converter = syosetu_com.SyosetuCom(site)
+    package = EPUBPackage(reproducible=True)
+    converter(package, style.StylesheetMap(('style.css', style.SimpleVerticalWritingStyle)), NCODE)
+    # the other TOC pages, then every chapter as one job of the scheduler
+    assert [len(batch) for batch in site.batches] == [2, 25]
+    assert all('?p=' in url for url in site.batches[0])
+    out = io.BytesIO()
+    package.save(out)
+    with zipfile.ZipFile(out) as z:
+        links = re.findall(r'href="([0-9]+\.xhtml)"', z.read('OPBES/toc.xhtml').decode('UTF-8'))
+    assert len(links) == 25
+
+def test_endpoint_and_negative_maps_are_bounded(monkeypatch):
+    import datetime
+    monkeypatch.setattr(syosetu_com.SyosetuCom, 'max_known_ncodes', 2)
+    converter = syosetu_com.SyosetuCom(FakeSite(1))
+    for ncode in ('n1', 'n2'):
+        converter._SyosetuCom__set_endpoint(ncode, 'api')
+    assert converter._SyosetuCom__known_endpoint('n1') == 'api'
+    converter._SyosetuCom__set_endpoint('n3', 'api')
+    # the least recently used ncode is forgotten
+    assert list(converter.endpoint_map) == ['n1', 'n3']
+
+    not_found = syosetu_com.MetadataNotFound('n')
+    converter._SyosetuCom__set_negative('api', 'n1', not_found)
+    converter._SyosetuCom__set_negative('api', 'n2', not_found)
+    converter.negative_map[('api', 'n2')] = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    converter._SyosetuCom__set_negative('api', 'n3', not_found)
+    # the expired entry goes first
+    assert list(converter.negative_map) == [('api', 'n1'), ('api', 'n3')]
+    converter._SyosetuCom__set_negative('api', 'n4', not_found)
+    assert list(converter.negative_map) == [('api', 'n3'), ('api', 'n4')]
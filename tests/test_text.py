@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import io, os, re, zipfile
+import text
+from epub import EPUBPackage
+from style import StylesheetMap, SimpleVerticalWritingStyle
+
+css_map = StylesheetMap(('style.css', SimpleVerticalWritingStyle))
+
+def write_files(directory, files, mtime=1388534400):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for (name, body) in files:
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(body)
+        os.utime(path, (mtime, mtime))
+        paths.append(path)
+    return paths
+
+def convert(paths, reproducible=True):
+    converter = text.TextToEpub(max_workers=None)
+    package = EPUBPackage(reproducible=reproducible)
+    converter.write_book('題名', '作者', converter.read_files(paths, css_map), css_map, package)
+    out = io.BytesIO()
+    package.save(out)
+    with zipfile.ZipFile(out) as z:
+        return z.read('OPBES/content.opf').decode('UTF-8')
+
+def identifier(opf):
+    return re.search(r'<dc:identifier[^>]*>([^<]+)<', opf).group(1)
+
+def test_reproducible_build_is_dated_by_mtime(tmp_path):
+    paths = write_files(str(tmp_path), [('0_一.txt', '本文'.encode('UTF-8'))])
+    opf = convert(paths)
+    assert '2014-01-01T00:00:00Z' in re.search(r'<meta property="dcterms:created"[^>]*>([^<]+)<', opf).group(1)
+    assert opf == convert(paths)
+
+def test_identifier_differs_between_books_of_the_same_title(tmp_path):
+    a = write_files(str(tmp_path / 'a'), [('0_一.txt', b'a')])
+    b = write_files(str(tmp_path / 'b'), [('0_別の話.txt', b'b')])
+    assert identifier(convert(a)) == identifier(convert(a))
+    assert identifier(convert(a)) != identifier(convert(b))
+    assert identifier(convert(a, reproducible=False)) != identifier(convert(a, reproducible=False))
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def test_detect_encoding_prefers_euc_jp_to_cp932_mojibake():
+    with open(os.path.join(DATA_DIR, 'euc_jp.txt'), 'rb') as f:
+        data = f.read()
+    # the fixture decodes without error as cp932 as well
+    data.decode('cp932')
+    assert text.detect_encoding(data) == 'euc_jp'
+    assert text.detect_encoding(data.decode('euc_jp').encode('cp932')) == 'cp932'
+    assert text.detect_encoding(data.decode('euc_jp').encode('UTF-8')) == 'utf-8'
+
+def test_single_file_split_of_euc_jp():
+    splitter = text.TextFileSplitter(os.path.join(DATA_DIR, 'euc_jp.txt'))
+    chapters = splitter.chapters()
+    assert [title for (title, _, _) in chapters] == ['第二章　名前', '第三章　記憶']
+    assert splitter.lines(*chapters[1][1:]) == ['本文の二行目です。']
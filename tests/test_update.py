@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import io, re, zipfile
+import pytest
+import style, syosetu_com
+from fake_syosetu import FakeSite, NCODE
+from epub import EPUBPackage
+from update import PreviousBuild
+
+def build(converter, previous=None):
+    css_map = style.StylesheetMap(('style.css', style.SimpleVerticalWritingStyle))
+    package = EPUBPackage(reproducible=True)
+    converter.update(package, css_map, NCODE, previous)
+    out = io.BytesIO()
+    package.save(out)
+    return (package, out.getvalue())
+
+def page_texts(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        return ''.join(re.sub(r'<[^>]+>', '', z.read(name).decode('UTF-8')) for name in z.namelist()
+                       if re.search(r'/[0-9]+\.xhtml$', name))
+
+@pytest.mark.parametrize('pack_size', [None, 1000])
+def test_update_fetches_placeholder_pages_again(pack_size):
+    site = FakeSite(5)
+    converter = syosetu_com.SyosetuCom(site, pack_size=pack_size)
+    site.failing = {3}
+    (package, first) = build(converter)
+    assert package.incomplete
+    assert style.placeholder_lines[0] in page_texts(first)
+
+    site.failing = set()
+    site.fetched = []
+    with PreviousBuild(io.BytesIO(first)) as previous:
+        assert [previous.has_placeholder(href) for href in previous.links].count(True) == \
+            (1 if pack_size is None else len(previous.links))
+        (package, second) = build(converter, previous)
+    assert not package.incomplete
+    assert 3 in site.fetched
+    texts = page_texts(second)
+    assert style.placeholder_lines[0] not in texts
+    assert '本文3' in texts
+
+def test_update_copies_unchanged_pages():
+    site = FakeSite(5)
+    converter = syosetu_com.SyosetuCom(site)
+    (_, first) = build(converter)
+    site.fetched = []
+    with PreviousBuild(io.BytesIO(first)) as previous:
+        assert not any(previous.has_placeholder(href) for href in previous.links)
+        (_, second) = build(converter, previous)
+    assert site.fetched == []
+    assert page_texts(second) == page_texts(first)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import style, syosetu_com
+from fake_syosetu import FakeSite, NCODE
+from volume import VolumeSplitter
+
+css_map = style.StylesheetMap(('style.css', style.SimpleVerticalWritingStyle))
+
+def test_split_by_items_reads_pages_only_to_write_them():
+    site = FakeSite(10)
+    converter = syosetu_com.SyosetuCom(site)
+    reads = []
+    def package_factory():
+        # the pages read before the first volume is written were read to measure them
+        reads.append(len(site.reads))
+        return syosetu_com.EPUBPackage()
+    packages = converter.build_volumes(css_map, NCODE, VolumeSplitter(max_items=4), package_factory=package_factory)
+    assert len(packages) == 3
+    assert reads[0] == 0
+
+def test_split_by_bytes_measures_pages():
+    site = FakeSite(10)
+    converter = syosetu_com.SyosetuCom(site)
+    packages = converter.build_volumes(css_map, NCODE, VolumeSplitter(max_bytes=400))
+    assert len(packages) > 1
+
+def test_short_story_fetches_metadata_once():
+    site = FakeSite(1, short_story=True)
+    converter = syosetu_com.SyosetuCom(site)
+    packages = converter.build_volumes(css_map, NCODE, VolumeSplitter(max_items=4))
+    assert len(packages) == 1
+    assert site.api_calls == 1
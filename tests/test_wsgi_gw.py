@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from wsgi_gw import SimpleGW
+from fake_syosetu import FakeSite, NCODE
+
+def test_packing_is_opt_in():
+    gw = SimpleGW(FakeSite(3))
+    assert gw.get_converter('syosetu.com').pack_size is None
+    assert gw.get_converter('syosetu.com', SimpleGW.is_packed({'pack': ['1']})).pack_size == gw.pack_size
+    assert not SimpleGW.is_packed({})
+    assert SimpleGW.build_key('syosetu.com', NCODE, False) != SimpleGW.build_key('syosetu.com', NCODE, True)
+
+class PlainConverter:
+    def __init__(self, cache):
+        self.cache = cache
+
+def test_converter_without_pack_size(monkeypatch):
+    import sites
+    site = sites.Site('plain', 'plain', 'http://plain.example/', 'test_wsgi_gw', 'PlainConverter',
+                      ('plain.example',))
+    monkeypatch.setattr(sites, 'sites', sites.sites + [site])
+    gw = SimpleGW(FakeSite(3))
+    assert isinstance(gw.get_converter('plain', True), PlainConverter)
+
+def request(gw, method='GET', headers={}):
+    environ = {'REQUEST_METHOD': method, 'QUERY_STRING': 's=syosetu.com&n=' + NCODE}
+    environ.update(headers)
+    response = {}
+    def start_response(status, response_headers):
+        response['status'] = status
+        response['headers'] = dict(response_headers)
+    body = b''.join(gw(environ, start_response))
+    return (response['status'], response['headers'], body)
+
+@pytest.fixture
+def gateway(tmp_path):
+    import syosetu_com
+    from admission import AdmissionController
+    from cache import SimpleCache
+    gw = SimpleGW(SimpleCache(str(tmp_path)), admission=AdmissionController(max_builds=1, max_wait=0.1))
+    site = FakeSite(3)
+    gw.service_map[('syosetu.com', False)] = syosetu_com.SyosetuCom(site)
+    return (gw, site)
+
+def test_head_before_build(gateway):
+    (gw, site) = gateway
+    (status, headers, body) = request(gw, 'HEAD')
+    assert status.startswith('404') and body == b''
+    assert site.fetched == []
+
+def test_ranges(gateway):
+    (gw, _) = gateway
+    (status, headers, epub) = request(gw)
+    assert status == '200 OK' and int(headers['Content-Length']) == len(epub)
+    etag = headers['ETag']
+    (status, headers, body) = request(gw, headers={'HTTP_RANGE': 'bytes=10-19'})
+    assert status.startswith('206') and body == epub[10:20]
+    assert headers['Content-Range'] == 'bytes 10-19/%d' % len(epub)
+    (status, headers, body) = request(gw, headers={'HTTP_RANGE': 'bytes=-5', 'HTTP_IF_RANGE': etag})
+    assert status.startswith('206') and body == epub[-5:]
+    (status, headers, body) = request(gw, headers={'HTTP_RANGE': 'bytes=%d-' % len(epub)})
+    assert status.startswith('416') and headers['Content-Range'] == 'bytes */%d' % len(epub)
+    (status, headers, body) = request(gw, headers={'HTTP_RANGE': 'bytes=10-19', 'HTTP_IF_RANGE': '"stale"'})
+    assert status == '200 OK' and body == epub
+    (status, headers, body) = request(gw, 'HEAD')
+    assert status == '200 OK' and body == b''
+    assert int(headers['Content-Length']) == len(epub) and headers['ETag'] == etag
+
+def test_overloaded_build_is_503(gateway):
+    import threading
+    (gw, site) = gateway
+    (started, release) = (threading.Event(), threading.Event())
+    def hold_build():
+        with gw.admission.build():
+            started.set()
+            release.wait()
+    threading.Thread(target=hold_build, daemon=True).start()
+    started.wait()
+    try:
+        (status, headers, body) = request(gw)
+    finally:
+        release.set()
+    assert status.startswith('503') and headers['Retry-After'] == str(gw.admission.retry_after)
+    assert site.fetched == []
@@ -3,66 +3,334 @@
 
 from epub import *
 from style import *
-import sys, os.path, operator, math, uuid
+from volume import VolumeSplitter, add_volume_metadata, build_volumes
+import sys, os.path, operator, math, uuid, codecs, concurrent.futures, functools, getopt, mmap, re, stat, threading
+
+# hiragana, full-width katakana and kanji
+japanese_char_regex = re.compile('[\u3041-\u309f\u30a1-\u30ff\u4e00-\u9fff]')
+
+def detect_encoding(buf, sample_size=1024 * 1024):
+    ''' utf-8 if the sample is valid utf-8. otherwise the one of shift_jis (cp932) and
+    euc-jp whose decoding of the sample has more kana and kanji: most euc-jp text also
+    decodes without error as cp932, into half-width katakana and unassigned kanji '''
+    if buf[0:3] == codecs.BOM_UTF8: return 'utf-8-sig'
+    sample = buf[0:sample_size]
+    scores = {}
+    for encoding in ('utf-8', 'cp932', 'euc_jp'):
+        try:
+            decoded = codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        except UnicodeDecodeError:
+            continue
+        if encoding == 'utf-8': return encoding
+        scores[encoding] = len(japanese_char_regex.findall(decoded))
+    if len(scores) == 0: return 'utf-8'
+    return max(('cp932', 'euc_jp'), key=lambda encoding: scores.get(encoding, -1))
+
+class TextFileSplitter:
+    ''' split one large text file into chapters by heading regexes in a single pass.
+    the file is memory-mapped and only decoded line by line, so the whole text
+    never exists as python strings. '''
+    default_heading_patterns = (r'^\s*第[0-9０-９一二三四五六七八九十百千]+[章話部節幕]',
+                                r'^\s*［＃.*見出し］', r'^#+\s')
+
+    def __init__(self, path, heading_patterns=None, encoding=None):
+        self.path = path
+        if heading_patterns is None or len(heading_patterns) == 0:
+            heading_patterns = TextFileSplitter.default_heading_patterns
+        self.heading_regex = re.compile('|'.join('(?:' + p + ')' for p in heading_patterns))
+        self.encoding = encoding
+
+    def __iter_lines(self, buf, start, end):
+        ''' yield (line, offset of the next line) '''
+        while start < end:
+            # '\n' never appears inside a multibyte character of utf-8, shift_jis or euc-jp
+            pos = buf.find(b'\n', start, end)
+            if pos < 0: pos = end
+            yield (buf[start:pos].decode(self.encoding, 'replace').rstrip('\r'), pos + 1)
+            start = pos + 1
+
+    def __map(self, func):
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0: return func(b'', 0)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                if self.encoding is None: self.encoding = detect_encoding(buf)
+                return func(buf, size)
+
+    def chapters(self):
+        ''' return [(title, start, end)] of the chapter bodies. the title of the text
+        before the first heading is None '''
+        def split(buf, size):
+            chapters = []
+            title, start, has_text = None, 0, False
+            pos = 0
+            for (line, next_pos) in self.__iter_lines(buf, 0, size):
+                if self.heading_regex.search(line) is not None:
+                    if title is not None or has_text: chapters.append((title, start, pos))
+                    title, start, has_text = line.strip(), next_pos, False
+                elif not has_text and len(line.strip()) > 0:
+                    has_text = True
+                pos = next_pos
+            if title is not None or has_text: chapters.append((title, start, size))
+            return chapters
+        return self.__map(split)
+
+    def lines(self, start, end):
+        ''' return the decoded lines of buf[start:end] '''
+        return self.__map(lambda buf, size: [line for (line, _) in self.__iter_lines(buf, start, min(end, size))])
+
+class RenderAhead:
+    ''' the page sources of a book, rendered ahead on an executor in chunks of chunk_size
+    pages. save() reads the pages in manifest order, so reading page i starts rendering
+    the chunks up to page i + readahead in the background; at most that many rendered
+    pages wait in memory '''
+    def __init__(self, executor, renders, readahead, chunk_size=8):
+        self.executor = executor
+        self.renders = renders
+        self.chunk_size = chunk_size
+        self.readahead_chunks = max(1, readahead // chunk_size)
+        self.futures = {}
+        self.submitted = 0
+        self.lock = threading.Lock()
+
+    def __render_chunk(self, c):
+        return [render() for render in self.renders[c * self.chunk_size:(c + 1) * self.chunk_size]]
+
+    def source(self, i):
+        def read():
+            c = i // self.chunk_size
+            last = (i + 1) % self.chunk_size == 0 or i + 1 == len(self.renders)
+            with self.lock:
+                chunk_count = (len(self.renders) + self.chunk_size - 1) // self.chunk_size
+                while self.submitted < min(c + 1 + self.readahead_chunks, chunk_count):
+                    self.futures[self.submitted] = self.executor.submit(self.__render_chunk, self.submitted)
+                    self.submitted += 1
+                future = self.futures.pop(c, None) if last else self.futures.get(c)
+            # a page read again (e.g. by a second save) is rendered again
+            return self.renders[i]() if future is None else future.result()[i % self.chunk_size]
+        return read
 
 class TextToEpub:
-    def __call__(self, title, author, filelist, css_map, package):
-        def find_date_info():
-            created = datetime.datetime.max
-            modified = datetime.datetime.min
-            for path in filelist:
-                if not os.path.isfile(path): continue
-                s = os.stat(path)
-                c = datetime.datetime.utcfromtimestamp(s.st_ctime)
-                m = datetime.datetime.utcfromtimestamp(s.st_mtime)
-                if c < created: created = c
-                if modified < m: modified = m
-            return (created, modified)
+    ''' a book read by read_files(), read_tree() or read_single_file() is a tuple of
+    (created, modified, nav, {filename: (page source, approximate size)}).
+    the text files are stat-ed, read, decoded and rendered on a pool of max_workers
+    threads (None: one by one when the book is saved), up to readahead pages ahead
+    of the page being written '''
+    text_extensions = ('.txt',)
+
+    def __init__(self, max_workers=4, readahead=16):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) \
+            if max_workers is not None else None
+        self.readahead = readahead
+
+    def __map(self, func, items, chunk_size=256):
+        ''' [func(item) for item in items], in chunks on the pool '''
+        if self.executor is None: return [func(item) for item in items]
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        return [r for results in self.executor.map(lambda chunk: [func(item) for item in chunk], chunks)
+                for r in results]
+
+    def __identifier(self, title, author, nav, package, volume):
+        ''' a random uuid, or when package is reproducible one derived from the title, the
+        author and the TOC, so that different books of the same title and author differ '''
+        if not package.reproducible: return str(uuid.uuid4())
+        names = [title, author]
+        def add_titles(node):
+            for child in node.children:
+                names.append(child.title)
+                add_titles(child)
+        add_titles(nav)
+        if volume is not None: names.append(str(volume))
+        return source_uuid(*names)
+
+    def __write_metadata(self, title, author, created, modified, nav, css_map, package, volume=None):
         meta = package.metadata
-        meta.add_title(title, lang='ja')
+        if volume is None: meta.add_title(title, lang='ja')
+        else: add_volume_metadata(meta, title, volume)
         meta.add_language('ja')
-        meta.add_identifier(str(uuid.uuid4()), unique_id=True)
-        created, modified = find_date_info()
+        meta.add_identifier(self.__identifier(title, author, nav, package, volume), unique_id=True)
         meta.add_modified(modified)
         meta.add_date_term('created', created)
-        meta.add_dcmes_info(DCMESDateInfo(datetime.datetime.utcnow()))
+        meta.add_dcmes_info(DCMESDateInfo(package.build_date(modified)))
         meta.add_dcmes_info(DCMESCreatorInfo(author, lang='ja'))
 
-        add_simple_cover(package.manifest, title, author, css_file=css_map.cover_css())
+        add_simple_cover(package.manifest, meta.get_dcmes_text('title'), author, css_file=css_map.cover_css())
         css_map.output(package.manifest)
 
-        nav = EPUBNav('toc', '目次', 'ja', css_map.toc_css())
-        toc_list = []
+    def __write_toc(self, nav, package):
+        compatible_toc = EPUBCompatibleNav([nav], package.metadata, package.manifest)
+        package.manifest.add_item('toc.ncx', str(compatible_toc).encode('UTF-8'), is_toc=True)
+        package.manifest.add_item('toc.xhtml', nav.to_xml().encode('UTF-8'), properties='nav',
+                                  spine_pos=package.manifest.find_spine_pos('cover.xhtml') + 1)
+
+    def write_book(self, title, author, book, css_map, package, volume=None):
+        (created, modified, nav, pages) = book
+        self.__write_metadata(title, author, created, modified, nav, css_map, package, volume)
+        links = []
+        def collect_links(node):
+            if node.link is not None: links.append(node.link)
+            for child in node.children: collect_links(child)
+        collect_links(nav)
+        if self.executor is None:
+            for link in links: package.manifest.add_item(link, pages[link][0])
+        else:
+            ahead = RenderAhead(self.executor, [pages[link][0] for link in links], self.readahead)
+            for (i, link) in enumerate(links): package.manifest.add_item(link, ahead.source(i))
+        self.__write_toc(nav, package)
+
+    def __stat(self, path):
+        ''' return os.stat(path), or None if path is not a file '''
+        try:
+            s = os.stat(path)
+        except OSError:
+            return None
+        return s if stat.S_ISREG(s.st_mode) else None
+
+    def __find_date_info(self, stats):
+        stats = [s for s in stats if s is not None]
+        if len(stats) == 0:
+            # titles only. the dates of the book do not matter
+            return (datetime.datetime.max, datetime.datetime.min)
+        # st_ctime is the time of the last copy or checkout rather than of the text
+        return (datetime.datetime.utcfromtimestamp(min(s.st_mtime for s in stats)),
+                datetime.datetime.utcfromtimestamp(max(s.st_mtime for s in stats)))
+
+    def __render_file(self, path, title, css_file, encoding):
+        if path is None:
+            return create_simple_page(title, 'h2', css_file, [])
+        with open(path, 'rb') as f:
+            data = f.read()
+        if encoding is None: encoding = detect_encoding(data)
+        return create_simple_page(title, 'h2', css_file, data.decode(encoding, 'replace').splitlines())
+
+    def __render_span(self, splitter, title, start, end, css_file):
+        return create_simple_page(title, 'h2', css_file, splitter.lines(start, end))
+
+    def __add_page(self, pages, node, path, s, css_map, encoding):
+        pages[node.link] = (functools.partial(self.__render_file, path if s is not None else None,
+                                              node.title, css_map.page_css(), encoding),
+                            s.st_size if s is not None else 0)
+
+    def read_files(self, filelist, css_map, encoding=None):
+        ''' read a book from one file per chapter. the files are ordered by the prefix of
+        their names ("00-1_title.txt"); a file whose prefix extends the prefix of an earlier
+        one ("00-1" of "00") is nested under it in the TOC. a name of no existing file
+        makes a page with the title only (e.g. a chapter title) '''
         class Entry:
             def __init__(self, path, prefix, title, levels):
                 self.path = path
                 self.prefix = prefix
                 self.title = title
                 self.levels = levels
-                self.filename = None
+        toc_list = []
         for x in filelist:
             items = os.path.splitext(os.path.basename(x))[0].split('_', 2)
             prefix, title, levels = items[0], items[1], items[0].split('-')
             toc_list.append(Entry(x, prefix, title, levels))
         toc_list = sorted(toc_list, key=operator.attrgetter('prefix'))
+        stats = self.__map(self.__stat, [entry.path for entry in toc_list])
+        created, modified = self.__find_date_info(stats)
 
-        autoid = 0
+        nav = EPUBNav('toc', '目次', 'ja', css_map.toc_css())
+        pages = {}
+        nodes = {}
         id_width = math.ceil(math.log10(len(toc_list)))
-        for entry in toc_list:
-            entry.filename = str(autoid).zfill(id_width) + '.xhtml'
-            autoid += 1
-            nav.add_child(entry.title, entry.filename)
-            data = create_simple_page(entry.title, 'h2', css_map.page_css(), open(entry.path, 'r')).encode('UTF-8')
-            package.manifest.add_item(entry.filename, data)
+        for (autoid, (entry, s)) in enumerate(zip(toc_list, stats)):
+            parent = nav
+            for i in range(len(entry.levels) - 1, 0, -1):
+                if tuple(entry.levels[:i]) in nodes:
+                    parent = nodes[tuple(entry.levels[:i])]
+                    break
+            node = parent.add_child(entry.title, str(autoid).zfill(id_width) + '.xhtml')
+            nodes[tuple(entry.levels)] = node
+            self.__add_page(pages, node, entry.path, s, css_map, encoding)
+        return (created, modified, nav, pages)
 
-        compatible_toc = EPUBCompatibleNav([nav], package.metadata, package.manifest)
-        package.manifest.add_item('toc.ncx', str(compatible_toc).encode('UTF-8'), is_toc=True)
-        package.manifest.add_item('toc.xhtml', nav.to_xml().encode('UTF-8'), properties='nav',
-                                  spine_pos=package.manifest.find_spine_pos('cover.xhtml') + 1)
+    def read_tree(self, root, css_map, encoding=None):
+        ''' read a book from a directory tree. every directory below root is a TOC entry
+        holding its files and directories, and every text file a chapter, both in the
+        order of their names. a "00_" prefix of a name is not part of the title '''
+        def title_of(name):
+            items = name.split('_', 1)
+            return items[1] if len(items) > 1 and len(items[1]) > 0 else name
+        nav = EPUBNav('toc', '目次', 'ja', css_map.toc_css())
+        files = []
+        def walk(path, parent):
+            with os.scandir(path) as it:
+                entries = sorted((e for e in it if not e.name.startswith('.')), key=operator.attrgetter('name'))
+            for e in entries:
+                if e.is_dir():
+                    node = EPUBNavNode(title_of(e.name))
+                    walk(e.path, node)
+                    # an empty directory has no page to point at
+                    if len(node.children) > 0: parent.children.append(node)
+                elif e.is_file() and os.path.splitext(e.name)[1].lower() in self.text_extensions:
+                    files.append((e.path, parent.add_child(title_of(os.path.splitext(e.name)[0]))))
+        walk(root, nav)
+        stats = self.__map(self.__stat, [path for (path, _) in files])
+        created, modified = self.__find_date_info(stats)
+        pages = {}
+        id_width = max(1, math.ceil(math.log10(len(files) + 1)))
+        for (autoid, ((path, node), s)) in enumerate(zip(files, stats)):
+            node.link = str(autoid).zfill(id_width) + '.xhtml'
+            self.__add_page(pages, node, path, s, css_map, encoding)
+        return (created, modified, nav, pages)
+
+    def read_single_file(self, title, path, css_map, heading_patterns=None, encoding=None):
+        ''' read a book from one (possibly huge) text file, splitting chapters at lines
+        matching heading_patterns '''
+        s = os.stat(path)
+        nav = EPUBNav('toc', '目次', 'ja', css_map.toc_css())
+        splitter = TextFileSplitter(path, heading_patterns, encoding)
+        chapters = splitter.chapters()
+        pages = {}
+        id_width = max(1, math.ceil(math.log10(len(chapters) + 1)))
+        for (autoid, (chapter_title, start, end)) in enumerate(chapters):
+            if chapter_title is None: chapter_title = title
+            filename = str(autoid).zfill(id_width) + '.xhtml'
+            nav.add_child(chapter_title, filename)
+            pages[filename] = (functools.partial(self.__render_span, splitter, chapter_title,
+                                                 start, end, css_map.page_css()), end - start)
+        return (datetime.datetime.utcfromtimestamp(s.st_mtime), datetime.datetime.utcfromtimestamp(s.st_mtime),
+                nav, pages)
+
+    def __call__(self, title, author, filelist, css_map, package):
+        self.write_book(title, author, self.read_files(filelist, css_map), css_map, package)
+
+    def from_single_file(self, title, author, path, css_map, package, heading_patterns=None, encoding=None):
+        ''' convert one (possibly huge) text file, splitting chapters at lines matching heading_patterns '''
+        self.write_book(title, author, self.read_single_file(title, path, css_map, heading_patterns, encoding),
+                          css_map, package)
+
+    def build_volumes(self, title, author, book, css_map, splitter, package_factory=EPUBPackage, max_workers=4):
+        ''' build a book split into volumes by splitter (a volume.VolumeSplitter).
+        the volumes are built concurrently. return the list of packages '''
+        (created, modified, nav, pages) = book
+        volumes = splitter.split(nav, lambda link: pages[link][1])
+        def build(number, entries):
+            package = package_factory()
+            volume_nav = EPUBNav('toc', '目次', 'ja', css_map.toc_css())
+            volume_nav.children = entries
+            self.write_book(title, author, (created, modified, volume_nav, pages), css_map, package,
+                              volume=number if len(volumes) > 1 else None)
+            return package
+        return build_volumes(volumes, build, max_workers)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 4:
-        print('''usage: python3 text.py [title] [author] text files...
+    opts, args = getopt.getopt(sys.argv[1:], 'rsdH:e:V:B:')
+    opts = dict((k, [v for (k2, v) in opts if k2 == k]) for (k, _) in opts)
+    if len(args) < 3 or (('-s' in opts or '-d' in opts) and len(args) != 3):
+        print('''usage: python3 text.py [-r] [-e encoding] [title] [author] text files...
+       python3 text.py -d [-r] [-e encoding] [title] [author] directory
+       python3 text.py -s [-r] [-H heading regex]... [-e encoding] [title] [author] text file
+
+  -r     reproducible build: the same text files (with the same modification times)
+         always give the same epub bytes
+  -e     encoding of the text files (default: utf-8, shift_jis or euc-jp, detected)
+
+volume options (write "title_N.epub" files):
+  -V N   at most N chapters per volume
+  -B N   at most about N bytes of text per volume
 
 if non-existent file attached, import title only.
 
@@ -73,7 +341,7 @@ Example1:
     section1
     section2
 
-Example2 (not implemented...):
+Example2:
   $ python3 text.py "novel title" "novel author" 00_chaptor1 00-0_section1.txt 00-1_section2.txt 01_chaptor2 01-0_section3
 
   output TOC:
@@ -81,15 +349,47 @@ Example2 (not implemented...):
       section1
       section2
     chaptor2
-      section3''')
+      section3
+
+Example3:
+  $ python3 text.py -d "novel title" "novel author" novel/
+
+  with novel/01_chaptor1/01_section1.txt, novel/01_chaptor1/02_section2.txt and
+  novel/02_chaptor2/01_section3.txt, output the TOC of Example2 (the directories
+  are TOC entries without a page of their own)
+
+Example4:
+  $ python3 text.py -s -H '^第.+章' "novel title" "novel author" novel.txt
+
+  split novel.txt (utf-8, shift_jis or euc-jp) into chapters at lines matching
+  the heading regexes (default: 第N章/第N話..., ［＃見出し］ and markdown headings)''')
         quit()
 
-    title = sys.argv[1]
-    author = sys.argv[2]
-    filelist = sys.argv[3:]
+    title = args[0]
+    author = args[1]
+    filelist = args[2:]
 
     css_map = StylesheetMap(('style.css', SimpleVerticalWritingStyle))
-    package = EPUBPackage()
-    package.spine.set_direction('rtl')
-    TextToEpub()(title, author, filelist, css_map, package)
-    package.save(title + '.epub')
+    def create_package():
+        package = EPUBPackage(reproducible='-r' in opts)
+        package.spine.set_direction('rtl')
+        return package
+    converter = TextToEpub()
+    encoding = opts.get('-e', [None])[0]
+    if '-s' in opts:
+        book = converter.read_single_file(title, filelist[0], css_map,
+                                          heading_patterns=opts.get('-H'), encoding=encoding)
+    elif '-d' in opts:
+        book = converter.read_tree(filelist[0], css_map, encoding=encoding)
+    else:
+        book = converter.read_files(filelist, css_map, encoding=encoding)
+    if '-V' in opts or '-B' in opts:
+        splitter = VolumeSplitter(max_items=int(opts['-V'][0]) if '-V' in opts else None,
+                                  max_bytes=int(opts['-B'][0]) if '-B' in opts else None)
+        packages = converter.build_volumes(title, author, book, css_map, splitter, package_factory=create_package)
+        for i in range(len(packages)):
+            packages[i].save(title + '_' + str(i + 1) + '.epub')
+    else:
+        package = create_package()
+        converter.write_book(title, author, book, css_map, package)
+        package.save(title + '.epub')
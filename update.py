@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import datetime, zipfile
+import xml.etree.ElementTree as ET
+from epub import RawEntry
+from style import placeholder_class
+
+OPF_NS = '{http://www.idpf.org/2007/opf}'
+DC_NS = '{http://purl.org/dc/elements/1.1/}'
+XHTML_NS = '{http://www.w3.org/1999/xhtml}'
+
+class PreviousBuild:
+    ''' an epub written earlier by the converters, opened to build an update of it.
+    identifier:  the unique identifier of the book
+    modified:    dcterms:modified of the book (datetime, utc) or None
+    media_types: {href: media type} of the manifest
+    links:       the links of the toc nav in document order (e.g. "0012.xhtml#ep12")
+    entry(href) returns a manifest item as a RawEntry, so that the new build copies it
+    without compressing it again. has_placeholder(href) tells whether a document has a
+    page standing in for contents that could not be fetched, which must not be copied.
+    raises zipfile.BadZipFile, KeyError, ValueError or
+    xml.etree.ElementTree.ParseError when file is not such an epub '''
+    rootdir = 'OPBES/'
+    # the opf and the nav are read into memory. the pages are only copied
+    max_document_size = 16 * 1024 * 1024
+
+    def __init__(self, file):
+        self.zip = zipfile.ZipFile(file)
+        self.placeholders = {}
+        try:
+            self.__read_opf()
+        except:
+            self.zip.close()
+            raise
+
+    def __read(self, href):
+        zinfo = self.zip.getinfo(self.rootdir + href)
+        if zinfo.file_size > self.max_document_size: raise ValueError('too large document: ' + href)
+        return self.zip.read(zinfo)
+
+    def __read_opf(self):
+        opf = ET.fromstring(self.__read('content.opf'))
+        unique_id = opf.attrib.get('unique-identifier')
+        self.identifier = None
+        for e in opf.iter(DC_NS + 'identifier'):
+            if self.identifier is None or e.attrib.get('id') == unique_id: self.identifier = e.text
+        self.modified = None
+        for e in opf.iter(OPF_NS + 'meta'):
+            if e.attrib.get('property') == 'dcterms:modified' and e.text is not None:
+                self.modified = datetime.datetime.strptime(e.text.strip(), '%Y-%m-%dT%H:%M:%SZ')
+        self.media_types = {}
+        nav_href = None
+        for item in opf.iter(OPF_NS + 'item'):
+            self.media_types[item.attrib['href']] = item.attrib.get('media-type')
+            if 'nav' in item.attrib.get('properties', '').split(): nav_href = item.attrib['href']
+        self.links = []
+        if nav_href is None: return
+        nav_doc = ET.fromstring(self.__read(nav_href))
+        for nav in nav_doc.iter(XHTML_NS + 'nav'):
+            if nav.attrib.get('{http://www.idpf.org/2007/ops}type') != 'toc': continue
+            self.links.extend(a.attrib['href'] for a in nav.iter(XHTML_NS + 'a') if 'href' in a.attrib)
+
+    def has_placeholder(self, href):
+        href = href.split('#', 1)[0]
+        if href not in self.placeholders:
+            data = self.__read(href)
+            # parse only the documents that may have the class
+            self.placeholders[href] = placeholder_class.encode('UTF-8') in data and \
+                any(placeholder_class in e.attrib.get('class', '').split() for e in ET.fromstring(data).iter())
+        return self.placeholders[href]
+
+    def entry(self, href):
+        return RawEntry(self.zip, self.rootdir + href)
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
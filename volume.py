@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from epub import *
+import concurrent.futures
+
+class VolumeSplitter:
+    ''' split a book into volumes by its top-level TOC entries.
+    by_chapter: a chapter (a top-level entry with children) always starts a new volume
+                when there is no budget, and is kept in one volume when it fits the budget
+    max_items:  maximum number of pages in a volume
+    max_bytes:  maximum approximate size of the pages in a volume
+    a chapter larger than the budget is split, and its rest is repeated as a new
+    top-level entry with the same title in the next volume. '''
+    def __init__(self, max_items=None, max_bytes=None, by_chapter=True):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.by_chapter = by_chapter
+
+    def __leaves(self, node):
+        if node.link is not None: yield node
+        for child in node.children:
+            yield from self.__leaves(child)
+
+    def split(self, nav, size_of):
+        ''' size_of(link) returns the approximate size of a page.
+        return [[EPUBNavNode]], the top-level entries of each volume '''
+        has_budget = self.max_items is not None or self.max_bytes is not None
+        volumes = [[]]
+        used = [0, 0]
+        def measure(node):
+            leaves = list(self.__leaves(node))
+            return (len(leaves), sum(size_of(leaf.link) for leaf in leaves))
+        def fits(cost):
+            return (self.max_items is None or used[0] + cost[0] <= self.max_items) and \
+                (self.max_bytes is None or used[1] + cost[1] <= self.max_bytes)
+        def new_volume():
+            if len(volumes[-1]) > 0:
+                volumes.append([])
+                used[0], used[1] = 0, 0
+        def add(parent, node, cost):
+            if parent is None: volumes[-1].append(node)
+            else: parent.children.append(node)
+            used[0] += cost[0]
+            used[1] += cost[1]
+        for node in nav.children:
+            cost = measure(node)
+            is_chapter = len(node.children) > 0
+            if is_chapter and self.by_chapter and not has_budget: new_volume()
+            if fits(cost):
+                add(None, node, cost)
+                continue
+            if not is_chapter:
+                new_volume()
+                add(None, node, cost)
+                continue
+            if self.by_chapter: new_volume()
+            part = None
+            for child in node.children:
+                child_cost = measure(child)
+                if part is None or (not fits(child_cost) and used[0] > 0):
+                    if part is not None: new_volume()
+                    part = EPUBNavNode(node.title, node.link if part is None else None)
+                    add(None, part, (0, 0))
+                add(part, child, child_cost)
+        if len(volumes[-1]) == 0 and len(volumes) > 1: volumes.pop()
+        return volumes
+
+    def describe(self):
+        ''' short stable description of the settings, e.g. for cache keys '''
+        return 'c%d-i%s-b%s' % (1 if self.by_chapter else 0, self.max_items, self.max_bytes)
+
+def add_volume_metadata(metadata, title, number):
+    ''' add the per-volume title and the collection shared by all volumes '''
+    metadata.add_title('%s 第%d巻' % (title, number), lang='ja')
+    metadata.add_collection(title, position=number)
+
+def build_volumes(volumes, build_func, max_workers=4):
+    ''' call build_func(number, top-level entries) for each volume concurrently.
+    return the built packages in volume order '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(build_func, range(1, len(volumes) + 1), volumes))
+
+def save_volumes(packages, file, basename, **save_args):
+    ''' save the volumes into one zip (stored, the epubs are already compressed) '''
+    width = len(str(len(packages)))
+    with ZipFile(file, 'w', ZIP_STORED) as z:
+        for i in range(len(packages)):
+            zinfo = ZipInfo(basename + '_' + str(i + 1).zfill(width) + '.epub',
+                            date_time=packages[i].date_time())
+            zinfo.external_attr = 0o600 << 16
+            with z.open(zinfo, 'w') as f:
+                packages[i].save(f, **save_args)
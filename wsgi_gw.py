@@ -1,30 +1,72 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-import io, sys, os.path, urllib.parse
-from urllib.parse import parse_qs, urlparse
+import contextlib, datetime, hashlib, http.client, inspect, json, re, sys, os.path, tempfile, threading, urllib.parse, zipfile
+import xml.etree.ElementTree as ET
+from urllib.parse import parse_qs
 from urllib.error import HTTPError
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-import syosetu_com, mai_net, epub, style
+import sites
 from cache import SimpleCache
+from admission import AdmissionController
 
 class SimpleGW:
     SYOSETU_COM = 'syosetu.com'
     MAI_NET = 'mai-net.net'
 
-    def __init__(self, cache):
+    def __init__(self, cache, volume_max_items=300, volume_max_bytes=None, pack_size=16 * 1024,
+                 profiler=None, admission=None, max_upload_bytes=64 * 1024 * 1024):
+        ''' volume_max_items, volume_max_bytes: default volume budgets of "vol" requests.
+        ?vol=N returns the Nth volume and ?vol=zip all volumes in a zip. "items", "bytes"
+        and "chapters=0" (do not keep chapters together) override the split.
+        pack_size: with ?pack=1 the converters pack short episodes into documents of about
+                   this size. it is opt-in as packing moves the episodes into NN.xhtml#epN, and
+                   so breaks the reading positions saved against earlier downloads
+        profiler: a profiling.RequestProfiler deciding which conversions to profile
+        admission: an admission.AdmissionController limiting the builds. give the same one
+                   to the cache so that the pages of each build are charged
+        max_upload_bytes: maximum size of an epub POSTed to be updated '''
         self.cache = cache
-        self.service_map = {
-            SimpleGW.SYOSETU_COM: syosetu_com.SyosetuCom(cache=self.cache),
-            SimpleGW.MAI_NET: mai_net.MaiNet(cache=self.cache)
-        }
+        self.profiler = profiler
+        self.admission = admission
+        self.pack_size = pack_size
+        self.max_upload_bytes = max_upload_bytes
+        self.volume_max_items = volume_max_items
+        self.volume_max_bytes = volume_max_bytes
+        self.service_map = {}
+        self.service_map_lock = threading.Lock()
+
+    def get_converter(self, service_name, packed=False):
+        ''' return the converter of service_name, packing short episodes if packed and
+        the converter takes a pack_size. its module is imported on first use '''
+        with self.service_map_lock:
+            converter = self.service_map.get((service_name, packed))
+            if converter is None:
+                site = sites.get_site(service_name)
+                if site is None: return None
+                if packed and 'pack_size' in inspect.signature(site.converter_class()).parameters:
+                    converter = site.converter_class()(cache=self.cache, pack_size=self.pack_size)
+                else:
+                    converter = site.converter_class()(cache=self.cache)
+                self.service_map[(service_name, packed)] = converter
+            return converter
+
+    @staticmethod
+    def is_packed(qs):
+        return qs.get('pack', ['0'])[0] == '1'
+
+    @staticmethod
+    def build_key(service_name, code, packed):
+        return 'epub:' + service_name + ':' + code + (':packed' if packed else '')
 
     def __call__(self, environ, start_response):
         qs = parse_qs(environ['QUERY_STRING'])
         if 'url' in qs:
+            if 'plan' in qs: return self.PlanFromURL(qs['url'][0], environ, start_response)
             return self.ConvertFromURL(qs['url'][0], environ, start_response)
         if 's' in qs and 'n' in qs:
+            if 'plan' in qs: return self.Plan(qs['s'][0], qs['n'][0], environ, start_response)
             return self.Convert(qs['s'][0], qs['n'][0], environ, start_response)
 
         mime_type = 'application/xhtml+xml'
@@ -36,14 +78,13 @@ class SimpleGW:
 <h1 style="font-size:x-large">ePub3 Converter</h1>
 <p>下記のサイトで公開されている小説等をePub3形式に変換します．</p>
 <ul>
-<li><a href="http://syosetu.com/" target="_blank">小説家になろう</a></li>
-<li><a href="http://www.mai-net.net/" target="_blank">Arcadia</a></li>
-</ul>
+<!-- sites --></ul>
 <h2 style="font-size:large">URLからePub3に変換</h2>
 <span>URL:</span>
 <form method="GET" target="_blank" style="display:inline">
 <input type="text" size="60" name="url" />
 <input type="submit" value="変換" />
+<label><input type="checkbox" name="pack" value="1" />短い話を1ファイルにまとめる</label>
 </form>
 
 <div style="border-top: 1px solid black; margin-top: 3em;font-size:small">
@@ -57,56 +98,324 @@ GitHubよりソースコードをダウンロードして各自のPC上で変換
 <h2 style="font-size:medium">ソースコードや不具合等の報告</h2>
 <p>ePub3変換プログラムのソースコードや，このサイトを構成するプログラム等は<a href="https://github.com/kazuki/epub3-converter" target="_blank">GitHub</a>にて公開しています．</p>
 <p>不具合等を見つけましたら<a href="https://github.com/kazuki/epub3-converter/issues" target="_blank">GitHubのバグ報告ページ</a>または，Twitter(@k_oi)，メール(k at oikw.org)へ報告すると，気が向いたときに修正するかもしれません．</p></div>
-</body></html>"""
+</body></html>""".replace('<!-- sites -->', ''.join(
+            '<li><a href="%s" target="_blank">%s</a></li>\n' % (site.homepage, site.title) for site in sites.sites))
         return [contents.encode('UTF-8')]
 
     def ConvertFromURL(self, url, environ, start_response):
-        url = urlparse(url)
-        service_name = None
-        code = None
-        if url.hostname.endswith('.syosetu.com'):
-            service_name = SimpleGW.SYOSETU_COM
-            if url.path.startswith('/n') or url.path.startswith('/N'):
-                code = url.path[1:]
-                if code.find('/') > 0:
-                    code = code[0:code.find('/')]
-                code = code.lower()
-        elif url.hostname == 'www.mai-net.net':
-            service_name = SimpleGW.MAI_NET
-            code = parse_qs(url.query).get('all')[0]
+        (site, code) = sites.find_site(url)
+        service_name = site.name if site is not None else None
         return self.Convert(service_name, code, environ, start_response)
-        
+
+    # estimated size of a page of the epub when no page of the book is cached yet,
+    # and of the cover, TOC and stylesheet
+    plan_page_bytes = 8 * 1024
+    plan_overhead_bytes = 4 * 1024
+
+    def PlanFromURL(self, url, environ, start_response):
+        (site, code) = sites.find_site(url)
+        service_name = site.name if site is not None else None
+        return self.Plan(service_name, code, environ, start_response)
+
+    def Plan(self, service_name, code, environ, start_response):
+        ''' describe the conversion of a book in json without building it: only the metadata
+        and the TOC are read, never a chapter.
+        chapters:        the number of chapters (null if unknown before fetching them)
+        cached_chapters: how many of their pages are cached and fresh
+        fetches:         the number of pages a conversion would download now
+        estimated_bytes: the approximate size of the epub, from the compressed size of the
+                         cached pages (an overestimate, as they include the site layout)
+        build_cached:    a fresh build is cached. it is served at once and its size is exact '''
+        def reply(status, body):
+            start_response(status, [('Content-Type', 'application/json; charset=UTF-8'),
+                                     ('Cache-Control', 'no-cache')])
+            return [json.dumps(body, ensure_ascii=False).encode('UTF-8')]
+        try:
+            packed = self.is_packed(parse_qs(environ.get('QUERY_STRING', '')))
+            converter = self.get_converter(service_name, packed)
+            if converter is None or code is None or not hasattr(converter, 'plan'):
+                return reply('404 Not Found', {'error': 'unsupported url'})
+            cached = self.cache.lookup_file(self.build_key(service_name, code, packed))
+            plan = converter.plan(code)
+            pages = plan.pop('pages')
+            sizes = self.cache.cached_sizes([url for (url, _) in pages], dict(pages))
+            cached_sizes = [size for size in sizes if size is not None]
+            page_bytes = sum(cached_sizes) // len(cached_sizes) if len(cached_sizes) > 0 else self.plan_page_bytes
+            plan.update(site=service_name, code=code,
+                        cached_chapters=len(cached_sizes) if plan['chapters'] is not None else None,
+                        fetches=0 if cached is not None else len(sizes) - len(cached_sizes),
+                        build_cached=cached is not None,
+                        estimated_bytes=os.path.getsize(cached[1]) if cached is not None else
+                            sum(cached_sizes) + page_bytes * (len(sizes) - len(cached_sizes)) +
+                            self.plan_overhead_bytes)
+            if plan['last_modified'] is not None: plan['last_modified'] = plan['last_modified'].isoformat()
+            return reply('200 OK', plan)
+        except HTTPError as ex:
+            return reply('%d %s' % (ex.code, http.client.responses.get(ex.code, 'Error')),
+                         {'error': 'HTTP %d' % ex.code})
+        except Exception as ex:
+            sys.stderr.write('plan failed (%s). site=%s code=%s\n' % (ex, service_name, code))
+            return reply('500 Internal Server Error', {'error': 'conversion failed'})
+
+    range_regex = re.compile(r'^bytes=([0-9]*)-([0-9]*)$')
+
+    def __read_epub_title(self, path):
+        with zipfile.ZipFile(path) as z:
+            opf = ET.fromstring(z.read('OPBES/content.opf'))
+        title = opf.find('{http://www.idpf.org/2007/opf}metadata/{http://purl.org/dc/elements/1.1/}title')
+        return title.text if title is not None else None
+
+    def __parse_range(self, environ, size, etag):
+        ''' return (start, end) of a satisfiable single range, None for a full response
+        or False if the range is not satisfiable '''
+        range_value = environ.get('HTTP_RANGE')
+        if range_value is None: return None
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range is not None and if_range != etag: return None
+        m = SimpleGW.range_regex.match(range_value.strip())
+        if m is None or (m.group(1) == '' and m.group(2) == ''): return None
+        if m.group(1) == '':
+            start, end = max(0, size - int(m.group(2))), size - 1
+        else:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) != '' else size - 1
+        if start >= size or start > end: return False
+        return (start, end)
+
+    def __serve_file(self, path, filename, etag, environ, start_response,
+                     content_type='application/epub+zip', no_store=False):
+        size = os.path.getsize(path)
+        headers = [('Content-Type', content_type),
+                   ('Accept-Ranges', 'bytes'),
+                   ('ETag', etag),
+                   ('Content-Disposition', 'attachment; filename*="' + filename + '"')]
+        if no_store: headers.append(('Cache-Control', 'no-store'))
+        byte_range = self.__parse_range(environ, size, etag)
+        if byte_range is False:
+            start_response('416 Range Not Satisfiable', [('Content-Range', 'bytes */' + str(size))])
+            return []
+        if byte_range is None:
+            status, start, end = '200 OK', 0, size - 1
+        else:
+            (start, end) = byte_range
+            status = '206 Partial Content'
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+        headers.append(('Content-Length', str(end - start + 1)))
+        start_response(status, headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        f = open(path, 'rb')
+        f.seek(start)
+        if end == size - 1 and 'wsgi.file_wrapper' in environ:
+            # the server may use sendfile from the current offset
+            return environ['wsgi.file_wrapper'](f, 1024 * 64)
+        return self.__read_range(f, end - start + 1)
+
+    def __read_range(self, f, length):
+        with f:
+            while length > 0:
+                buf = f.read(min(length, 1024 * 64))
+                if not buf: break
+                length -= len(buf)
+                yield buf
+
+    def __create_package(self):
+        import epub
+        # identical sources give identical files, so their blobs and ETags are shared
+        package = epub.EPUBPackage(reproducible=True)
+        package.spine.set_direction('rtl')
+        return package
+
+    def __store_build(self, cache_key, incomplete, save_func):
+        ''' save a build to the blob store. return the key it was stored as '''
+        if incomplete:
+            # keep placeholder builds out of the build cache. the fetched
+            # chapters are cached, so the next request only fetches the rest
+            cache_key = 'epub-incomplete:' + cache_key[len('epub:'):]
+        with tempfile.TemporaryFile() as f:
+            save_func(f)
+            f.seek(0)
+            self.cache.store_file(cache_key, f)
+        return cache_key
+
+    def __open_previous(self, file):
+        ''' return an update.PreviousBuild of file, or None if it is not an epub we can update '''
+        import update
+        try:
+            return update.PreviousBuild(file)
+        except (zipfile.BadZipFile, KeyError, ValueError, ET.ParseError) as ex:
+            sys.stderr.write('cannot update the previous build (%s)\n' % (ex,))
+            return None
+
+    def __build(self, converter, code, cache_key, css_map, previous_path=None):
+        ''' previous_path: an expired build of the book. a converter supporting updates
+        copies its unchanged pages instead of fetching them again '''
+        package = self.__create_package()
+        previous = self.__open_previous(previous_path) \
+            if previous_path is not None and hasattr(converter, 'update') else None
+        if previous is None:
+            converter(package, css_map, code)
+            return self.__store_build(cache_key, package.incomplete,
+                                      lambda f: package.save(f, deflate_cache=self.cache.deflate_cache))
+        with previous:
+            converter.update(package, css_map, code, previous)
+            return self.__store_build(cache_key, package.incomplete,
+                                      lambda f: package.save(f, deflate_cache=self.cache.deflate_cache))
+
+    def __convert_upload(self, converter, code, environ, start_response):
+        ''' update the epub POSTed as the request body. the result contains pages sent by
+        the client, so it is served as is and never stored in the build cache '''
+        import style
+        if not hasattr(converter, 'update'):
+            start_response('400 Bad Request', [('Content-Type', 'text/plain; charset=UTF-8')])
+            return ['このサイトのePub3ファイルの更新には対応していません．'.encode('UTF-8')]
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if length <= 0 or length > self.max_upload_bytes:
+            start_response('413 Payload Too Large', [('Content-Type', 'text/plain; charset=UTF-8')])
+            return [('更新できるePub3ファイルは%dMBまでです．' % (self.max_upload_bytes // 1024 // 1024)).encode('UTF-8')]
+        css_map = style.StylesheetMap(('style.css', style.SimpleVerticalWritingStyle))
+        (fd, path) = tempfile.mkstemp(dir=self.cache.blobs.root_dir, prefix='.tmp-upload-')
+        try:
+            with tempfile.TemporaryFile() as upload, os.fdopen(fd, 'w+b') as f:
+                while length > 0:
+                    buf = environ['wsgi.input'].read(min(length, 1024 * 64))
+                    if not buf: break
+                    length -= len(buf)
+                    upload.write(buf)
+                previous = self.__open_previous(upload)
+                if previous is None:
+                    start_response('400 Bad Request', [('Content-Type', 'text/plain; charset=UTF-8')])
+                    return ['このコンバータで変換したePub3ファイルを送信してください．'.encode('UTF-8')]
+                with previous, self.admission.build() if self.admission is not None else contextlib.nullcontext():
+                    package = self.__create_package()
+                    converter.update(package, css_map, code, previous)
+                    package.save(f, deflate_cache=self.cache.deflate_cache)
+                f.seek(0)
+                h = hashlib.sha512()
+                for buf in iter(lambda: f.read(1024 * 64), b''): h.update(buf)
+            filename = self.__read_epub_title(path)
+            if filename is None: filename = str(code)
+            filename = "utf-8'en'" + urllib.parse.quote(filename + '.epub', encoding='utf-8', errors='replace')
+            # __serve_file opens the file before returning, so it can be unlinked afterwards
+            return self.__serve_file(path, filename, '"' + h.hexdigest()[0:64] + '"', environ, start_response,
+                                     no_store=True)
+        finally:
+            os.unlink(path)
+
+    def __build_volumes(self, converter, code, cache_key, css_map, splitter, volume_request):
+        ''' build every volume at once and store each of them and their zip.
+        return the key of the requested one, or None if there is no such volume '''
+        import volume
+        packages = converter.build_volumes(css_map, code, splitter, package_factory=self.__create_package)
+        incomplete = any(package.incomplete for package in packages)
+        keys = {}
+        for i in range(len(packages)):
+            keys[str(i + 1)] = self.__store_build(cache_key + ':' + str(i + 1), incomplete,
+                lambda f: packages[i].save(f, deflate_cache=self.cache.deflate_cache))
+        keys['zip'] = self.__store_build(cache_key + ':zip', incomplete,
+            lambda f: volume.save_volumes(packages, f, code, deflate_cache=self.cache.deflate_cache))
+        return keys.get(volume_request)
+
+    def __volume_splitter(self, qs):
+        import volume
+        def int_param(name, default):
+            return int(qs[name][0]) if name in qs else default
+        return volume.VolumeSplitter(max_items=int_param('items', self.volume_max_items),
+                                     max_bytes=int_param('bytes', self.volume_max_bytes),
+                                     by_chapter=int_param('chapters', 1) != 0)
+
     def Convert(self, service_name, code, environ, start_response):
+        if self.profiler is not None and self.profiler.wants(environ):
+            return self.profiler.run('%s-%s' % (service_name, code),
+                                     self.__convert, service_name, code, environ, start_response)
+        return self.__convert(service_name, code, environ, start_response)
+
+    def __convert(self, service_name, code, environ, start_response):
         try:
-            converter = self.service_map.get(service_name)
+            qs = parse_qs(environ.get('QUERY_STRING', ''))
+            packed = self.is_packed(qs)
+            converter = self.get_converter(service_name, packed)
             if converter is None or code is None:
                 raise 'argument error'
 
-            css_map = style.StylesheetMap(('style.css', style.SimpleVerticalWritingStyle))
-            package = epub.EPUBPackage()
-            package.spine.set_direction('rtl')
+            volume_request = qs.get('vol', [None])[0]
+            cache_key = self.build_key(service_name, code, packed)
+            if volume_request is not None:
+                if not hasattr(converter, 'build_volumes'):
+                    start_response('404 Not Found', [('Content-Type', 'text/plain; charset=UTF-8')])
+                    return ['このサイトの小説は分冊に対応していません．'.encode('UTF-8')]
+                splitter = self.__volume_splitter(qs)
+                cache_key += ':' + splitter.describe()
+            content_type = 'application/zip' if volume_request == 'zip' else 'application/epub+zip'
+            if environ.get('REQUEST_METHOD') == 'POST' and volume_request is None:
+                return self.__convert_upload(converter, code, environ, start_response)
 
-            converter(package, css_map, code)
-            bio = io.BytesIO()
-            package.save(bio)
+            requested_key = cache_key + (':' + volume_request if volume_request else '')
+            cached = self.cache.lookup_file(requested_key)
+            if cached is None and environ.get('REQUEST_METHOD') == 'HEAD':
+                # do not build the epub only for HEAD requests. there is no file to describe yet
+                start_response('404 Not Found', [('Content-Type', 'text/plain; charset=UTF-8'),
+                                                 ('Cache-Control', 'no-cache')])
+                return []
+            incomplete = False
+            if cached is None:
+                import style
+                css_map = style.StylesheetMap(('style.css', style.SimpleVerticalWritingStyle))
+                try:
+                    with self.admission.build() if self.admission is not None else contextlib.nullcontext():
+                        if volume_request is None:
+                            # an expired build is updated rather than built again
+                            expired = self.cache.lookup_file(requested_key, use_cache_newer_than=datetime.datetime.min)
+                            stored_key = self.__build(converter, code, cache_key, css_map,
+                                                      expired[1] if expired is not None else None)
+                        else:
+                            stored_key = self.__build_volumes(converter, code, cache_key, css_map, splitter,
+                                                              volume_request)
+                    if stored_key is None:
+                        start_response('404 Not Found', [('Content-Type', 'text/plain; charset=UTF-8')])
+                        return ['指定された巻は存在しません．'.encode('UTF-8')]
+                    incomplete = stored_key.startswith('epub-incomplete:')
+                    cached = self.cache.lookup_file(stored_key, use_cache_newer_than=datetime.datetime.min)
+                except HTTPError as ex:
+                    # serve the last complete build of any age rather than an error page
+                    cached = self.cache.lookup_file(requested_key, use_cache_newer_than=datetime.datetime.min)
+                    if cached is None or ex.code in (404, 410): raise
+                    sys.stderr.write('build failed (%d). serve the build of %s. key=%s\n' %
+                                     (ex.code, cached[0].accessed.isoformat(), requested_key))
+                    incomplete = True
+            (entry, path) = cached
 
-            filename = package.metadata.get_dcmes_text('title')
-            if filename is None: filename = str(code)
-            filename += '.epub'
+            if volume_request == 'zip':
+                filename = str(code) + '.zip'
+            else:
+                filename = self.__read_epub_title(path)
+                if filename is None: filename = str(code)
+                filename += '.epub'
             filename = "utf-8'en'" + urllib.parse.quote(filename, encoding='utf-8', errors='replace')
-            epub_binary = bio.getvalue()
-            start_response('200 OK', [('Content-Type', 'application/epub+zip'),
-                                      ('Content-Length', str(len(epub_binary))),
-                                      ('Content-Disposition', 'attachment; filename*="' + filename + '"')])
-            return [epub_binary]
+            return self.__serve_file(path, filename, '"' + entry.hash + '"', environ, start_response,
+                                     content_type=content_type, no_store=incomplete)
         except HTTPError as ex:
             if ex.code in (503,):
-                start_response('503 Service Unavailable', [('Content-Type', 'text/plain; charset=UTF-8'),
-                                                           ('Pragma', 'no-cache'),
-                                                           ('Cache-Control', 'no-cache')])
+                headers = [('Content-Type', 'text/plain; charset=UTF-8'),
+                           ('Pragma', 'no-cache'),
+                           ('Cache-Control', 'no-cache')]
+                if getattr(ex, 'retry_after', None) is not None:
+                    # shed by the admission controller, not throttled by the site
+                    headers.append(('Retry-After', str(ex.retry_after)))
+                    start_response('503 Service Unavailable', headers)
+                    err_msg = 'HTTP 503 (Service Unavailable): 変換サーバが混雑しています．'
+                    err_msg += '%d秒以上時間をおいてから再試行してください。' % ex.retry_after
+                    return [err_msg.encode('UTF-8')]
+                start_response('503 Service Unavailable', headers)
                 err_msg = 'HTTP 503 (Service Unavailable): 指定された小説サイトが一時的な過負荷状態または、アクセス制限を受けています．\n'
                 err_msg += '1分以上時間をおいてから再試行するか、スクリプトを利用者のPC上で実行してください。'
                 return [err_msg.encode('UTF-8')]
+            if ex.code in (504,):
+                start_response('504 Gateway Timeout', [('Content-Type', 'text/plain; charset=UTF-8'),
+                                                       ('Pragma', 'no-cache'),
+                                                       ('Cache-Control', 'no-cache')])
+                err_msg = 'HTTP 504 (Gateway Timeout): オフラインで動作中のため、キャッシュにない小説は変換できません．'
+                return [err_msg.encode('UTF-8')]
             raise ex
         except:
             start_response('500 Internel Server Error', [('Content-Type', 'text/plain; charset=UTF-8'),
@@ -117,9 +426,30 @@ GitHubよりソースコードをダウンロードして各自のPC上で変換
             return [err_msg.encode('UTF-8')]
 
 data_dir=os.path.dirname(os.path.abspath(__file__)) + '/data'
-application = SimpleGW(SimpleCache(cache_dir=data_dir))
+profiler = None
+if 'EPUB3_PROFILE_SECRET' in os.environ or 'EPUB3_PROFILE_RATE' in os.environ:
+    import profiling
+    profiler = profiling.RequestProfiler(os.environ.get('EPUB3_PROFILE_DIR', data_dir + '/profiles'),
+                                         secret=os.environ.get('EPUB3_PROFILE_SECRET'),
+                                         sample_rate=float(os.environ.get('EPUB3_PROFILE_RATE', 0)))
+egress = None
+if 'EPUB3_FETCH_WORKERS' in os.environ:
+    # download through fetch workers (comma separated urls) on other addresses
+    import fetch_worker
+    egress = fetch_worker.EgressPool(os.environ['EPUB3_FETCH_WORKERS'].split(','),
+                                     rate=float(os.environ.get('EPUB3_FETCH_WORKER_RATE', 1)),
+                                     token=os.environ.get('EPUB3_FETCH_WORKER_TOKEN'))
+admission = AdmissionController()
+application = SimpleGW(SimpleCache(cache_dir=data_dir,
+                                   stale_while_revalidate=datetime.timedelta(days=1),
+                                   stale_if_error=datetime.timedelta(days=7),
+                                   admission=admission, egress=egress),
+                       profiler=profiler, admission=admission)
 
 if __name__ == '__main__':
     from wsgiref.simple_server import make_server
+    if '--offline' in sys.argv[1:]:
+        # build only from the cached pages, e.g. while the sites are unreachable
+        application.cache.cache_only = True
     httpd = make_server('', 8080, application)
     httpd.serve_forever()